@@ -1,5 +1,7 @@
 import numpy as np
 import pandas as pd
+import patsy
+from scipy import stats
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 from statsmodels.stats.multitest import multipletests
@@ -16,20 +18,27 @@ def anova_for_all_peaks_with_adjustment(df, variables, interaction='double'):
     """
     # Get p-values for each analysis
     pvs = anova_for_all_peaks_vs_some_variables(df, variables, interaction)
-    # Flatten p-value df into 1-dimensional array
-    p_values = pvs.values.ravel()
-
     # Adjust p-values with Benjamini/Hochberg procedure
-    p_values_corrected = multipletests(p_values, method='fdr_tsbh')
-    bool_p = p_values_corrected[0].reshape(pvs.shape)
-    cor_p = p_values_corrected[1].reshape(pvs.shape)
+    bool_p, cor_p = adjust_p_values(pvs.values)
     # Create df with adjusted p-values and mask that which are higher than 0.05
     p_values_corrected = pd.DataFrame(cor_p, columns=pvs.columns, index=pvs.index)
     p_value_appropriate = p_values_corrected[pd.DataFrame(bool_p, columns=pvs.columns, index=pvs.index)]
     return p_value_appropriate
 
 
-def anova_for_all_peaks_vs_some_variables(df, variables, interaction='double'):
+def adjust_p_values(p_values):
+    """
+    Adjust p-values of all analyses together with two-stage Benjamini/Hochberg procedure
+    :param p_values: array - p-values with shape terms X peaks
+    :return: (array, array) - boolean array of significant p-values and array of adjusted p-values, both with the shape
+    of p_values
+    """
+    # Flatten p-values into 1-dimensional array, adjust them and return to original shape
+    reject, corrected, _, _ = multipletests(p_values.ravel(), method='fdr_tsbh')
+    return reject.reshape(p_values.shape), corrected.reshape(p_values.shape)
+
+
+def anova_for_all_peaks_vs_some_variables(df, variables, interaction='double', method='matrix'):
     """
     Conduct anova for each column on columns in variables - each column in df except those which are in variables will
     be analysed vs those in variables
@@ -37,19 +46,99 @@ def anova_for_all_peaks_vs_some_variables(df, variables, interaction='double'):
     :param df: df - dataframe, which contains all aforementioned columns
     :param variables: list - list with column names which will be used in anova
     :param interaction: str - one of 'no', 'double' and 'multiple' denoting type of interaction
+    :param method: str - 'matrix' to compute all peaks at once with one design matrix or 'statsmodels' to fit
+                         separate model for each peak (slow, kept as reference)
     :return: df - dataframe with shape len(variables) + their interactions X len(df.columns) - len(varibles) with
     p-value for each analysis
     """
-    # Create df for p-values of all interactions in anova
-    pvs = pd.DataFrame()
+    peaks = df.columns[:-2]
+
+    # Fit model for each peak by age and tissue with interaction and collect p-values
+    if method == 'statsmodels':
+        pvs = pd.concat({peak: anova(df, peak, variables, interaction) for peak in peaks}, axis=1)
+        return pvs
 
-    # Conduct anova for each peak by age and tissue with interaction and add information to dataframe
-    for peak in df.columns[:-2]:
-        analysis = anova(df, peak, variables, interaction)
-        pvs[peak] = analysis
+    # Build design matrix once and compute p-values for all peaks together
+    design, terms = design_matrix(df, variables, interaction)
+    intensities = df.loc[design.index, peaks].to_numpy(dtype='float')
+    p_values = anova_matrix(design.values, intensities, list(terms.values()))
+
+    pvs = pd.DataFrame(p_values, index=list(terms.keys()), columns=peaks)
     return pvs
 
 
+def design_matrix(df, variables, interaction='double'):
+    """
+    Build design matrix for right-hand side of anova formula, the same which is used by statsmodels for each peak
+    Rows with NA in variables are dropped
+    :param df: df - dataframe, which contains variables columns
+    :param variables: list - list with column names which will be used in anova
+    :param interaction: str - one of 'no', 'double' and 'multiple' denoting type of interaction
+    :return: (df, dict) - design matrix indexed as df and dict with term name: slice of its columns in design matrix
+    without intercept
+    """
+    # Take right-hand side of formula, dependent term is not needed here
+    formula = construct_formula('y', variables, interaction)
+    rhs = formula.split('~', 1)[1]
+
+    design = patsy.dmatrix(rhs, df[list(variables)], return_type='dataframe')
+    info = design.design_info
+    terms = {term: info.slice(term) for term in info.term_names if term != 'Intercept'}
+    return design, terms
+
+
+def anova_matrix(design, intensities, slices):
+    """
+    Compute p-values of type I (sequential) anova for many dependent variables with common design matrix
+    It is the same procedure as in sm.stats.anova_lm, but for all columns of intensities at once
+    Columns with NA are processed in groups with the same pattern of missing observations
+    :param design: array - design matrix with intercept, observations X regressors
+    :param intensities: array - dependent variables, observations X peaks
+    :param slices: list - slices of design matrix columns corresponding to each tested term
+    :return: array - p-values with shape len(slices) X peaks
+    """
+    p_values = np.full((len(slices), intensities.shape[1]), np.nan)
+    missing = np.isnan(intensities)
+
+    # Complete peaks are computed together, others - by groups with equal NA positions in observations
+    if not missing.any():
+        p_values[:] = sequential_anova(design, intensities, slices)
+        return p_values
+
+    patterns, groups = np.unique(np.packbits(missing, axis=0), axis=1, return_inverse=True)
+    groups = groups.ravel()
+    for group in range(patterns.shape[1]):
+        columns = np.flatnonzero(groups == group)
+        present = ~missing[:, columns[0]]
+        p_values[:, columns] = sequential_anova(design[present], intensities[np.ix_(present, columns)], slices)
+    return p_values
+
+
+def sequential_anova(design, intensities, slices):
+    """
+    Conduct type I anova with F test for all columns of complete (without NA) intensities
+    Sums of squares of terms are taken from QR effects and residual sum of squares from least squares solution
+    :param design: array - design matrix with intercept, observations X regressors
+    :param intensities: array - dependent variables without NA, observations X peaks
+    :param slices: list - slices of design matrix columns corresponding to each tested term
+    :return: array - p-values with shape len(slices) X peaks
+    """
+    # Effects are projections of dependent variables onto orthogonalized regressors
+    q, _ = np.linalg.qr(design)
+    effects = q.T @ intensities
+
+    # Residual sum of squares and its degrees of freedom
+    coefficients, _, rank, _ = np.linalg.lstsq(design, intensities, rcond=None)
+    ssr = ((intensities - design @ coefficients) ** 2).sum(axis=0)
+    df_resid = design.shape[0] - rank
+
+    # Sequential sums of squares, F statistics and p-values of terms
+    sum_sq = np.vstack([(effects[s] ** 2).sum(axis=0) for s in slices])
+    dfs = np.array([s.stop - s.start for s in slices])[:, np.newaxis]
+    f = (sum_sq / dfs) / (ssr / df_resid)
+    return stats.f.sf(f, dfs, df_resid)
+
+
 def anova(df, feature, variables, interaction='double'):
     """
     Perform anova for 1 feature ~ variables and their interactions
@@ -0,0 +1,261 @@
+import os
+import hashlib
+from collections import namedtuple, OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+from scipy.cluster import hierarchy
+from sklearn.cluster import KMeans, MiniBatchKMeans
+import matplotlib.pyplot as plt
+from ..processing_dataset.lipid_matrix import LipidMatrix, sample_matrix, find_diff
+# fastcluster is optional, it gives the same linkages as scipy faster and vector methods without distance matrix
+try:
+    import fastcluster
+except ImportError:
+    fastcluster = None
+
+
+# Result of hierarchical clustering: linkage matrix in scipy format and names of clustered observations
+Clustering = namedtuple('Clustering', ['linkage', 'labels', 'method', 'metric'])
+
+# Linkages computed in this session by content of matrix and parameters, the least recently used are forgotten
+linkages = OrderedDict()
+max_linkages = 32
+
+# Methods which fastcluster computes from observations without distance matrix
+vector_methods = {'single', 'ward', 'centroid', 'median'}
+
+
+def observations(data, axis='samples'):
+    """
+    Take clustered observations from processed intensities
+    :param data: LipidMatrix, df or array - matrix, dataframe merged with metadata or intensities peaks X samples
+    :param axis: str - 'samples' to cluster samples by peaks or 'peaks' to cluster lipids by samples
+    :return: (array, index) - observations X features array and names of observations (positions for arrays)
+    """
+    if isinstance(data, np.ndarray):
+        matrix, samples, peaks = data.T, pd.RangeIndex(data.shape[1]), pd.RangeIndex(data.shape[0])
+    elif isinstance(data, LipidMatrix):
+        matrix, samples, peaks = sample_matrix(data), data.samples.index, data.peaks.index
+    else:
+        matrix, samples, peaks = sample_matrix(data), data.columns, data.index[:data.shape[0] - find_diff(data)]
+
+    if axis == 'samples':
+        return matrix, samples
+    elif axis == 'peaks':
+        return matrix.T, peaks
+    raise ValueError(f'Unknown axis of clustering: {axis}')
+
+
+def condensed_distances(matrix, metric='euclidean', block=1000, path=None, dtype='float64'):
+    """
+    Compute condensed distance matrix (upper triangle in scipy format) by blocks of observations
+    Only block X observations distances are kept in memory at once, the result could be written into memory-mapped
+    file for data whose distance matrix doesn't fit into memory
+    :param matrix: array - observations X features
+    :param metric: str - metric of scipy cdist, e.g. 'euclidean', 'correlation', 'cosine'
+    :param block: int - number of observations in block
+    :param path: str - path to .npy file for memory-mapped result, None to keep it in memory
+    :param dtype: str - type of distances
+    :return: array - distances with length n * (n - 1) / 2
+    """
+    n = matrix.shape[0]
+    size = n * (n - 1) // 2
+    if path is None:
+        distances = np.empty(size, dtype=dtype)
+    else:
+        distances = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(size,))
+
+    # Rows of block occupy contiguous part of condensed matrix, each row starts after the diagonal
+    offset = 0
+    for start in range(0, n, block):
+        part = cdist(matrix[start:start + block], matrix[start:], metric=metric)
+        for row, distance in enumerate(part):
+            distances[offset:offset + n - start - row - 1] = distance[row + 1:]
+            offset += n - start - row - 1
+
+    if path is not None:
+        distances.flush()
+    return distances
+
+
+def linkage_matrix(distances, method='average'):
+    """
+    Compute hierarchical clustering from condensed distances, with fastcluster if it is installed and with scipy
+    otherwise
+    :param distances: array - condensed distance matrix
+    :param method: str - linkage method, e.g. 'average', 'complete', 'single', 'ward'
+    :return: array - linkage matrix in scipy format
+    """
+    if fastcluster is not None:
+        return fastcluster.linkage(distances, method=method)
+    return hierarchy.linkage(distances, method=method)
+
+
+def hierarchical_clustering(data, axis='samples', method='average', metric='euclidean', block=1000, path=None,
+                            cache_dir=None):
+    """
+    Cluster samples or peaks hierarchically, linkage of the same data and parameters is computed only once
+    With fastcluster single, ward, centroid and median linkages by euclidean metric are computed without distance
+    matrix, otherwise (and for all linkages without fastcluster, which falls back to scipy) distances are computed by
+    blocks. Data should be without NA, e.g. after substitute_na
+    :param data: LipidMatrix, df or array - matrix, dataframe merged with metadata or intensities peaks X samples
+    :param axis: str - 'samples' or 'peaks'
+    :param method: str - linkage method, e.g. 'average', 'complete', 'single', 'ward'
+    :param metric: str - metric of scipy cdist, e.g. 'euclidean', 'correlation', 'cosine'
+    :param block: int - number of observations in block of distances
+    :param path: str - path to .npy file for memory-mapped distances
+    :param cache_dir: str - directory for linkages on disk, None to keep them only in memory
+    :return: Clustering - linkage matrix and names of observations
+    """
+    matrix, labels = observations(data, axis)
+    check_na(matrix)
+    key = linkage_key(matrix, method, metric)
+
+    # Look in memory and then on disk
+    if key in linkages:
+        linkages.move_to_end(key)
+        return Clustering(linkages[key], labels, method, metric)
+    cached = os.path.join(cache_dir, f'linkage_{key}.npy') if cache_dir is not None else None
+    if cached is not None and os.path.exists(cached):
+        linkage = np.load(cached)
+    else:
+        if fastcluster is not None and method in vector_methods and metric == 'euclidean':
+            linkage = fastcluster.linkage_vector(np.asarray(matrix, dtype='float64'), method=method)
+        else:
+            linkage = linkage_matrix(condensed_distances(matrix, metric, block, path), method)
+        if cached is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cached, linkage)
+
+    # Forget the least recently used linkage
+    linkages[key] = linkage
+    if len(linkages) > max_linkages:
+        linkages.popitem(last=False)
+    return Clustering(linkage, labels, method, metric)
+
+
+def check_na(matrix):
+    """
+    Check that clustered observations have no NA, distances with them are undefined
+    :param matrix: array - observations X features
+    :return:
+    """
+    if np.isnan(matrix).any():
+        raise ValueError('Intensities contain NA, substitute them with substitute_na before clustering')
+
+
+def linkage_key(matrix, method, metric):
+    """
+    Compute cache key of linkage
+    :param matrix: array - observations X features
+    :param method: str - linkage method
+    :param metric: str - metric of distances
+    :return: str - hex digest
+    """
+    matrix = np.ascontiguousarray(matrix)
+    digest = hashlib.sha1(repr((method, metric, matrix.shape, str(matrix.dtype))).encode())
+    digest.update(matrix.tobytes())
+    return digest.hexdigest()
+
+
+def cut_clusters(clustering, n_clusters):
+    """
+    Cut dendrogram into flat clusters
+    :param clustering: Clustering - result of hierarchical_clustering
+    :param n_clusters: int - maximal number of clusters
+    :return: series - cluster of each observation starting from 1
+    """
+    clusters = hierarchy.fcluster(clustering.linkage, n_clusters, criterion='maxclust')
+    return pd.Series(clusters, index=clustering.labels, name='cluster')
+
+
+def kmeans_clusters(data, n_clusters, axis='samples', mini_batch=None, batch_size=1024, seed=0):
+    """
+    Cluster samples or peaks with k-means, mini-batch k-means is used for large number of observations
+    :param data: LipidMatrix, df or array - matrix, dataframe merged with metadata or intensities peaks X samples
+    :param n_clusters: int - number of clusters
+    :param axis: str - 'samples' or 'peaks'
+    :param mini_batch: bool - whether to use mini-batch k-means, by default for more than 10000 observations
+    :param batch_size: int - number of observations in mini-batch
+    :param seed: int - seed of random generator
+    :return: (series, float) - cluster of each observation and inertia
+    """
+    matrix, labels = observations(data, axis)
+    check_na(matrix)
+    if mini_batch is None:
+        mini_batch = matrix.shape[0] > 10000
+    if mini_batch:
+        model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=seed, n_init=3)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=seed, n_init=10)
+    clusters = model.fit_predict(matrix)
+    return pd.Series(clusters, index=labels, name='cluster'), model.inertia_
+
+
+def kmeans_inertias(data, n_clusters=range(1, 9), axis='samples', mini_batch=None, seed=0):
+    """
+    Compute inertia of k-means for several numbers of clusters to choose it by elbow
+    :param data: LipidMatrix, df or array - matrix, dataframe merged with metadata or intensities peaks X samples
+    :param n_clusters: iterable - numbers of clusters
+    :param axis: str - 'samples' or 'peaks'
+    :param mini_batch: bool - whether to use mini-batch k-means, by default for more than 10000 observations
+    :param seed: int - seed of random generator
+    :return: series - inertia for each number of clusters
+    """
+    return pd.Series({k: kmeans_clusters(data, k, axis, mini_batch, seed=seed)[1] for k in n_clusters},
+                     name='inertia')
+
+
+def draw_clustermap(data, samples=None, peaks=None, name='clustermap', title='Clustering', cmap='viridis', fmt='svg',
+                    dpi=150, directory='img'):
+    """
+    Plot heatmap of intensities with dendrograms of samples and peaks, precomputed linkages are reused
+    :param data: LipidMatrix, df or array - matrix, dataframe merged with metadata or intensities peaks X samples
+    :param samples: Clustering - clustering of samples, computed (or taken from cache) by hierarchical_clustering if
+                                 not provided
+    :param peaks: Clustering - clustering of peaks, computed (or taken from cache) by hierarchical_clustering if not
+                               provided
+    :param name: str - name of saved figure
+    :param title: str - title of figure
+    :param cmap: str - colormap of heatmap
+    :param fmt: str - 'svg' with rasterized heatmap and vector dendrograms or 'png'
+    :param dpi: int - resolution of png or of rasterized heatmap in svg
+    :param directory: str - directory for figures
+    :return: str - name of saved figure
+    """
+    if samples is None:
+        samples = hierarchical_clustering(data, 'samples')
+    if peaks is None:
+        peaks = hierarchical_clustering(data, 'peaks')
+    matrix, _ = observations(data, 'samples')
+
+    # Dendrograms on the left (samples) and on the top (peaks), heatmap in the rest
+    fig = plt.figure(figsize=(12, 8))
+    left = fig.add_axes([0.05, 0.1, 0.15, 0.75])
+    top = fig.add_axes([0.22, 0.87, 0.65, 0.1])
+    heatmap = fig.add_axes([0.22, 0.1, 0.65, 0.75])
+    bar = fig.add_axes([0.97, 0.1, 0.02, 0.75])
+    sample_order = hierarchy.dendrogram(samples.linkage, orientation='left', no_labels=True, ax=left,
+                                        color_threshold=0)['leaves']
+    peak_order = hierarchy.dendrogram(peaks.linkage, no_labels=True, ax=top, color_threshold=0)['leaves']
+    for ax in (left, top):
+        ax.set_axis_off()
+
+    # Leaves of left dendrogram go from bottom to top, so rows are drawn in the same order
+    image = heatmap.imshow(matrix[np.ix_(sample_order, peak_order)], aspect='auto', origin='lower', cmap=cmap,
+                           interpolation='nearest', rasterized=True)
+    heatmap.set_yticks(np.arange(len(sample_order)))
+    heatmap.set_yticklabels(samples.labels[sample_order], fontsize=6)
+    heatmap.yaxis.tick_right()
+    heatmap.set_xticks([])
+    heatmap.set_xlabel('peaks')
+    fig.colorbar(image, cax=bar)
+    top.set_title(title)
+
+    # Create dir for images and save image, figure is closed to free memory in long runs
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f'{name}.{fmt}')
+    fig.savefig(filename, format=fmt, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return filename
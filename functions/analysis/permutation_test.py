@@ -1,38 +1,233 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from .anova import *
+from ..processing_dataset.storage import describe_table, load_peak_table, DESCRIPTION, INTENSITIES
 
 
-def anova_permutations(df, variables, permutated, n=1000, interaction='double'):
+# Intensities and labels which are shared by all permutations in a process, filled by init_permutations
+shared = {}
+
+
+def anova_permutations(df, variables, permutated, n=1000, interaction='double', n_jobs=1, seed=0, batch=None,
+                       report=100, intensities=None, monitor=None, summary=False):
     """
     Perform permutation test with anova tests
+    Permutations are spread over process pool, each permutation has its own random stream derived from seed, thus
+    results don't depend on the number of workers. df itself is never modified
     :param df: df - dataframe with samples - rows and peaks and features - columns (normal form)
     :param variables: list - list with column names which will be used in anova
     :param permutated: list - features from variables in which labels should be mixed
     :param n: int - number of permutations
     :param interaction: str - type of interaction in anova, one of 'no', 'double' and 'multiple'
-    :return: df - dataframe with size n X len(variables) + their interactions filled with significant peaks and their
-    significance for each category after each permutation
-    """
-    # Perform anova 1 time to obtain right column structure for df with permutations results
-    trial = anova_for_all_peaks_vs_some_variables(df, variables, interaction)
-    # Create result df
-    results_permutation = pd.DataFrame(columns=trial.index)
-
-    # By number of permutations:
-    # shuffle specified labels
-    # conduct anova n times
-    # compute BH corrected p-values
-    # store significant peaks in result dataframe
-    for i in range(n):
-        # Shuffle specified labels
+    :param n_jobs: int - number of worker processes, 1 to compute everything in current process
+    :param seed: int - seed of random generator
+    :param batch: int - number of permutations which are sent to worker at once, stored intensities are read into
+                        memory of worker once for each batch. By default up to 25, but small enough to give each worker
+                        several batches and to pass every reporting point, since progress is updated by whole batches
+    :param report: int - print progress after every report permutations, 0 or None to keep silent
+    :param intensities: str - directory with table stored by save_peak_table or path to .npy with intensities
+                              peaks X samples, which will be memory-mapped by every process instead of taking them
+                              from df. Peaks and samples of stored table are checked against df and samples of df are
+                              selected from it, plain .npy should have exactly peaks and samples of df in their order
+    :param monitor: Monitor - instrumentation which gets progress of permutations as events
+    :param summary: bool - whether to return only numbers of significant peaks and their frequencies instead of
+                           significant peaks themselves, which takes much less memory for large n
+    :return: df or (df, df) - dataframe with size n X len(variables) + their interactions filled with significant peaks
+    and their significance (adjusted p-values) for each category after each permutation. If summary is True dataframe
+    n X len(variables) + their interactions with number of significant peaks for each category after each permutation
+    and dataframe len(variables) + their interactions X peaks with portion of permutations in which peak was significant
+    """
+    peaks = df.columns[:-2]
+    # Labels are kept by position, intensities are shared as one read-only float matrix
+    labels = df[list(variables)].reset_index(drop=True)
+    if intensities is None:
+        intensities = df[peaks].to_numpy(dtype='float')
+        intensities.flags.writeable = False
+    else:
+        intensities = stored_intensities(intensities, df.index, peaks)
+
+    # Independent random stream for each permutation
+    if batch is None:
+        batch = max(1, min(25, n // (4 * n_jobs), report or 25))
+    seeds = np.random.SeedSequence(seed).spawn(n)
+    batches = [(i, seeds[i:i + batch]) for i in range(0, n, batch)]
+
+    # Perform anova 1 time to obtain names of categories
+    _, terms = design_matrix(labels, variables, interaction)
+    counts = np.zeros((n, len(terms)), dtype='int')
+    frequencies = np.zeros((len(terms), len(peaks)))
+    significant = np.empty((n, len(terms)), dtype='object')
+
+    # Collect results of batches in order of their completion
+    progress = Progress(n, report, monitor)
+    for start, (batch_counts, batch_frequencies, batch_significant) in run_batches(batches, intensities, labels,
+                                                                                   variables, permutated, interaction,
+                                                                                   n_jobs, not summary):
+        counts[start:start + len(batch_counts)] = batch_counts
+        frequencies += batch_frequencies
+        # Significant peaks of each category are series of their adjusted p-values
+        for i, permutation in enumerate(batch_significant or []):
+            for j, (term, (positions, p_values)) in enumerate(zip(terms, permutation)):
+                significant[start + i, j] = pd.Series(p_values, index=peaks[positions], name=term)
+        progress.update(len(batch_counts))
+
+    if not summary:
+        return pd.DataFrame(significant, columns=list(terms))
+    counts = pd.DataFrame(counts, columns=list(terms))
+    frequencies = pd.DataFrame(frequencies / n, index=list(terms), columns=peaks)
+    return counts, frequencies
+
+
+def run_batches(batches, intensities, labels, variables, permutated, interaction, n_jobs, details=False):
+    """
+    Generate results of permutation batches either in current process or in process pool
+    :param batches: list - tuples with number of first permutation in batch and seeds of batch permutations
+    :param intensities: array or tuple - read-only matrix samples X peaks or path to .npy with matrix peaks X samples
+                                         and columns of samples in it
+    :param labels: df - dataframe with variables columns indexed by position
+    :param variables: list - list with column names which will be used in anova
+    :param permutated: list - features from variables in which labels should be mixed
+    :param interaction: str - type of interaction in anova, one of 'no', 'double' and 'multiple'
+    :param n_jobs: int - number of worker processes
+    :param details: bool - whether to return adjusted p-values of significant peaks too
+    :return: generator - tuples with number of first permutation in batch and result of permutation_batch
+    """
+    # Shared data of current process is forgotten after the last batch
+    if n_jobs == 1:
+        init_permutations(intensities, labels)
+        try:
+            for start, seeds in batches:
+                yield start, permutation_batch(seeds, variables, permutated, interaction, details)
+        finally:
+            shared.clear()
+        return
+
+    # Matrix is passed to every worker only once by initializer or memory-mapped there
+    with ProcessPoolExecutor(n_jobs, initializer=init_permutations, initargs=(intensities, labels)) as pool:
+        futures = {pool.submit(permutation_batch, seeds, variables, permutated, interaction, details): start
+                   for start, seeds in batches}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def stored_intensities(path, samples, peaks):
+    """
+    Check that stored intensities correspond to df and find columns of df samples in stored matrix
+    :param path: str - directory with table stored by save_peak_table or path to .npy with matrix peaks X samples
+    :param samples: index - names of samples in order of df rows
+    :param peaks: index - names of peaks in order of df columns
+    :return: (str, slice or array) - path to .npy and columns of samples in it
+    """
+    directory, name = (path, INTENSITIES) if os.path.isdir(path) else os.path.split(path)
+    matrix = np.load(os.path.join(directory, name), mmap_mode='r')
+
+    # Without description matrix can be checked only by its shape
+    if not os.path.exists(os.path.join(directory, DESCRIPTION)):
+        if matrix.shape != (len(peaks), len(samples)):
+            raise ValueError(f'Stored intensities with shape {matrix.shape} do not correspond to {len(peaks)} peaks '
+                             f'and {len(samples)} samples of df')
+        return os.path.join(directory, name), slice(None)
+
+    # Stored table keeps all columns (blanks, qc etc.) in storage order, so samples of df are selected by names
+    stored_peaks = load_peak_table(directory, columns=[]).index
+    if not stored_peaks.astype(str).equals(pd.Index(peaks).astype(str)):
+        raise ValueError('Peaks of stored table differ from peaks of df')
+    positions = pd.Index(describe_table(directory)['samples']).get_indexer(pd.Index(samples).astype(str))
+    if (positions < 0).any():
+        raise ValueError(f'Samples are absent in stored table: {list(pd.Index(samples)[positions < 0])}')
+
+    # Consecutive columns are taken by slice, so matrix isn't copied in workers
+    if positions.size and (np.diff(positions) == 1).all():
+        positions = slice(positions[0], positions[-1] + 1)
+    return os.path.join(directory, name), positions
+
+
+def init_permutations(intensities, labels):
+    """
+    Store intensities and labels in process for subsequent permutations
+    :param intensities: array or tuple - read-only matrix samples X peaks or path to .npy with matrix peaks X samples
+                                         and columns of samples in it (from stored_intensities)
+    :param labels: df - dataframe with variables columns indexed by position
+    :return:
+    """
+    # Stored matrix is mapped into memory of process and transposed to samples X peaks, samples which are not
+    # consecutive in it are copied
+    if isinstance(intensities, tuple):
+        path, positions = intensities
+        intensities = np.load(path, mmap_mode='r').T[positions]
+    shared['intensities'] = intensities
+    shared['labels'] = labels
+
+
+def permutation_batch(seeds, variables, permutated, interaction, details=False):
+    """
+    Conduct anova for several permutations of labels
+    :param seeds: list - seed sequences, one for each permutation
+    :param variables: list - list with column names which will be used in anova
+    :param permutated: list - features from variables in which labels should be mixed
+    :param interaction: str - type of interaction in anova, one of 'no', 'double' and 'multiple'
+    :param details: bool - whether to return adjusted p-values of significant peaks too
+    :return: (array, array, list) - number of significant peaks for each category in each permutation, number of
+    permutations in which each peak was significant for each category and if details is True for each permutation
+    positions and adjusted p-values of significant peaks of each category (None otherwise)
+    """
+    intensities, labels = shared['intensities'], shared['labels']
+    # Memory-mapped matrix is read from disk once for the whole batch instead of once for each permutation
+    if isinstance(intensities, np.memmap):
+        intensities = np.array(intensities)
+    counts = []
+    frequencies = 0
+    significant_values = [] if details else None
+
+    for seed in seeds:
+        # Shuffle specified labels by permutation of positions, every feature separately
+        rng = np.random.default_rng(seed)
+        permuted = labels.copy()
         for feature in permutated:
-            np.random.shuffle(df[feature].values)
+            permuted[feature] = labels[feature].values[rng.permutation(len(labels))]
+
+        # Conduct anova and find significant peaks
+        design, terms = design_matrix(permuted, variables, interaction)
+        p_values = anova_matrix(design.values, intensities[design.index.values], list(terms.values()))
+        significant, corrected = adjust_p_values(p_values)
 
-        # Conduct anova and write significant peaks to df
-        p_vals = anova_for_all_peaks_with_adjustment(df, variables, interaction='double')
-        results_permutation.loc[i] = tuple(p_vals.loc[c].dropna() for c in p_vals.index)
+        counts.append(significant.sum(axis=1))
+        frequencies = frequencies + significant
+        if details:
+            significant_values.append([(np.flatnonzero(row), values[row])
+                                       for row, values in zip(significant, corrected)])
+    return np.array(counts), frequencies, significant_values
+
+
+class Progress:
+    """
+    Print number of done permutations and their throughput
+    """
+    def __init__(self, total, report, monitor=None):
+        """
+        :param total: int - total number of permutations
+        :param report: int - print message after every report permutations, 0 or None to keep silent
+        :param monitor: Monitor - instrumentation which gets the same messages as events instead of printing
+        """
+        self.total = total
+        self.report = report
+        self.monitor = monitor
+        self.done = 0
+        self.start = time.perf_counter()
 
-        # Display 100th rounds to give user information about process
-        if i % 100 == 0:
-            print(f'{i}th launch is done')
+    def update(self, done):
+        """
+        Account done permutations and print message if next reporting point was passed
+        :param done: int - number of just done permutations
+        :return:
+        """
+        previous, self.done = self.done, self.done + done
+        if not self.report or (previous // self.report == self.done // self.report and self.done != self.total):
+            return
 
-    return results_permutation
+        elapsed = time.perf_counter() - self.start
+        if self.monitor is not None:
+            self.monitor.event('permutations', done=self.done, total=self.total, rate=self.done / elapsed)
+        else:
+            print(f'{self.done}/{self.total} permutations are done, {self.done / elapsed:.1f} per second')
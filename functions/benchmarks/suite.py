@@ -0,0 +1,217 @@
+import os
+import io
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import contextlib
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from .synthetic import synthetic_peak_table, synthetic_metadata, merged_frame, anova_frame
+from ..processing_dataset.column_division import sample_layout, cast_intensities
+from ..processing_dataset.purge_contamination import purge_contaminants
+from ..processing_dataset.purge_isotopes import purge_isotopes
+from ..processing_dataset.purge_adducts import purge_adducts
+from ..processing_dataset.merge_features import merge_features
+from ..processing_dataset.purge_control import purge_control
+from ..processing_dataset.substitute_na import remove_na_peaks, substitute_na
+from ..processing_dataset.scaling import log_transform, z_scale
+from ..processing_dataset.normalization import percentille_normalization, normalize_by_mass
+from ..visualizing.pca import pca_transform, mds_transform
+from ..analysis.anova import anova_for_all_peaks_vs_some_variables
+from ..analysis.permutation_test import anova_permutations
+
+
+# Measured function: name, function which takes prepared data and returns arguments, measured function
+Benchmark = namedtuple('Benchmark', ['name', 'arguments', 'function'])
+
+# Stages of processing and analysis in order of notebooks, each one takes output of previous stages from data
+benchmarks = [Benchmark('purge_contaminants', lambda data: (data['raw'],), purge_contaminants),
+              Benchmark('purge_isotopes', lambda data: (data['raw'],), purge_isotopes),
+              Benchmark('purge_adducts', lambda data: (data['raw'],), purge_adducts),
+              Benchmark('merge_features', lambda data: (data['raw'],), merge_features),
+              Benchmark('purge_control', lambda data: (data['raw'],), purge_control),
+              Benchmark('remove_na_peaks', lambda data: (data['controlled'],), remove_na_peaks),
+              Benchmark('substitute_na', lambda data: (data['controlled'],), substitute_na),
+              Benchmark('substitute_na_knn', lambda data: (data['controlled'], 'knn'), substitute_na),
+              Benchmark('log_transform', lambda data: (data['imputed'],), log_transform),
+              Benchmark('z_scale', lambda data: (data['logged'],), z_scale),
+              Benchmark('percentile_normalization', lambda data: (data['logged'],), percentille_normalization),
+              Benchmark('mass_normalization', lambda data: (data['merged'],), normalize_by_mass),
+              Benchmark('pca_transform', lambda data: (data['merged'], data['dtype']),
+                        lambda df, dtype: pca_transform(df, dtype=dtype)),
+              Benchmark('mds_transform', lambda data: (data['merged'], data['dtype']),
+                        lambda df, dtype: mds_transform(df, dtype=dtype)),
+              Benchmark('anova', lambda data: (data['anova'], ['tissue', 'age']), anova_for_all_peaks_vs_some_variables),
+              Benchmark('anova_permutations', lambda data: (data['anova'], ['tissue', 'age'], ['age'], 20),
+                        lambda df, variables, permutated, n: anova_permutations(df, variables, permutated, n,
+                                                                                report=0, summary=True))]
+
+# Baseline results stored in repository
+baseline_path = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def prepare_data(n_peaks, n_samples, dtype='float64', seed=0):
+    """
+    Generate synthetic peak table and inputs of all stages by running processing once
+    :param n_peaks: int - number of peaks
+    :param n_samples: int - number of samples without controls
+    :param dtype: str - type of intensities, 'float64' or 'float32'
+    :param seed: int - seed of random generator
+    :return: dict - name of processing step: its output and type of intensities
+    """
+    raw = synthetic_peak_table(n_peaks, n_samples, dtype=dtype, seed=seed)
+    metadata = synthetic_metadata(n_samples, seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        controlled = remove_na_peaks(purge_control(raw), 0.5)
+    imputed = substitute_na(controlled)
+    # Peaks without values in samples are left after imputation, they are dropped for analysis
+    imputed = imputed.dropna(subset=list(metadata.index))
+    logged = log_transform(imputed)
+    return {'dtype': dtype,
+            'raw': raw,
+            'controlled': controlled,
+            'imputed': imputed,
+            'logged': logged,
+            'merged': merged_frame(logged, metadata),
+            'anova': anova_frame(logged, metadata)}
+
+
+def measure(function, arguments, repeat=3):
+    """
+    Measure time and memory of function call
+    Time is the best of repeat calls, memory is peak of python allocations (tracemalloc) in separate call
+    :param function: function - measured function
+    :param arguments: tuple - positional arguments of function
+    :param repeat: int - number of timed calls
+    :return: (float, float) - seconds and peak memory in MiB
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(*arguments)
+            times.append(time.perf_counter() - start)
+
+        # Tracing slows down function, so memory is measured separately
+        tracemalloc.start()
+        try:
+            function(*arguments)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def run_benchmarks(scales=((2000, 40), (20000, 80)), names=None, repeat=3, dtype='float64', seed=0):
+    """
+    Measure all stages at several scales of synthetic data
+    :param scales: iterable - pairs of numbers of peaks and samples
+    :param names: iterable - names of benchmarks to run, all by default
+    :param repeat: int - number of timed calls of each function
+    :param dtype: str - type of intensities, 'float64' or 'float32'
+    :param seed: int - seed of random generator
+    :return: df - dataframe with benchmark, peaks, samples, dtype, seconds and memory (MiB) columns
+    """
+    selected = [b for b in benchmarks if names is None or b.name in names]
+    results = []
+    for n_peaks, n_samples in scales:
+        data = prepare_data(n_peaks, n_samples, dtype, seed)
+        for benchmark in selected:
+            seconds, memory = measure(benchmark.function, benchmark.arguments(data), repeat)
+            results.append({'benchmark': benchmark.name, 'peaks': n_peaks, 'samples': n_samples, 'dtype': dtype,
+                            'seconds': seconds, 'memory': memory})
+    return pd.DataFrame(results)
+
+
+def precision_agreement(n_peaks=2000, n_samples=40, seed=0):
+    """
+    Compare results of processing in single and double precision
+    :param n_peaks: int - number of peaks
+    :param n_samples: int - number of samples without controls
+    :param seed: int - seed of random generator
+    :return: series - maximal relative deviation of float32 results from float64 ones for each stage
+    """
+    single, double = prepare_data(n_peaks, n_samples, 'float32', seed), prepare_data(n_peaks, n_samples, 'float64',
+                                                                                      seed)
+    samples = sample_layout(double['logged']).samples
+    deviations = {}
+    for stage in ['imputed', 'logged']:
+        expected = double[stage][samples].to_numpy()
+        observed = cast_intensities(single[stage], 'float64')[samples].to_numpy()
+        deviations[stage] = np.nanmax(np.abs(observed - expected) / np.abs(expected))
+
+    # Components are compared up to sign
+    expected, observed = pca_transform(double['merged'])[0], pca_transform(single['merged'], dtype='float32')[0]
+    deviations['pca_transform'] = np.max(np.abs(np.abs(observed) - np.abs(expected))) / np.abs(expected).max()
+    return pd.Series(deviations, name='deviation')
+
+
+def save_baseline(results, path=baseline_path):
+    """
+    Save benchmark results as baseline
+    :param results: df - results of run_benchmarks
+    :param path: str - path to json file
+    :return:
+    """
+    with open(path, 'w') as f:
+        json.dump({'machine': platform.platform(), 'results': results.to_dict(orient='records')}, f, indent=1)
+        f.write('\n')
+
+
+def load_baseline(path=baseline_path):
+    """
+    Load baseline results
+    :param path: str - path to json file
+    :return: df - results in the form of run_benchmarks
+    """
+    with open(path) as f:
+        return pd.DataFrame(json.load(f)['results'])
+
+
+def compare_with_baseline(results, baseline, slowdown=1.5):
+    """
+    Compare benchmark results with baseline and mark regressions
+    :param results: df - results of run_benchmarks
+    :param baseline: df - baseline results
+    :param slowdown: float - ratio of time or memory to baseline which is considered as regression
+    :return: df - results with time and memory ratios to baseline and regression column
+    """
+    keys = ['benchmark', 'peaks', 'samples', 'dtype']
+    compared = results.merge(baseline[keys + ['seconds', 'memory']], on=keys, how='left', suffixes=('', '_baseline'))
+    compared['time_ratio'] = compared['seconds'] / compared['seconds_baseline']
+    compared['memory_ratio'] = compared['memory'] / compared['memory_baseline']
+    compared['regression'] = (compared['time_ratio'] > slowdown) | (compared['memory_ratio'] > slowdown)
+    return compared
+
+
+def main():
+    """
+    Run benchmarks from command line, e.g. python -m functions.benchmarks.suite --scales 2000x40 20000x80 --compare
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks of lipidomic processing on synthetic data')
+    parser.add_argument('--scales', nargs='+', default=['2000x40', '20000x80'], help='scales as PEAKSxSAMPLES')
+    parser.add_argument('--names', nargs='+', help='names of benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed calls')
+    parser.add_argument('--dtype', default='float64', help='type of intensities')
+    parser.add_argument('--save', action='store_true', help='save results as baseline')
+    parser.add_argument('--compare', action='store_true', help='compare results with baseline')
+    parser.add_argument('--precision', action='store_true', help='check agreement of float32 and float64 results')
+    args = parser.parse_args()
+
+    scales = [tuple(map(int, scale.split('x'))) for scale in args.scales]
+    results = run_benchmarks(scales, args.names, args.repeat, args.dtype)
+    if args.compare and os.path.exists(baseline_path):
+        results = compare_with_baseline(results, load_baseline())
+    print(results.to_string(index=False))
+    if args.save:
+        save_baseline(results[['benchmark', 'peaks', 'samples', 'dtype', 'seconds', 'memory']])
+    if args.precision:
+        print(precision_agreement().to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+from ..processing_dataset.purge_contamination import conts_neg
+
+
+# Negative mode adducts of CAMERA: name and shift of ion mz from neutral mass, the first one is the main ion
+adducts = {'[M-H]-': -1.007276,
+           '[M+Cl]-': 34.969402,
+           '[M+HCOO]-': 44.998201,
+           '[M-H2O-H]-': -19.017841}
+# Mass difference between isotopes (13C - 12C)
+isotope_shift = 1.003355
+tissues = ['brain', 'liver', 'muscle', 'plasma']
+ages = ['young', 'old']
+
+
+def synthetic_peak_table(n_peaks=5000, n_samples=60, n_blanks=3, n_qc=5, n_washes=2, na_rate=0.2, isotope_rate=0.3,
+                         adduct_rate=0.3, contaminant_rate=0.01, dtype='float64', seed=0):
+    """
+    Generate deterministic peak table in the form of XCMS/CAMERA output (negative mode): mz, mzmin, mzmax, rt, rtmin,
+    rtmax, npeaks, isotopes, adduct, pcgroup and intensities of blanks, qc, washes and samples
+    Peaks are ions of compounds: [M-H]- ion, optionally its isotopes and other adducts in the same pcgroup. Intensities
+    of samples depend on tissue and age of animal (see synthetic_metadata), NA are produced both below detection
+    limit and at random
+    :param n_peaks: int - number of peaks
+    :param n_samples: int - number of samples without controls
+    :param n_blanks: int - number of blank controls
+    :param n_qc: int - number of quality controls
+    :param n_washes: int - number of washes
+    :param na_rate: float - portion of NA in intensities of samples
+    :param isotope_rate: float - portion of compounds with isotopic peaks
+    :param adduct_rate: float - portion of compounds with additional adducts
+    :param contaminant_rate: float - portion of peaks with mz of known contaminants
+    :param dtype: str - type of intensities, 'float64' or 'float32'
+    :param seed: int - seed of random generator
+    :return: df - peak table with peaks as rows
+    """
+    rng = np.random.default_rng(seed)
+    peaks = synthetic_peaks(n_peaks, isotope_rate, adduct_rate, contaminant_rate, rng)
+    metadata = synthetic_metadata(n_samples, seed)
+
+    # Abundance of compound and its effects in tissues and ages, ions of compound share them
+    compounds = peaks['compound'].to_numpy()
+    n_compounds = compounds.max() + 1
+    abundance = rng.normal(12, 2, n_compounds)
+    tissue_effects = rng.normal(0, 1, (n_compounds, len(tissues))) * (rng.random((n_compounds, 1)) < 0.3)
+    age_effects = rng.normal(0, 0.7, (n_compounds, len(ages))) * (rng.random((n_compounds, 1)) < 0.2)
+
+    # Log intensities of samples
+    tissue_codes = pd.Index(tissues).get_indexer(metadata['tissue'])
+    age_codes = pd.Index(ages).get_indexer(metadata['age'])
+    logs = (abundance[compounds, np.newaxis] + peaks['shift'].to_numpy()[:, np.newaxis]
+            + tissue_effects[compounds][:, tissue_codes] + age_effects[compounds][:, age_codes]
+            + np.log(metadata['mass'].fillna(1).to_numpy()) + rng.normal(0, 0.3, (n_peaks, n_samples)))
+    intensities = np.exp(logs)
+
+    # Values below detection limit and random ones become NA
+    censored = logs < np.quantile(logs, na_rate / 2)
+    intensities[censored | (rng.random(logs.shape) < na_rate / (2 - na_rate))] = np.nan
+
+    # Controls: pooled qc, blanks with background of contaminants and some peaks, mostly empty washes
+    qc = np.exp(np.log(np.nanmean(intensities, axis=1, keepdims=True)) + rng.normal(0, 0.1, (n_peaks, n_qc)))
+    background = (rng.random(n_peaks) < 0.1) | peaks['contaminant'].to_numpy()
+    blanks = np.where(background[:, np.newaxis], np.exp(rng.normal(11, 1, (n_peaks, n_blanks))), np.nan)
+    washes = np.where(rng.random((n_peaks, n_washes)) < 0.05, np.exp(rng.normal(9, 1, (n_peaks, n_washes))), np.nan)
+
+    columns = {**{f'Blank_{i + 1}': blanks[:, i] for i in range(n_blanks)},
+               **{f'QC_{i + 1:02d}': qc[:, i] for i in range(n_qc)},
+               **{f'Wash_{i + 1}': washes[:, i] for i in range(n_washes)},
+               **dict(zip(metadata.index, intensities.T))}
+    table = pd.concat([peaks.drop(columns=['compound', 'shift', 'contaminant']),
+                       pd.DataFrame(columns, index=peaks.index, dtype=dtype)], axis=1)
+    return table
+
+
+def synthetic_peaks(n_peaks, isotope_rate=0.3, adduct_rate=0.3, contaminant_rate=0.01, rng=None):
+    """
+    Generate annotation of peaks as CAMERA does
+    :param n_peaks: int - number of peaks
+    :param isotope_rate: float - portion of compounds with isotopic peaks
+    :param adduct_rate: float - portion of compounds with additional adducts
+    :param contaminant_rate: float - portion of peaks with mz of known contaminants
+    :param rng: Generator - random generator
+    :return: df - annotation of peaks with XCMS names and columns compound, shift (of log intensity from compound
+    abundance) and contaminant
+    """
+    rng = rng or np.random.default_rng(0)
+    ions = []
+    compound, isotope_group = 0, 0
+    # Compounds are generated until all peaks are filled, each ion is (compound, neutral mass, rt, adduct, isotope)
+    while len(ions) < n_peaks:
+        mass, rt = rng.uniform(400, 1000), rng.uniform(30, 1200)
+        names = ['[M-H]-'] + (list(rng.choice(list(adducts)[1:], rng.integers(1, 3), replace=False))
+                              if rng.random() < adduct_rate else [])
+        for name in names:
+            # Main ion of compound could have isotopes
+            if name == '[M-H]-' and rng.random() < isotope_rate:
+                for k in range(rng.integers(2, 4)):
+                    ions.append((compound, mass, rt, name, isotope_group, k))
+                isotope_group += 1
+            else:
+                ions.append((compound, mass, rt, name, -1, 0))
+        compound += 1
+    ions = pd.DataFrame(ions[:n_peaks], columns=['compound', 'mass', 'rt', 'adduct', 'isotope_group', 'isotope'])
+
+    # Ion mz and intensity shift: adducts are weaker, isotopes decay
+    ions['mz'] = ions['mass'] + ions['adduct'].map(adducts) + ions['isotope'] * isotope_shift
+    ions['shift'] = np.where(ions['adduct'] == '[M-H]-', 0, -1.5) + ions['isotope'] * np.log(0.35)
+    compound_rt = ions['rt'].to_numpy()
+    ions['rt'] += rng.normal(0, 0.5, n_peaks)
+
+    # Some peaks are contaminants
+    contaminant = rng.random(n_peaks) < contaminant_rate
+    ions.loc[contaminant, 'mz'] = rng.choice(conts_neg, contaminant.sum()) * (1 + rng.normal(0, 1e-6,
+                                                                                             contaminant.sum()))
+
+    # Annotation columns of XCMS
+    peaks = pd.DataFrame({'mz': ions['mz'],
+                          'mzmin': ions['mz'] * (1 - 3e-6),
+                          'mzmax': ions['mz'] * (1 + 3e-6),
+                          'rt': ions['rt'],
+                          'rtmin': ions['rt'] - 3,
+                          'rtmax': ions['rt'] + 3,
+                          'npeaks': rng.integers(1, 80, n_peaks)})
+
+    # Annotation columns of CAMERA - isotope strings, adducts with neutral mass and pseudo-compound groups by rt
+    grouped = ions['isotope_group'] >= 0
+    peaks['isotopes'] = ''
+    peaks.loc[grouped, 'isotopes'] = ('[' + (ions.loc[grouped, 'isotope_group'] + 1).astype(str) + ']['
+                                      + np.where(ions.loc[grouped, 'isotope'] == 0, 'M',
+                                                 'M+' + ions.loc[grouped, 'isotope'].astype(str)) + ']')
+    annotated = (ions['isotope'] == 0) & (ions.groupby('compound')['adduct'].transform('nunique') > 1)
+    peaks['adduct'] = ''
+    peaks.loc[annotated, 'adduct'] = (ions.loc[annotated, 'adduct'] + ' '
+                                      + ions.loc[annotated, 'mass'].round(4).astype(str))
+    peaks['pcgroup'] = pd.factorize((compound_rt // 2).astype(int), sort=True)[0] + 1
+
+    # XCMS names of peaks, repeated ones get suffix
+    names = 'M' + peaks['mz'].round().astype(int).astype(str) + 'T' + peaks['rt'].round().astype(int).astype(str)
+    repeats = names.groupby(names).cumcount()
+    peaks.index = names.where(repeats == 0, names + '_' + repeats.astype(str))
+    peaks['compound'] = ions['compound'].to_numpy()
+    peaks['shift'] = ions['shift'].to_numpy()
+    peaks['contaminant'] = contaminant
+    return peaks
+
+
+def synthetic_metadata(n_samples=60, seed=0):
+    """
+    Generate metadata of samples: tissue and age are balanced, mass is unknown for some animals
+    Names of samples contain tissue and id of animal, e.g. brain_ms12
+    :param n_samples: int - number of samples
+    :param seed: int - seed of random generator
+    :return: df - metadata indexed by names of samples with columns tissue, age, mass and id
+    """
+    rng = np.random.default_rng(seed + 1)
+    positions = np.arange(n_samples)
+    tissue = np.array(tissues)[positions % len(tissues)]
+    # Each animal gives all tissues
+    animal = positions // len(tissues) + 1
+    age = np.array(ages)[animal % len(ages)]
+    mass = pd.Series(rng.uniform(0.5, 2, animal.max() + 1)[animal]).where(rng.random(n_samples) > 0.1)
+
+    names = [f'{t}_ms{a}' for t, a in zip(tissue, animal)]
+    return pd.DataFrame({'tissue': tissue, 'age': age, 'mass': mass.to_numpy(), 'id': [f'ms{a}' for a in animal]},
+                        index=pd.Index(names))
+
+
+def merged_frame(table, metadata):
+    """
+    Create dataframe merged with metadata as in notebooks: intensities of samples with metadata rows at the bottom
+    :param table: df - peak table from synthetic_peak_table
+    :param metadata: df - metadata from synthetic_metadata
+    :return: df - samples columns with peaks rows and tissue, age, mass rows
+    """
+    return pd.concat([table[metadata.index], metadata[['tissue', 'age', 'mass']].T])
+
+
+def anova_frame(table, metadata, variables=('tissue', 'age')):
+    """
+    Create dataframe in normal form for anova: samples are rows, peaks and variables are columns
+    :param table: df - peak table from synthetic_peak_table without NA in samples
+    :param metadata: df - metadata from synthetic_metadata
+    :param variables: tuple - 2 columns of metadata which become the last columns
+    :return: df - samples X (peaks + variables)
+    """
+    return pd.concat([table[metadata.index].T, metadata[list(variables)]], axis=1)
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import functools
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Monitor:
+    """
+    Instrumentation of processing and analysis functions
+    Each call of wrapped function produces record with wall and CPU time, change of resident memory, peak of resident
+    memory during the call above its level at the start, shapes of input and output (thus peaks dropped by purges)
+    which is passed to all hooks. Processing functions are wrapped by Pipeline, analysis and visualization ones by
+    wrap_functions(analysis_functions())
+    """
+    def __init__(self, hooks=()):
+        """
+        :param hooks: iterable - functions which take record (dict), e.g. JsonLines or list.append
+        """
+        self.hooks = list(hooks)
+        self.depth = 0
+        # Whether peak was reset and peak of memory of each running call, inner calls reset the peak of process, so
+        # outer ones get peaks observed before and inside them
+        self.peaks = []
+
+    def add_hook(self, hook):
+        """
+        Add function which is called with each record
+        :param hook: function - function which takes record (dict)
+        :return: Monitor - the monitor itself to chain additions
+        """
+        self.hooks.append(hook)
+        return self
+
+    def wrap(self, function, name=None):
+        """
+        Wrap function to record its calls
+        :param function: function - function whose first argument is df, matrix or array
+        :param name: str - name of stage in records, name of function by default
+        :return: function - wrapped function with the same signature
+        """
+        name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            record = {'stage': name, 'depth': self.depth, 'start': time.time()}
+            record['rows_in'], record['columns_in'] = shape(args[0] if args else None)
+            rss = resident_memory()
+            if self.peaks and self.peaks[-1][0]:
+                self.peaks[-1][1] = maximum(self.peaks[-1][1], peak_memory())
+            reset = reset_peak_memory()
+            self.peaks.append([reset, None if reset else peak_memory()])
+            wall, cpu = time.perf_counter(), time.process_time()
+
+            # Calls inside wrapped function get greater depth
+            self.depth += 1
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                record['error'] = repr(error)
+                raise
+            else:
+                record['rows_out'], record['columns_out'] = shape(result)
+                if record['rows_in'] is not None and record['rows_out'] is not None:
+                    record['dropped'] = record['rows_in'] - record['rows_out']
+                return result
+            finally:
+                self.depth -= 1
+                record['wall'] = time.perf_counter() - wall
+                record['cpu'] = time.process_time() - cpu
+                record['rss_delta'] = difference(resident_memory(), rss)
+                record['peak_rss_delta'] = self.peak_delta(rss)
+                self.emit(record)
+        return wrapper
+
+    def peak_delta(self, rss):
+        """
+        Finish measurement of memory peak of call and pass it to outer call
+        Without resetting of peak (not Linux) only the lifetime peak of process is known, so the delta is positive
+        only for calls which raise the peak of process and shows how much they raised it
+        :param rss: int - resident memory at the start of call
+        :return: int - peak of resident memory above rss (or above previous peak) in bytes, None if it is unknown
+        """
+        reset, peak = self.peaks.pop()
+        if not reset:
+            return difference(peak_memory(), peak)
+        peak = maximum(peak_memory(), peak)
+        if self.peaks:
+            self.peaks[-1][1] = maximum(self.peaks[-1][1], peak)
+        return difference(peak, rss)
+
+    def wrap_functions(self, functions):
+        """
+        Wrap all functions of dictionary, e.g. processing_functions of pipeline
+        :param functions: dict - name: function
+        :return: dict - name: wrapped function
+        """
+        return {name: self.wrap(function, name) for name, function in functions.items()}
+
+    def event(self, name, **values):
+        """
+        Pass custom record to hooks, e.g. progress of long computation
+        :param name: str - name of event
+        :param values: dict - values of record
+        :return:
+        """
+        self.emit({'stage': name, 'depth': self.depth, 'start': time.time(), **values})
+
+    def emit(self, record):
+        """
+        Pass record to all hooks
+        :param record: dict - record of call or event
+        :return:
+        """
+        for hook in self.hooks:
+            hook(record)
+
+
+class JsonLines:
+    """
+    Hook which appends records to file in JSON lines format
+    """
+    def __init__(self, path):
+        """
+        :param path: str - path to file, records are appended to existing one
+        """
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+def read_records(path):
+    """
+    Read records written by JsonLines
+    :param path: str - path to file
+    :return: list - list with records (dicts)
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def shape(value):
+    """
+    Find number of rows and columns of argument or result of function
+    :param value: df, LipidMatrix, array or tuple - for tuples (e.g. results with report) the first element is taken
+    :return: (int, int) - number of rows and columns, None for values without shape
+    """
+    if isinstance(value, tuple) and value:
+        return shape(value[0])
+    dimensions = getattr(value, 'shape', None)
+    if dimensions is None:
+        return None, None
+    dimensions = tuple(dimensions) + (None, None)
+    return dimensions[0], dimensions[1]
+
+
+def resident_memory():
+    """
+    Get current resident memory of process
+    :return: int - bytes, None if it is unknown on this platform
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_peak_memory():
+    """
+    Reset peak resident memory of process to the current one, it is supported by Linux only
+    :return: bool - whether peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory():
+    """
+    Get peak resident memory of process since start or since the last reset_peak_memory
+    :return: int - bytes, None if it is unknown on this platform
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    # Linux reports kilobytes and macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def difference(after, before):
+    """
+    Compute difference of measurements which could be unknown
+    :param after: int - measurement after call
+    :param before: int - measurement before call
+    :return: int - difference, None if some measurement is unknown
+    """
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+def maximum(first, second):
+    """
+    Compute maximum of measurements which could be unknown
+    :param first: int - measurement
+    :param second: int - measurement
+    :return: int - maximum of known measurements, None if both are unknown
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return max(first, second)
+
+
+def analysis_functions():
+    """
+    Get analysis and visualization functions to instrument them with Monitor.wrap_functions
+    Modules are imported here to keep monitoring of processing free of their dependencies
+    :return: dict - name: function
+    """
+    from .analysis.anova import anova_for_all_peaks_with_adjustment, anova_for_all_peaks_vs_some_variables
+    from .analysis.permutation_test import anova_permutations
+    from .analysis.clustering import hierarchical_clustering, kmeans_clusters, draw_clustermap
+    from .visualizing.pca import pca_transform, incremental_pca, mds_transform, render_jobs
+    return {'anova': anova_for_all_peaks_with_adjustment,
+            'anova_p_values': anova_for_all_peaks_vs_some_variables,
+            'anova_permutations': anova_permutations,
+            'hierarchical_clustering': hierarchical_clustering,
+            'kmeans': kmeans_clusters,
+            'clustermap': draw_clustermap,
+            'pca': pca_transform,
+            'incremental_pca': incremental_pca,
+            'mds': mds_transform,
+            'render': render_jobs}
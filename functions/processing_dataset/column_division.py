@@ -1,32 +1,68 @@
-import numpy as np
-import pandas as pd
 import re
+from collections import namedtuple
+from functools import lru_cache
+import pandas as pd
 
 
-# MANUAL
-# Divide columns into groups
-# Load data
-name = '../../vitaminD/cleaned_contaminants_xs_annotated_rats_neg.csv'
-df = pd.read_csv(name, index_col=0)
+# Diverse columns without concentration
+other_columns = {'mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks',
+                 'samples', 'isotopes', 'adduct', 'pcgroup'}
 
-# Blank controls
-pat = re.compile(r'blank', re.I)
-blanks = df.filter(regex=pat).columns
+# Groups of columns in peak table:
+# blanks - blank controls, qc_controls - quality controls, washes - washes,
+# samples - all samples including controls, samples_wo_controls_qc - samples without all controls except qc
+SampleLayout = namedtuple('SampleLayout', ['blanks', 'qc_controls', 'washes', 'samples', 'samples_wo_controls_qc'])
 
-# Quality controls
-pat = re.compile(r'qc', re.I)
-qc_controls = df.filter(regex=pat).columns
 
-# Washes
-pat = re.compile(r'wash', re.I)
-washes = df.filter(regex=pat).columns
+def sample_layout(df):
+    """
+    Divide columns of df into groups. Layout is computed once for each set of columns
+    :param df: df - peak table with peaks as rows and mz, rt, samples as columns
+    :return: SampleLayout - named tuple with indices of column groups
+    """
+    return columns_layout(tuple(df.columns))
 
-# Diverse columns without concentration
-other_columns = {'mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks',
-                 'samples', 'isotopes', 'adduct', 'pcgroup'}
 
-# All samples including controls and without all of them except qc
-samples = list(set(df.columns).difference(other_columns))
+@lru_cache(maxsize=128)
+def columns_layout(columns):
+    """
+    Divide columns into groups by their names, order of columns is preserved
+    :param columns: tuple - column names of peak table
+    :return: SampleLayout - named tuple with indices of column groups
+    """
+    # All samples including controls
+    samples = pd.Index([c for c in columns if c not in other_columns])
+
+    # Blank controls, quality controls and washes
+    names = samples.astype(str)
+    blanks = samples[names.str.contains(r'blank', flags=re.I)]
+    qc_controls = samples[names.str.contains(r'qc', flags=re.I)]
+    washes = samples[names.str.contains(r'wash', flags=re.I)]
+
+    # Samples without all controls except qc
+    samples_wo_controls_qc = samples[~samples.isin(blanks) & ~samples.isin(washes)]
+    return SampleLayout(blanks, qc_controls, washes, samples, samples_wo_controls_qc)
+
+
+def intensity_values(df, copy=False):
+    """
+    Take intensities from columns of df as float array
+    Single precision is kept if all columns are float32, otherwise values are converted to float64
+    :param df: df - dataframe with intensity columns only
+    :param copy: bool - whether to always return new writable array
+    :return: array - float32 or float64 array with values of df
+    """
+    dtype = 'float32' if len(df.columns) and (df.dtypes == 'float32').all() else 'float64'
+    return df.to_numpy(dtype=dtype, copy=copy)
+
 
-samples_wo_controls_qc = list(set(samples).difference(blanks)
-                                          .difference(washes))
\ No newline at end of file
+def cast_intensities(df, dtype='float32', layout=None):
+    """
+    Convert intensity columns of peak table to given float type, e.g. after reading csv
+    :param df: df - peak table with peaks as rows and mz, rt, samples as columns
+    :param dtype: str - float type, 'float32' for single precision mode
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df - peak table with converted intensities
+    """
+    samples = (layout or sample_layout(df)).samples
+    return df.astype({sample: dtype for sample in samples})
@@ -1,44 +1,83 @@
-import numpy as np
+import re
+import hashlib
+from functools import lru_cache
 import pandas as pd
-from .column_division import *
+from .column_division import sample_layout
+from .lipid_matrix import LipidMatrix
 
 
-def compose_metadata(df, metadata):
+def compose_metadata(df, metadata, layout=None):
     """
     Alternative to add_metadata, shouldn't be used
     Prepare metadata to main df compatible structure (aligned by sample names)
     :param df: df - original dataframe
-    :param metadata: df - support dataframe with metadata
-    :return: df - original df with several added rows from metadata
+    :param metadata: df or str - support dataframe with metadata or path to csv with it
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df - rows with id and metadata aligned with columns of df
     """
-    # Extract metadata
-    meta = extract_meta(metadata)
-    # Add id to dataframe and transpose it for merging
-    df = add_id(df).T
-
-    # Merge transposed df with meta on new id column and index of meta
-    # Transpose df back to arrange it in original manner
-    df = df.merge(meta, left_on='id', right_index=True, how='left').T
-    meta = df.iloc[-(meta.shape[1] + 1):, :]
-    return meta
+    # Only metadata rows are transposed, intensities are not touched
+    meta = sample_metadata((layout or sample_layout(df)).samples, metadata)
+    return meta.T.reindex(columns=df.columns)
 
 
-def add_metadata(df, metadata):
+def add_metadata(df, metadata, layout=None):
     """
     Add some rows from metadata to df
-    :param df: df - original dataframe
-    :param metadata: df - support dataframe with metadata
-    :return: df - original df with several added rows from metadata
+    :param df: df or LipidMatrix - original dataframe or matrix
+    :param metadata: df or str - support dataframe with metadata or path to csv with it
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df or LipidMatrix - original df with several added rows from metadata or matrix with joined metadata of
+    samples
+    """
+    # Metadata of matrix is joined by names of samples without copying intensities
+    if isinstance(df, LipidMatrix):
+        meta = sample_metadata(df.samples.index, metadata)
+        return df.with_metadata(df.samples.join(meta.drop(columns=df.samples.columns, errors='ignore')))
+
+    # Rows of metadata are added to the bottom of df
+    return pd.concat([df, compose_metadata(df, metadata, layout)])
+
+
+def sample_metadata(samples, metadata):
+    """
+    Join metadata to samples by id extracted from their names
+    :param samples: index - names of samples
+    :param metadata: df or str - support dataframe with metadata or path to csv with it
+    :return: df - dataframe indexed by samples with id and metadata columns, NA for samples without metadata
     """
     # Extract metadata
-    meta = extract_meta(metadata)
-    # Add id to dataframe and transpose it for merging
-    df = add_id(df).T
+    meta = read_metadata(metadata) if isinstance(metadata, str) else extract_meta(metadata)
+    # The first row is taken for ids repeated in metadata
+    meta = meta[~meta.index.duplicated()]
 
-    # Merge transposed df with meta on new id column and index of meta
-    # Transpose df back to arrange it in original manner
-    df = df.merge(meta, left_on='id', right_index=True, how='left').T
-    return df
+    # Take metadata of each sample by its id
+    ids = extract_id(samples).reindex(samples)
+    meta = meta.reindex(ids.values)
+    meta.index = samples
+    return pd.concat([ids, meta], axis=1)
+
+
+def read_metadata(path):
+    """
+    Read csv with metadata and extract age, mass and id columns from it
+    Parsed metadata is cached by content of file, so it is read again only after changes
+    :param path: str - path to csv with metadata
+    :return: df - subset from metadata with some meta columns
+    """
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return parse_metadata(path, digest).copy()
+
+
+@lru_cache(16)
+def parse_metadata(path, digest):
+    """
+    Read csv with metadata and extract its columns, cached by path and hash of file
+    :param path: str - path to csv with metadata
+    :param digest: str - hash of file content, key of cache
+    :return: df - subset from metadata with some meta columns
+    """
+    return extract_meta(pd.read_csv(path))
 
 
 def extract_meta(metadata):
@@ -72,15 +111,16 @@ def extract_column(df, pat):
     return df.filter(regex=pat).iloc[:, 0]
 
 
-def add_id(df):
+def add_id(df, layout=None):
     """
     Add row with id to df
     :param df: df - original df
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :return: df - df with row 'id'
     """
     # Add identifiers
-    ids = extract_id(samples)
-    df = df.append(ids)
+    ids = extract_id((layout or sample_layout(df)).samples)
+    df = pd.concat([df, ids.to_frame().T.reindex(columns=df.columns)])
     return df
 
 
@@ -90,18 +130,11 @@ def extract_id(samples):
     :param samples: iterable - collection with names of samples
     :return: series - series with id of each sample which had it in a form specified by pattern
     """
-    # Extract identifier of each mouse
-    pat = re.compile(r'ms\d+', re.I)
-    res = {}
+    # Extract identifier of each mouse, the first one in name
+    samples = pd.Index(samples).astype(str)
+    res = pd.Series(samples, index=samples).str.extract(r'(ms\d+)', flags=re.I, expand=False)
 
-    # Add identifier in dict if it was found
-    for s in samples:
-        for i in re.finditer(pat, s):
-            res[s] = i.group()
-            break
-
-    # Create series and name it
-    res = pd.Series(res)
+    # Keep only samples which had identifier and name series
+    res = res.dropna()
     res.name = 'id'
     return res
-
@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 from itertools import product
+from functools import lru_cache
+from collections import deque
 import string
 
 
@@ -45,31 +47,93 @@ def create_labels_tissue(samples, labs=tissues, name='tissue', punct=string.punc
 def create_labels(samples, labs, punct=string.punctuation):
     """
     Create series with new names of samples
+    Each sample gets the first label from labs which is contained in its name. All labels are searched in one pass
+    over name by automaton, which is built once for each vocabulary
     :param samples: iterable - collection of samples names in original dataframe
     :param labs: iterable - collection of new appropriate names of samples which express some category, e.g. tissue
     :param punct: iterable - collection of possible separators in original names
-    :return: series - series with new names of samples
+    :return: series - categorical series with new names of samples, categories are in order of labs
     """
-    # Create list to store labels
-    res = []
+    samples = list(samples)
+    matcher = label_matcher(tuple(labs), tuple(punct))
 
-    # Find appropriate name of type for sample
-    # Make it '_' separated and add it to list with labels
+    # Find appropriate name of type for sample, it is already '_' separated
     # Add NA if no matches with labs were found
-    for sample in samples:
-        for lab in labs:
-            if lab in sample.lower():
-                lab = punct_check(lab, punct)
-                res.append(lab)
-                break
-        else:
-            res.append(np.nan)
-
-    # Create a series
-    res = pd.Series({c: v for c, v in zip(samples, res)})
+    positions = [matcher.first(sample.lower()) for sample in samples]
+    res = [matcher.labels[i] if i >= 0 else np.nan for i in positions]
+
+    # Create a series, categories are only found labels
+    found = sorted(set(positions) - {-1})
+    categories = pd.unique(pd.Series([matcher.labels[i] for i in found], dtype='object'))
+    res = pd.Series(pd.Categorical(res, categories=categories), index=samples)
     return res
 
 
+@lru_cache(16)
+def label_matcher(labs, punct=tuple(string.punctuation)):
+    """
+    Build automaton for vocabulary of labels, it is cached for repeated calls of create_labels
+    :param labs: tuple - labels in order of priority
+    :param punct: tuple - collection of possible separators in labels
+    :return: LabelMatcher - automaton for labs
+    """
+    return LabelMatcher(labs, punct)
+
+
+class LabelMatcher:
+    """
+    Aho-Corasick automaton which finds label with the smallest position in vocabulary among all labels contained in
+    text. Failure links are resolved in advance, so each character of text is one dictionary lookup. Each state keeps
+    the best label among those which end in it
+    """
+    def __init__(self, labs, punct=string.punctuation):
+        """
+        :param labs: iterable - labels in order of priority
+        :param punct: iterable - collection of possible separators, they are replaced by '_' in found labels
+        """
+        self.labels = [punct_check(lab, punct) for lab in labs]
+        # Position of label in vocabulary, len(labels) means no label
+        missing = len(self.labels)
+        goto = [{}]
+        self.best = [missing]
+
+        # Trie of labels, each state remembers the first label which ends in it
+        for i, lab in enumerate(labs):
+            state = 0
+            for char in lab:
+                if char not in goto[state]:
+                    goto.append({})
+                    self.best.append(missing)
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            self.best[state] = min(self.best[state], i)
+
+        # Transitions of automaton in breadth first order: transitions of failure state completed by trie ones,
+        # labels which are suffixes of state are inherited from failure state
+        self.transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque((child, 0) for child in goto[0].values())
+        while queue:
+            state, fail = queue.popleft()
+            self.best[state] = min(self.best[state], self.best[fail])
+            self.transitions[state] = {**self.transitions[fail], **goto[state]}
+            for char, child in goto[state].items():
+                queue.append((child, self.transitions[fail].get(char, 0)))
+
+    def first(self, text):
+        """
+        Find position of the first label in vocabulary which is contained in text
+        :param text: str - text to search in
+        :return: int - position of label, -1 if text contains no labels
+        """
+        transitions, best = self.transitions, self.best
+        state, found = 0, best[0]
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if best[state] < found:
+                found = best[state]
+        return -1 if found == len(self.labels) else found
+
+
 def punct_check(label, punct):
     """
     Replace arbitrary separator by '_' in label name
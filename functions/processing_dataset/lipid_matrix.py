@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from .column_division import sample_layout, intensity_values
+
+
+class LipidMatrix:
+    """
+    Peak table divided into 3 aligned parts:
+    intensities - contiguous float array peaks X samples,
+    peaks - dataframe with annotation of peaks (mz, rt, isotopes etc.) indexed by peak names,
+    samples - dataframe with metadata of samples (id, age, mass etc.) indexed by sample names
+    Metadata is never mixed with intensities, so they don't have to be converted from object dtype
+    """
+    def __init__(self, intensities, peaks, samples):
+        """
+        :param intensities: array - intensities with shape len(peaks) X len(samples), float32 ones stay single
+                                    precision, others are converted to float64
+        :param peaks: df - annotation of peaks
+        :param samples: df - metadata of samples
+        """
+        intensities = np.asarray(intensities)
+        dtype = intensities.dtype if intensities.dtype in (np.float32, np.float64) else np.float64
+        self.intensities = np.ascontiguousarray(intensities, dtype=dtype)
+        self.peaks = peaks
+        self.samples = samples
+        if self.intensities.shape != (len(peaks), len(samples)):
+            raise ValueError('Intensities are not aligned with peaks, samples')
+
+    @classmethod
+    def from_peak_table(cls, df, dtype=None, layout=None):
+        """
+        Create matrix from XCMS/CAMERA peak table
+        :param df: df - peak table with peaks as rows and mz, rt, samples as columns
+        :param dtype: str - type of intensities, e.g. 'float32', type of df columns by default
+        :param layout: SampleLayout - groups of df columns, computed from df if not provided
+        :return: LipidMatrix - matrix with all samples including controls and without sample metadata
+        """
+        samples = (layout or sample_layout(df)).samples
+        intensities = intensity_values(df[samples])
+        return cls(intensities.astype(dtype or intensities.dtype, copy=False), df.drop(columns=samples),
+                   pd.DataFrame(index=samples))
+
+    @classmethod
+    def from_merged(cls, df, dtype='float64', layout=None):
+        """
+        Create matrix from dataframe merged with metadata, where metadata rows are at the bottom of df
+        :param df: df - dataframe merged with metadata
+        :param dtype: str - type of intensities, 'float64' or 'float32'
+        :param layout: SampleLayout - groups of df columns, computed from df if not provided
+        :return: LipidMatrix - matrix with metadata of samples taken from metadata rows
+        """
+        samples = (layout or sample_layout(df)).samples
+        n_peaks = df.shape[0] - find_diff(df)
+        data, meta = df.iloc[:n_peaks], df.iloc[n_peaks:]
+
+        # Metadata rows become columns of samples frame, numeric ones are converted to numbers
+        metadata = meta[samples].T.apply(convert_numeric)
+        metadata.columns.name = None
+        peaks = data.drop(columns=samples).infer_objects()
+        return cls(data[samples].to_numpy(dtype=dtype), peaks, metadata)
+
+    @property
+    def shape(self):
+        """
+        :return: tuple - number of peaks and samples
+        """
+        return self.intensities.shape
+
+    def frame(self):
+        """
+        Get intensities as dataframe peaks X samples without copying them
+        :return: df - intensities with peaks names as index and samples names as columns
+        """
+        return pd.DataFrame(self.intensities, index=self.peaks.index, columns=self.samples.index, copy=False)
+
+    def with_intensities(self, intensities):
+        """
+        Create matrix with the same annotation and metadata but another intensities
+        :param intensities: array - intensities with the same shape
+        :return: LipidMatrix - new matrix
+        """
+        return LipidMatrix(intensities, self.peaks, self.samples)
+
+    def with_metadata(self, metadata):
+        """
+        Create matrix with the same intensities and annotation but another metadata of samples
+        :param metadata: df - metadata indexed by samples names in the same order
+        :return: LipidMatrix - new matrix
+        """
+        return LipidMatrix(self.intensities, self.peaks, metadata)
+
+    def select_peaks(self, selection):
+        """
+        Take subset of peaks
+        :param selection: array-like - boolean mask or positions of peaks
+        :return: LipidMatrix - matrix with selected peaks
+        """
+        selection = np.asarray(selection)
+        return LipidMatrix(self.intensities[selection], self.peaks.iloc[selection], self.samples)
+
+    def select_samples(self, selection):
+        """
+        Take subset of samples
+        :param selection: array-like - boolean mask, positions or names of samples
+        :return: LipidMatrix - matrix with selected samples
+        """
+        selection = np.asarray(selection)
+        if selection.dtype.kind not in 'bi':
+            selection = self.samples.index.get_indexer(selection)
+        return LipidMatrix(self.intensities[:, selection], self.peaks, self.samples.iloc[selection])
+
+    def to_peak_table(self):
+        """
+        Unite annotation and intensities into peak table
+        :return: df - peak table with peaks as rows and mz, rt, samples as columns
+        """
+        return pd.concat([self.peaks, self.frame()], axis=1)
+
+    def to_merged(self):
+        """
+        Create dataframe merged with metadata in the old manner - metadata rows are at the bottom of df
+        :return: df - dataframe merged with metadata
+        """
+        return pd.concat([self.to_peak_table(), self.samples.T])
+
+
+def sample_matrix(data, dtype=None):
+    """
+    Get intensities in normal form - samples are rows and peaks are columns
+    :param data: LipidMatrix or df - matrix or dataframe with intensities of samples and possibly metadata rows at
+                 the bottom (only columns of samples)
+    :param dtype: str - type of result, e.g. 'float32', by default float32 intensities stay single precision and others
+                        are float64. Columns of dataframe merged with metadata are of object type, so single precision
+                        of such dataframe should be requested explicitly
+    :return: array - float array samples X peaks
+    """
+    if isinstance(data, LipidMatrix):
+        return data.intensities.T if dtype is None else data.intensities.T.astype(dtype, copy=False)
+    n_peaks = data.shape[0] - find_diff(data)
+    if dtype is None:
+        return intensity_values(data.iloc[:n_peaks]).T
+    return data.iloc[:n_peaks].to_numpy(dtype=dtype).T
+
+
+def find_diff(df):
+    """
+    Find number of rows for metainformation in df. This rows should located at the bottom of df
+    Assumes that only peak names contains numbers
+    Used for finding constant meta
+    :param df: df - dataframe with metadata
+    :return: int - number of rows which are taken by metadata
+    """
+    meta = df.shape[0] - df.filter(regex=r'\d+', axis=0).index.shape[0]
+    return meta
+
+
+def convert_numeric(column):
+    """
+    Convert column to numbers if all its values are numeric
+    :param column: series - column of metadata
+    :return: series - numeric or original column
+    """
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return column.infer_objects()
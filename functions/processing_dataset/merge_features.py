@@ -0,0 +1,134 @@
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from .column_division import sample_layout, intensity_values
+
+
+def merge_features(df, rule='max', mz_tolerance=0, rt_tolerance=0, report=False, layout=None):
+    """
+    Merge features split by XCMS into several ones - peaks are rows and mz, mzmin, mzmax, rt, rtmin, rtmax, samples are
+    columns. Features whose mz and rt windows overlap are duplicates, chains of overlapping features form one group
+    Merged feature takes annotation of the most complete feature of group and windows covering the whole group
+    :param df: df - dataframe to clean
+    :param rule: str - intensities of merged feature, 'max' - maximal intensity of group in each sample, 'sum' - sum of
+                       intensities of group in each sample, 'complete' - intensities of the most complete feature
+    :param mz_tolerance: float - widening of mz windows on both sides in ppm
+    :param rt_tolerance: float - widening of rt windows on both sides in seconds
+    :param report: bool - whether to return group of each original feature too
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df or (df, series) - dataframe with merged features in order of their first appearance and if report is
+    True series with name of merged feature for each original one
+    """
+    if rule not in ('max', 'sum', 'complete'):
+        raise ValueError(f'Unknown rule of merging: {rule}')
+    layout = layout or sample_layout(df)
+
+    # Windows of features, widened by tolerances
+    mzmin = df['mzmin'].to_numpy(dtype='float') * (1 - mz_tolerance * 1e-6)
+    mzmax = df['mzmax'].to_numpy(dtype='float') * (1 + mz_tolerance * 1e-6)
+    rtmin = df['rtmin'].to_numpy(dtype='float') - rt_tolerance
+    rtmax = df['rtmax'].to_numpy(dtype='float') + rt_tolerance
+
+    # Find groups of overlapping features
+    first, second = overlapping_windows(mzmin, mzmax, rtmin, rtmax)
+    n_groups, groups = connected_components(coo_matrix((np.ones(len(first), dtype='bool'), (first, second)),
+                                                       shape=(len(df), len(df))), directed=False)
+    if n_groups == len(df):
+        return (df.copy(), pd.Series(df.index, index=df.index, name='feature')) if report else df.copy()
+
+    # Groups are numbered in order of their first features
+    _, firsts, groups = np.unique(groups, return_index=True, return_inverse=True)
+    groups = np.argsort(np.argsort(firsts))[groups]
+
+    # Representative of group is its most complete feature, ties are resolved by median intensity
+    intensities = intensity_values(df[layout.samples])
+    representatives = representative_features(groups, intensities)
+    merged = df.iloc[representatives].copy()
+
+    # Windows of merged features cover windows of all features in group
+    order, starts = group_boundaries(groups)
+    for column, reduce in [('mzmin', np.minimum), ('mzmax', np.maximum), ('rtmin', np.minimum),
+                           ('rtmax', np.maximum)]:
+        merged[column] = reduce.reduceat(df[column].to_numpy()[order], starts)
+
+    # Intensities of merged features
+    if rule in ('max', 'sum'):
+        merged[layout.samples] = reduce_intensities(intensities[order], starts, rule)
+
+    if report:
+        return merged, pd.Series(merged.index[groups], index=df.index, name='feature')
+    return merged
+
+
+def overlapping_windows(mzmin, mzmax, rtmin, rtmax):
+    """
+    Find all pairs of features whose mz and rt windows overlap
+    Features are swept in order of mzmin: mz window of feature overlaps windows of following features until their mzmin
+    exceeds its mzmax, so candidates are found with binary search and only they are checked for rt overlap
+    :param mzmin: array - lower bounds of mz windows
+    :param mzmax: array - upper bounds of mz windows
+    :param rtmin: array - lower bounds of rt windows
+    :param rtmax: array - upper bounds of rt windows
+    :return: (array, array) - positions of the first and the second feature of each pair
+    """
+    # Range of candidates for each feature in sorted order
+    order = np.argsort(mzmin, kind='stable')
+    starts = np.arange(1, len(order) + 1)
+    ends = np.maximum(np.searchsorted(mzmin[order], mzmax[order], side='right'), starts)
+
+    # Expand ranges into pairs of positions in sorted order
+    counts = ends - starts
+    first = np.repeat(np.arange(len(order)), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    first, second = order[first], order[second]
+
+    # Keep pairs which overlap in rt too
+    overlap = np.maximum(rtmin[first], rtmin[second]) <= np.minimum(rtmax[first], rtmax[second])
+    return first[overlap], second[overlap]
+
+
+def group_boundaries(groups):
+    """
+    Sort features by groups for reduction of groups
+    :param groups: array - group of each feature
+    :return: (array, array) - order of features sorted by group and start of each group in sorted order
+    """
+    order = np.argsort(groups, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+    return order, starts
+
+
+def representative_features(groups, intensities):
+    """
+    Choose the most complete feature of each group, ties are resolved by higher median intensity and then by position
+    :param groups: array - group of each feature
+    :param intensities: array - intensities of features X samples
+    :return: array - positions of representatives in order of groups
+    """
+    completeness = (~np.isnan(intensities)).sum(axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        medians = np.nan_to_num(np.nanmedian(intensities, axis=1), nan=-np.inf)
+
+    # The first feature of each group after sorting is its representative
+    order = np.lexsort((np.arange(len(groups)), -medians, -completeness, groups))
+    firsts = np.r_[True, groups[order][1:] != groups[order][:-1]]
+    return order[firsts]
+
+
+def reduce_intensities(intensities, starts, rule='max'):
+    """
+    Reduce intensities of sorted groups of features into intensities of groups
+    :param intensities: array - intensities of features X samples sorted by group
+    :param starts: array - start of each group in sorted order
+    :param rule: str - 'max' or 'sum', NA are ignored and group without values in sample gets NA
+    :return: array - intensities of groups X samples
+    """
+    present = np.add.reduceat(~np.isnan(intensities), starts, axis=0) > 0
+    if rule == 'max':
+        reduced = np.fmax.reduceat(intensities, starts, axis=0)
+    else:
+        reduced = np.add.reduceat(np.nan_to_num(intensities), starts, axis=0)
+    return np.where(present, reduced, np.nan).astype(intensities.dtype)
@@ -1,114 +1,147 @@
 import numpy as np
 import pandas as pd
-from .column_division import *
+from .column_division import sample_layout, intensity_values
+from .lipid_matrix import LipidMatrix, find_diff
+from .purge_contamination import mz_index, match_mz
 
 
 # Really many functions in 1 file, probably should be divided by normalization type or refactored with more general
 # functions
-def percentille_normalization(df, q=0.75):
+def percentille_normalization(df, q=0.75, layout=None):
     """
     Normalize intensities in dataframe by some of their order statistic, 75 by default
     Data is assumed to be log-transformed
-    samples and meta constants should be predefined
-    :param df: df - dataframe with all data
+    :param df: LipidMatrix or df - matrix or dataframe with all data
     :param q: float - percentile which will be denominator
-    :return: df - normalized by percentile df
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: LipidMatrix or df - normalized by percentile data of the same type
     """
+    # Normalize intensities of matrix by selected percentile
+    if isinstance(df, LipidMatrix):
+        return df.with_intensities(df.intensities - np.nanquantile(df.intensities, q, axis=1, keepdims=True))
+
+    samples = (layout or sample_layout(df)).samples
+    peaks = df.index[:df.shape[0] - find_diff(df)]
     df = df.copy()
 
     # Because of addition of metadata to rows there is a problem - data in column is heterogeneous (intensities and categories)
-    # Thus we have to convert it to float before operations
-    numeric_part = df.loc[df.index[:-meta], samples].apply(lambda x: pd.to_numeric(x, errors='ignore'))
+    # Thus we have to convert it to float before operations, float32 intensities stay single precision
+    numeric_part = intensity_values(df.loc[peaks, samples])
 
     # Normalize by selected percentile
-    numeric_part = numeric_part.subtract(numeric_part.quantile(q, axis=1), axis=0)
-    df.loc[df.index[:-meta], samples] = numeric_part
+    df.loc[peaks, samples] = numeric_part - np.nanquantile(numeric_part, q, axis=1, keepdims=True)
     return df
 
 
 def normalize_with_access_to_all_cols(df, function, *args, **kwargs):
     """
-    Apply normalization function to subset of df, which is determined by samples and meta constants which should be
-    defined earlier
+    Apply normalization function to all rows of df except metadata ones
     :param df: df - dataframe with all data
     :param function: function - function which takes df and return df
     :param args: sequence - list, tuple, set or str with parameters in the right order to function
     :param kwargs: dict - dict with name: value of parameters to function
     :return:
     """
+    n_peaks = df.shape[0] - find_diff(df)
     df = df.copy()
 
     # Convert data to float and perform operation
-    df.iloc[:-meta] = function(df.iloc[:-meta].astype(dtype='float', errors='ignore'), *args, **kwargs)
+    df.iloc[:n_peaks] = function(df.iloc[:n_peaks].astype(dtype='float', errors='ignore'), *args, **kwargs)
     return df
 
 
-def normalize(df, function, *args, **kwargs):
+def normalize(df, function, *args, layout=None, **kwargs):
     """
-    Apply normalization function to subset of df, which is determined by samples and meta constants which should be
-    defined earlier
-    :param df: df - dataframe with all data
+    Apply normalization function to intensities of samples
+    :param df: LipidMatrix or df - matrix or dataframe with all data
     :param function: function - function which takes df and return df
     :param args: sequence - list, tuple, set or str with parameters in the right order to function
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :param kwargs: dict - dict with name: value of parameters to function
-    :return:
+    :return: LipidMatrix or df - normalized data of the same type
     """
+    # Matrix intensities are passed to function as float df without copying
+    if isinstance(df, LipidMatrix):
+        return df.with_intensities(function(df.frame(), *args, **kwargs).to_numpy(dtype=df.intensities.dtype))
+
+    samples = (layout or sample_layout(df)).samples
+    peaks = df.index[:df.shape[0] - find_diff(df)]
     df = df.copy()
 
-    # Convert data to float and perform operation
-    df.loc[df.index[:-meta], samples] = function(df.loc[df.index[:-meta], samples].astype(dtype='float'), *args,
-                                                 **kwargs)
+    # Convert data to float and perform operation, float32 intensities stay single precision
+    numeric_part = intensity_values(df.loc[peaks, samples])
+    normalized = function(pd.DataFrame(numeric_part, index=peaks, columns=samples), *args, **kwargs)
+    df.loc[peaks, samples] = np.asarray(normalized, dtype=numeric_part.dtype)
     return df
 
 
-def find_diff(df):
-    """
-    Find number of rows for metainformation in df. This rows should located at the bottom of df
-    Assumes that only peak names contains numbers
-    Used for finding constant meta
-    :param df: df - dataframe with metadata
-    :return: int - number of rows which are taken by metadata
-    """
-    meta = df.shape[0] - df.filter(regex=r'\d+', axis=0).index.shape[0]
-    return meta
-
 # mz of diverse standard adducts - H and Ac-H
 standard_mzs = {'pg': [709.55189, 769.57302],
                 'pe': [740.54648, 800.56761],
                 'ceramide': [529.53310, 589.55423]}
 
 
-def standard_normalization(df, standard_mzs, precision=5):
+def standard_normalization(df, standard_mzs, precision=5, classes=None, standard_rts=None, rt_tolerance=0.5,
+                           layout=None):
     """
     Normalize df by standard intensities. Throw an error if no standards were found. It should be refined I think.
     Make loop with try block to reduce precision up to some value, after this perhaps we should return original df.
-    :param df: df - dataframe with all data, with no nonnumericals in columns with intensities
+    :param df: LipidMatrix or df - matrix or dataframe with all data, with no nonnumericals in columns with intensities
     :param standard_mzs: dict - standard names and lists of their mzs
-    :param precision: int - number of digits to round mzs before comparison
-    :return: df - df with normalized intensities by standard intensities
+    :param precision: float - ppm - deviation of standard mz
+    :param classes: series or str - lipid class of each peak (names of standards, e.g. pg, pe, ceramide) or name of
+                                    column with them. Each class is normalized by its own standard, peaks of other
+                                    classes or classes without found standard (or without its values in all
+                                    samples) are normalized by maximal one.
+                                    All peaks are normalized by maximal standard if not provided
+    :param standard_rts: dict - standard names and their retention times, mzs only are compared if not provided
+    :param rt_tolerance: float - maximal deviation of standard retention time
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: LipidMatrix or df - df with normalized intensities by standard intensities
     """
     # Find standards
-    standards = find_standards(df, standard_mzs, precision)
+    standards = find_standards(df, standard_mzs, precision, standard_rts, rt_tolerance, layout)
     # Select suitable standard
     standard = select_standard(standards)
-    # Normalize by standard itensities
-    df = std_normalization(df, standard)
-    return df
+    if classes is None:
+        # Normalize by standard itensities
+        return std_normalization(df, standard, layout)
+
+    # Each peak gets intensities of standard of its class
+    peaks = df.peaks if isinstance(df, LipidMatrix) else df
+    classes = peaks[classes] if isinstance(classes, str) else classes.reindex(peaks.index)
+    levels = class_standards(standards).reindex(classes.to_numpy())
 
+    # Class keeps its standard in all samples to stay on one scale, only classes whose standard has no values at all
+    # get maximal standard, NA of class standard in some samples gives NA
+    values = levels.to_numpy(dtype='float', copy=True)
+    values[np.isnan(values).all(axis=1)] = standard[levels.columns].to_numpy(dtype='float')
+    return std_normalization(df, pd.DataFrame(values, index=peaks.index, columns=levels.columns), layout)
 
-def std_normalization(df, standard):
+
+def std_normalization(df, standard, layout=None):
     """
     Divide intensities in df by standard intensities
-    :param df: df - dataframe with all data, with no nonnumericals in columns with intensities
-    :param standard: series - series with standard intensities
-    :return: df - normalized by standard intensities df
+    :param df: LipidMatrix or df - matrix or dataframe with all data, with no nonnumericals in columns with intensities
+    :param standard: series or df - series with standard intensities or dataframe peaks X samples with intensities of
+                                    standard for each peak
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: LipidMatrix or df - normalized by standard intensities df
     """
-    df = df.copy()
+    samples = df.samples.index if isinstance(df, LipidMatrix) else (layout or sample_layout(df)).samples
+    intensities = df.intensities if isinstance(df, LipidMatrix) else intensity_values(df[samples])
+
+    # Extract np array with values from standard in precision of intensities, one row is broadcasted to all peaks
+    if isinstance(standard, pd.Series):
+        standard = standard[samples].to_numpy(dtype=intensities.dtype)[np.newaxis]
+    else:
+        standard = standard[samples].to_numpy(dtype=intensities.dtype)
 
-    # Extract np array with values from standard series
-    standard = standard[samples].values.reshape(-1)
     # Subtract standard intensities from values
-    df[samples] = df[samples].subtract(standard, axis=1)
+    if isinstance(df, LipidMatrix):
+        return df.with_intensities(intensities - standard)
+    df = df.copy()
+    df[samples] = intensities - standard
     return df
 
 
@@ -119,103 +152,119 @@ def select_standard(standards):
     :return: series - series with selected intensities
     """
     # Select maximal intensities from all standards
-    return standards.max()
+    return standards.drop(columns='standard', errors='ignore').max()
 
 
-def find_standards(df, standard_mzs, precision=10):
+def class_standards(standards):
+    """
+    Select intensities of each standard - maximal ones from all its peaks
+    :param standards: df - dataframe with standards intensities and names of standards in column standard
+    :return: df - dataframe standards X samples
+    """
+    return standards.groupby('standard').max()
+
+
+def find_standards(df, standard_mzs, precision=10, standard_rts=None, rt_tolerance=0.5, layout=None):
     """
     Find standard's peaks in df given dictionary with their mzs
-    :param df: df - dataframe with data
+    All peaks are matched with all standards at once by binary search in sorted mzs of standards
+    :param df: LipidMatrix or df - matrix or dataframe with data
     :param standard_mzs: dict - standard names and lists of their mzs
-    :param precision: int - ppm - deviation of standard mz (1kk * |expected - observed| / expected), 10 by default
-    :return: df - dataframe with rows from original corresponding to standards
-    """
-    # Create empty df for standards
-    stands = pd.DataFrame()
-    # Convert precision to float to save computations
-    precision *= 1e-6
-
-    # Compute relative deviation of mz from standards mz and pick peaks whose deviation less than precision as standards
-    # i.e. which have approximately equal mz
-    for standard, mzs in standard_mzs.items():
-        for mz in mzs:
-            # Find deviation
-            relative_differences = relative_difference(df['mz'], mz)
-            # Find appropriate peaks and take them
-            p = relative_differences <= precision
-            stands = stands.append(df[p])
+    :param precision: float - ppm - deviation of standard mz (1kk * |expected - observed| / expected), 10 by default
+    :param standard_rts: dict - standard names and their retention times, mzs only are compared if not provided
+    :param rt_tolerance: float - maximal deviation of standard retention time
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df - dataframe with intensities of peaks corresponding to standards and name of standard in column
+    standard
+    """
+    peaks = df.peaks if isinstance(df, LipidMatrix) else df
+    names = [standard for standard, mzs in standard_mzs.items() for _ in mzs]
+    index = mz_index([mz for mzs in standard_mzs.values() for mz in mzs], names)
+
+    # Pick peaks whose deviation from standard mz less than precision as standards, i.e. which have approximately
+    # equal mz, and optionally close retention time. Peaks are matched by positions since index could be not unique
+    matches = match_mz(peaks['mz'].reset_index(drop=True), index, precision, 'ppm')
+    if standard_rts is not None:
+        expected = matches['label'].map(standard_rts).to_numpy(dtype='float')
+        observed = peaks['rt'].to_numpy(dtype='float')[matches['peak'].to_numpy()]
+        matches = matches[~(np.abs(observed - expected) > rt_tolerance)]
 
     # Check whether some standards are present
-    assert not stands.empty, 'No standards was found in df!\nTry less strict precision'
+    assert not matches.empty, 'No standards was found in df!\nTry less strict precision'
+
+    # Take intensities of standards' peaks
+    positions = matches['peak'].to_numpy()
+    if isinstance(df, LipidMatrix):
+        stands = df.frame().iloc[positions]
+    else:
+        stands = df[(layout or sample_layout(df)).samples].iloc[positions].astype('float')
+    stands['standard'] = matches['label'].to_numpy()
     return stands
 
 
-def relative_difference(observed, expected):
-    """
-    Compute relative difference between observed mz and expected with formula |observed - expected| / expected
-    It is expected to work upon single value / column and single value but will do ok on both columns (it is not
-    intended usually)
-    :param observed: series - dataframe column with observed values
-    :param expected: float - expected value of variable
-    :return: series - deviation from expected value (in number of expected vals)
-    """
-    # |observed - expected| / expected
-    return np.abs(observed - expected) / expected
-
-
-def normalize_by_mass(df, mass_row_name='mass'):
+def normalize_by_mass(df, mass_row_name='mass', layout=None):
     """
-    Apply mass normalization function to subset of df, which is determined by samples, samples_with_mass and meta
-    constants which should be defined earlier. Samples should be an Index object.
-    Perhaps we should remake these functions to take all that independent constants
-    Modify input df
-    :param df: df - dataframe with all data
-    :param mass_row_name: str - name of row with mass data
-    :return:
+    Apply mass normalization function to intensities of samples with known mass
+    :param df: LipidMatrix or df - matrix or dataframe with all data
+    :param mass_row_name: str - name of row (column of samples metadata for matrix) with mass data
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: LipidMatrix or df - normalized data of the same type
     """
+    # Subtract logarithm of mass from columns of matrix with known mass
+    if isinstance(df, LipidMatrix):
+        masses = df.samples[mass_row_name].to_numpy(dtype=df.intensities.dtype)
+        with_mass = ~np.isnan(masses)
+        intensities = df.intensities.copy()
+        intensities[:, with_mass] = mass_norm(intensities[:, with_mass], masses[with_mass])
+        return df.with_intensities(intensities)
+
+    samples = (layout or sample_layout(df)).samples
+    peaks = df.index[:df.shape[0] - find_diff(df)]
     df = df.copy()
 
     # Select intensities of samples
-    samples_intensities = prepare_intensities(df)
+    samples_intensities = prepare_intensities(df, samples, mass_row_name)
     # Pick masses of samples
-    masses = prepare_mass(df, mass_row_name)
+    masses = prepare_mass(df, samples, mass_row_name)
     # Normalize
-    df.loc[df.index[:-meta], samples[samples_with_mass]] = mass_norm(samples_intensities, masses)
+    df.loc[peaks, samples_intensities.columns] = mass_norm(samples_intensities, masses)
     return df
 
 
 def mass_norm(samples_intensities, masses):
     """
     Perform normalization by mass
-    :param samples_intensities: df - dataframe with intensities of samples with known mass in float format
-    :param masses: series - series with mass data, which is converted to float
-    :return: df - dataframe with intensities normalized by mass
+    :param samples_intensities: df or array - intensities of samples with known mass in float format
+    :param masses: series or array - mass data, which is converted to float
+    :return: df or array - intensities normalized by mass
     """
     # Log transform mass because it is not scaled but data is
-    return samples_intensities - masses.apply(np.log)
+    return samples_intensities - np.log(masses)
 
 
-def prepare_mass(df, mass_row_name='mass'):
+def prepare_mass(df, samples, mass_row_name='mass'):
     """
-    Get mass data from df
+    Get mass data of samples with known mass from df
     :param df: df - dataframe with merged metadata
+    :param samples: index - names of sample columns
     :param mass_row_name: str - name of row with mass data
     :return: series - series with mass data, which is converted to float
     """
-    # samples_with_mass should be defined
     # Pick masses of samples and convert them to float
-    masses = df.loc[mass_row_name, samples_with_mass[samples_with_mass].index]
-    masses = masses.astype('float')
-    return masses
+    masses = df.loc[mass_row_name, samples].astype('float')
+    return masses.dropna()
 
 
-def prepare_intensities(df):
+def prepare_intensities(df, samples, mass_row_name='mass'):
     """
     Get data with intensities of samples with known mass from df
     :param df: df - dataframe with merged metadata
+    :param samples: index - names of sample columns
+    :param mass_row_name: str - name of row with mass data
     :return: df - subset of passed into df with intensities, which are converted to floats
     """
     # Select intensities of samples with mass and convert them to float
-    samples_intensities = df.loc[df.index[:-meta], samples].loc[:, samples_with_mass]
+    samples_with_mass = df.loc[mass_row_name, samples].notna()
+    samples_intensities = df.loc[df.index[:df.shape[0] - find_diff(df)], samples[samples_with_mass.values]]
     samples_intensities = samples_intensities.astype('float')
     return samples_intensities
@@ -0,0 +1,232 @@
+import os
+import pickle
+import hashlib
+import inspect
+from functools import partial
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from .purge_contamination import purge_contaminants
+from .purge_isotopes import purge_isotopes
+from .purge_adducts import purge_adducts
+from .merge_features import merge_features
+from .purge_control import purge_control
+from .substitute_na import remove_na_peaks, substitute_na
+from .scaling import log_transform, z_scale
+from .normalization import percentille_normalization, standard_normalization, normalize_by_mass
+
+
+# Processing step - name of stage, function which takes and returns df and its keyword parameters
+Stage = namedtuple('Stage', ['name', 'function', 'params'])
+
+# Processing functions in order of notebooks 1-9
+processing_functions = {'contaminants': purge_contaminants,
+                        'isotopes': purge_isotopes,
+                        'adducts': purge_adducts,
+                        'duplicates': merge_features,
+                        'control': purge_control,
+                        'na_peaks': remove_na_peaks,
+                        'na': substitute_na,
+                        'log': log_transform,
+                        'z_scale': z_scale,
+                        'percentile_normalization': percentille_normalization,
+                        'standard_normalization': standard_normalization,
+                        'mass_normalization': normalize_by_mass}
+
+
+class Pipeline:
+    """
+    Chain of processing stages with cached outputs
+    Output of each stage is pickled into cache_dir with a key computed from content of pipeline input and names,
+    functions and parameters of this and all previous stages. Thus only stages after changed one are recomputed
+    """
+    def __init__(self, stages=(), cache_dir='.pipeline_cache', monitor=None):
+        """
+        :param stages: iterable - collection with Stage tuples
+        :param cache_dir: str - directory for cached outputs of stages, None to disable caching
+        :param monitor: Monitor - instrumentation which records calls of stages, None to run them as is
+        """
+        self.stages = list(stages)
+        self.cache_dir = cache_dir
+        self.monitor = monitor
+
+    def add(self, name, function, **params):
+        """
+        Append stage to the end of pipeline
+        :param name: str - name of stage, should be unique in pipeline
+        :param function: function - function which takes df and return df
+        :param params: dict - keyword parameters to function
+        :return: Pipeline - the pipeline itself to chain additions
+        """
+        if name in {stage.name for stage in self.stages}:
+            raise ValueError(f'Stage {name} is already in pipeline')
+        self.stages.append(Stage(name, function, params))
+        return self
+
+    def keys(self, df):
+        """
+        Compute cache keys of all stages for given input
+        :param df: df - input of pipeline
+        :return: list - list with key of each stage
+        """
+        keys = []
+        key = content_hash(df)
+        for stage in self.stages:
+            key = stage_hash(key, stage)
+            keys.append(key)
+        return keys
+
+    def run(self, df, until=None):
+        """
+        Pass df through stages, reusing cached outputs where inputs and parameters are unchanged
+        :param df: df - input of pipeline, e.g. XCMS/CAMERA peak table
+        :param until: str - name of the last stage to run, all stages by default
+        :return: df - output of the last stage, any object (e.g. tuple with report or LipidMatrix) which stage returns
+        """
+        stages = self.stages
+        if until is not None:
+            stages = stages[:[stage.name for stage in stages].index(until) + 1]
+        keys = self.keys(df)[:len(stages)]
+
+        # Start from the output of the last stage which is already in cache
+        start = 0
+        for i in reversed(range(len(stages))):
+            if os.path.exists(self.path(stages[i], keys[i])):
+                with open(self.path(stages[i], keys[i]), 'rb') as f:
+                    df = pickle.load(f)
+                start = i + 1
+                if self.monitor is not None:
+                    self.monitor.event('cache', cached=stages[i].name, skipped=i + 1)
+                break
+
+        # Compute remaining stages and store their outputs
+        for stage, key in zip(stages[start:], keys[start:]):
+            df = self.function(stage)(df, **stage.params)
+            if self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.path(stage, key), 'wb') as f:
+                    pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return df
+
+    def function(self, stage):
+        """
+        Get function of stage, wrapped by monitor if pipeline has it, functions which report (e.g. remove_na_peaks) get
+        the monitor too
+        :param stage: Stage - stage of pipeline
+        :return: function - function which takes df and return df
+        """
+        if self.monitor is None:
+            return stage.function
+        function = stage.function
+        if 'monitor' in inspect.signature(function).parameters:
+            function = partial(function, monitor=self.monitor)
+        return self.monitor.wrap(function, stage.name)
+
+    def path(self, stage, key):
+        """
+        Get path of cached output of stage
+        :param stage: Stage - stage of pipeline
+        :param key: str - cache key of stage
+        :return: str - path to file, never existing one if caching is disabled
+        """
+        if self.cache_dir is None:
+            return ''
+        return os.path.join(self.cache_dir, f'{stage.name}_{key}.pkl')
+
+
+def processing_pipeline(names=('contaminants', 'isotopes', 'control', 'na_peaks', 'na', 'log'),
+                        cache_dir='.pipeline_cache', monitor=None, **params):
+    """
+    Create pipeline from standard processing functions
+    :param names: iterable - names of stages from processing_functions in order of their application
+    :param cache_dir: str - directory for cached outputs of stages, None to disable caching
+    :param monitor: Monitor - instrumentation which records calls of stages
+    :param params: dict - stage name: dict with its keyword parameters, e.g. control={'fold': 5}
+    :return: Pipeline - pipeline with stages
+    """
+    pipeline = Pipeline(cache_dir=cache_dir, monitor=monitor)
+    for name in names:
+        pipeline.add(name, processing_functions[name], **params.get(name, {}))
+    return pipeline
+
+
+def content_hash(df):
+    """
+    Compute hash of dataframe content - values, index, column names and dtypes
+    :param df: df - dataframe
+    :return: str - hex digest
+    """
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    return digest.hexdigest()
+
+
+def stage_hash(key, stage):
+    """
+    Compute cache key of stage from key of its input and stage description
+    Code of stage function and of its whole module is hashed as well, so change of the function or of helpers in its
+    module invalidates cache
+    :param key: str - cache key of input of stage
+    :param stage: Stage - stage of pipeline
+    :return: str - hex digest
+    """
+    digest = hashlib.sha1(key.encode())
+    digest.update(stage.name.encode())
+    digest.update(describe(stage.function).encode())
+    digest.update(repr(sorted((name, describe(value)) for name, value in stage.params.items())).encode())
+    return digest.hexdigest()
+
+
+def describe(value):
+    """
+    Create stable text description of stage parameter
+    Functions are described by their qualified name and code (see function_code), partial functions by their bound
+    arguments too, arrays and dataframes by their content
+    :param value: object - parameter value
+    :return: str - description
+    """
+    if isinstance(value, partial):
+        return f'{describe(value.func)}({describe(value.args)}, {describe(value.keywords)})'
+    if callable(value):
+        digest = hashlib.sha1(function_code(value).encode()).hexdigest()
+        return f'{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", repr(value))}:{digest}'
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return content_hash(value.to_frame() if isinstance(value, pd.Series) else value)
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, dict):
+        return repr(sorted((k, describe(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return repr([describe(v) for v in value])
+    return repr(value)
+
+
+def function_code(function):
+    """
+    Get code of function for its description: its source and source of its module (for helpers defined there)
+    Functions without source, e.g. defined in notebooks or by exec, are described by their compiled code, constants,
+    used names and default values
+    :param function: function - function of stage or parameter
+    :return: str - code of function
+    """
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        code = getattr(function, '__code__', None)
+        source = compiled_code(code) + describe(getattr(function, '__defaults__', None)) if code is not None else ''
+    try:
+        source += inspect.getsource(inspect.getmodule(function))
+    except (OSError, TypeError):
+        pass
+    return source
+
+
+def compiled_code(code):
+    """
+    Describe compiled code independently of memory addresses of nested code objects
+    :param code: code - code object of function
+    :return: str - description
+    """
+    constants = [compiled_code(constant) if inspect.iscode(constant) else repr(constant) for constant in code.co_consts]
+    return repr((code.co_code, constants, code.co_names))
@@ -1 +1,118 @@
-# TODO: SHOULD BE REWRITTEN - I think, I did it wrong
+import warnings
+import numpy as np
+import pandas as pd
+from .column_division import sample_layout, intensity_values
+
+
+# Negative mode adducts of CAMERA in order of preference: deprotonated ion is the most reliable representative
+adduct_priority = ('[M-H]-', '[M-2H]2-', '[M+Cl]-', '[M+HCOO]-', '[M-H+HCOOH]-', '[M-H2O-H]-', '[2M-H]-')
+
+# Annotation of CAMERA: adduct name followed by neutral mass, e.g. [M-H]- 782.177 [M+Cl]- 746.2
+annotation_pattern = r'(?P<adduct>\[[^\]]+\]\d*[+-]+)\s+(?P<mass>\d+(?:\.\d*)?)'
+
+
+def purge_adducts(df, priority=adduct_priority, intensity='median', tolerance=0.005, layout=None):
+    """
+    Delete redundant adduct peaks from dataset - peaks are rows and mz, rt, adduct, pcgroup, samples are columns
+    Ions of one compound are peaks of the same pcgroup annotated with the same neutral mass (up to tolerance), only one
+    representative ion is kept for each compound. Peaks without adduct annotation are kept as is
+    :param df: df - dataframe to clean
+    :param priority: iterable - adducts in order of preference, adducts which are not listed are the least preferable,
+                                None or empty to choose only by intensity
+    :param intensity: str - statistic of intensities in samples which chooses among ions of the same priority,
+                            'median', 'mean', 'sum' or 'max'
+    :param tolerance: float - maximal difference (Da) between neutral masses of ions of one compound
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df - cleaned from adducts dataframe, order of peaks is preserved
+    """
+    layout = layout or sample_layout(df)
+
+    # Parse annotations, peak with several hypotheses gets row for each of them
+    annotations = parse_adducts(df['adduct'])
+    if annotations.empty:
+        return df.copy()
+
+    # Rank of adduct by priority and score of peak by intensity
+    peaks = annotations['peak'].to_numpy()
+    priority = pd.Index(priority or [])
+    ranks = priority.get_indexer(annotations['adduct'])
+    ranks[ranks < 0] = len(priority)
+    scores = intensity_scores(intensity_values(df[layout.samples]), intensity)[peaks]
+
+    # Number compounds and find the best ion of each one
+    compounds = find_compounds(df['pcgroup'].to_numpy()[peaks], annotations['mass'].to_numpy(),
+                               tolerance)
+    best = representative_ions(compounds, ranks, scores)
+
+    # Peak is redundant if it isn't representative of any of its hypotheses
+    annotated = np.zeros(len(df), dtype='bool')
+    annotated[peaks] = True
+    kept = np.zeros(len(df), dtype='bool')
+    kept[peaks[best]] = True
+    return df.iloc[np.flatnonzero(~annotated | kept)]
+
+
+def parse_adducts(adducts):
+    """
+    Parse adduct column of CAMERA into annotations
+    :param adducts: series - adduct annotations of peaks, empty strings or NA for peaks without them
+    :return: df - annotations with columns peak (position of peak), adduct (name) and mass (neutral mass)
+    """
+    adducts = adducts.fillna('').astype(str).reset_index(drop=True)
+    parsed = adducts[adducts.str.len() > 0].str.extractall(annotation_pattern)
+    return pd.DataFrame({'peak': parsed.index.get_level_values(0).to_numpy(dtype='int64'),
+                         'adduct': parsed['adduct'].to_numpy(dtype='object'),
+                         'mass': parsed['mass'].to_numpy(dtype='float64')})
+
+
+def intensity_scores(intensities, intensity='median'):
+    """
+    Compute statistic of intensities for each peak, absent peaks get the lowest score
+    :param intensities: array - intensities of peaks X samples
+    :param intensity: str - 'median', 'mean', 'sum' or 'max'
+    :return: array - score of each peak
+    """
+    statistics = {'median': np.nanmedian, 'mean': np.nanmean, 'sum': np.nansum, 'max': np.nanmax}
+    if intensity not in statistics:
+        raise ValueError(f'Unknown intensity rule: {intensity}')
+
+    # Peaks without values produce warnings of empty slices
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        scores = statistics[intensity](intensities, axis=1)
+    return np.nan_to_num(scores.astype('float64'), nan=-np.inf)
+
+
+def find_compounds(pcgroups, masses, tolerance=0.005):
+    """
+    Number compounds of annotations: annotations of one pcgroup whose sorted neutral masses differ by no more than
+    tolerance belong to the same compound
+    :param pcgroups: array - pcgroup of each annotation
+    :param masses: array - neutral mass of each annotation
+    :param tolerance: float - maximal difference between neighbouring masses of one compound
+    :return: array - number of compound of each annotation
+    """
+    # Sort by pcgroup and mass, new compound starts at new pcgroup or at gap in masses
+    order = np.lexsort((masses, pcgroups))
+    pcgroups, masses = pcgroups[order], masses[order]
+    starts = np.ones(len(order), dtype='bool')
+    starts[1:] = (pcgroups[1:] != pcgroups[:-1]) | (np.diff(masses) > tolerance)
+
+    compounds = np.empty(len(order), dtype='int64')
+    compounds[order] = np.cumsum(starts) - 1
+    return compounds
+
+
+def representative_ions(compounds, ranks, scores):
+    """
+    Choose the best annotation of each compound: the most preferable adduct and then the most intensive ion
+    :param compounds: array - number of compound of each annotation
+    :param ranks: array - priority rank of adduct of each annotation, lower is better
+    :param scores: array - intensity score of each annotation, higher is better
+    :return: array - positions of chosen annotations
+    """
+    # The best annotation is the first one of its compound after sorting
+    order = np.lexsort((-scores, ranks, compounds))
+    firsts = np.ones(len(order), dtype='bool')
+    firsts[1:] = compounds[order][1:] != compounds[order][:-1]
+    return order[firsts]
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from collections import namedtuple
 
 
 # List of contaminants in negative mode without palmitic oleic and stearic acids
@@ -127,30 +128,99 @@ conts_pos = [33.03349, 42.03383, 59.06037, 63.04406, 64.01577, 65.05971, 74.0600
              3312.30814, 3337.73214, 3346.68149, 3353.72706]
 
 
-def purge_contaminants(df, decimals=3, negatives=conts_neg, positives=conts_pos):
+# Sorted mzs of contaminants with their origins
+MzIndex = namedtuple('MzIndex', ['mz', 'label'])
+
+
+def mz_index(mzs, labels):
     """
-    Delete contaminant peaks from original dataset - peaks are rows and mz, rt, samples are columns
-    :param df: df - dataframe to clean
-    :param decimals: int - number of decimal digits to which mz will be approximated
+    Create index of reference mzs sorted for binary search
+    :param mzs: iterable - collection with reference mzs
+    :param labels: iterable - collection with label of each reference mz, e.g. its name or ionization mode
+    :return: MzIndex - sorted arrays of mzs and their labels
+    """
+    mzs = np.asarray(mzs, dtype='float')
+    labels = np.asarray(labels)
+    order = np.argsort(mzs, kind='stable')
+    return MzIndex(mzs[order], labels[order])
+
+
+def contaminant_index(negatives=conts_neg, positives=conts_pos):
+    """
+    Create index of contaminants from both ionization modes, labels are names of modes
     :param negatives: list - list with mz of contaminants in negative mode
     :param positives: list - list with mz of contaminants in positive mode
-    :return: df - cleaned from contaminants dataframe
+    :return: MzIndex - sorted arrays of contaminant mzs and their modes
     """
-    # Find contaminants in negative mode
-    delete_contamination(df, decimals, negatives)
-    # Find contaminants in positive mode
-    delete_contamination(df, decimals, positives)
-    return df
+    labels = ['negative'] * len(negatives) + ['positive'] * len(positives)
+    return mz_index(list(negatives) + list(positives), labels)
+
 
-def delete_contamination(df, decimals, conts):
+# Index of default contaminants lists
+contaminants = contaminant_index()
+
+
+def purge_contaminants(df, tolerance=5, unit='ppm', index=contaminants, report=False):
     """
-    Delete peaks from df with mz which is provided in conts with specified precision
+    Delete contaminant peaks from original dataset - peaks are rows and mz, rt, samples are columns
     :param df: df - dataframe to clean
-    :param decimals: int - number of decimal digits to which mz will be approximated
-    :param conts: list - list with mz of contaminants
-    :return: df - cleaned from contaminants dataframe
+    :param tolerance: float - maximal deviation of peak mz from contaminant mz
+    :param unit: str - unit of tolerance, 'ppm' or 'da'
+    :param index: MzIndex - index of contaminants, e.g. from contaminant_index with custom lists
+    :param report: bool - whether to return report about matched contaminants too
+    :return: df or (df, df) - cleaned from contaminants dataframe and report from match_mz if report is True
     """
     # Find peaks with mz around contaminants mz
-    contaminant_peaks = df['mz'].round(decimals).isin(np.round(conts, decimals))
+    matches = match_mz(df['mz'], index, tolerance, unit)
     # Exclude contaminant peaks from df
-    df.drop(contaminant_peaks[contaminant_peaks].index, inplace=True)
+    cleaned = df.drop(matches['peak'].unique())
+
+    if report:
+        return cleaned, matches
+    return cleaned
+
+
+def match_mz(mz, index, tolerance=5, unit='ppm'):
+    """
+    Find all pairs of peaks and reference mzs which are closer than tolerance
+    Window of each peak is found with binary search in sorted reference mzs, so all peaks are matched at once
+    :param mz: series - mz of peaks
+    :param index: MzIndex - index of reference mzs
+    :param tolerance: float - maximal deviation of peak mz from reference mz
+    :param unit: str - unit of tolerance, 'ppm' (relative to reference mz) or 'da'
+    :return: df - dataframe with peak, mz, reference mz, label of reference and deviation in ppm for each match
+    """
+    observed = mz.to_numpy(dtype='float')
+
+    # Find range of reference mzs which could be matched with each peak
+    if unit == 'ppm':
+        tolerance *= 1e-6
+        lower, upper = observed / (1 + tolerance), observed / (1 - tolerance)
+    elif unit == 'da':
+        lower, upper = observed - tolerance, observed + tolerance
+    else:
+        raise ValueError(f'Unknown unit of tolerance: {unit}')
+    starts = np.searchsorted(index.mz, lower, side='left')
+    ends = np.searchsorted(index.mz, upper, side='right')
+
+    # Expand windows into pairs of peak and reference positions
+    counts = ends - starts
+    peaks = np.repeat(np.arange(len(observed)), counts)
+    references = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+    matches = pd.DataFrame({'peak': mz.index[peaks],
+                            'mz': observed[peaks],
+                            'reference': index.mz[references],
+                            'label': index.label[references]})
+    matches['ppm'] = 1e6 * relative_deviation(matches['mz'], matches['reference'])
+    return matches
+
+
+def relative_deviation(observed, expected):
+    """
+    Compute relative deviation of observed mz from expected with formula |observed - expected| / expected
+    :param observed: series - observed mzs
+    :param expected: series - expected mzs
+    :return: series - deviation from expected value (in number of expected vals)
+    """
+    return np.abs(observed - expected) / expected
@@ -1,40 +1,105 @@
+import warnings
 import numpy as np
 import pandas as pd
-from .column_division import *
+from .column_division import sample_layout, intensity_values
 
 
-def purge_control(df, fold=3, exterminate=False):
+def purge_control(df, fold=3, exterminate=False, threshold='max', k=3, batches=None, subtract=False, report=False,
+                  layout=None):
     """
     Turn values in peaks whose intensity is lower than corresponding in control samples to NA
     :param df: df - dataframe to clean
     :param fold: float - number of times which intensity of peak should be larger in sample than in peak
     :param exterminate: boolean - whether to turn all values in a peak to NA if it is present in a blank (strict variant)
-    :return: df - cleaned from control dataframe
+    :param threshold: str - blank level of peak, 'max' - maximal intensity in blanks, 'mean_sd' - mean + k * sd of
+                            intensities in blanks
+    :param k: float - number of standard deviations for 'mean_sd' threshold
+    :param batches: dict - name of batch: (blank columns, sample columns) to compare samples only with blanks from their
+                           batch, samples which are not in batches are compared with all blanks
+    :param subtract: boolean - whether to subtract blank level from remaining values
+    :param report: boolean - whether to return numbers of removed values too
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return: df or (df, series, series) - cleaned from control dataframe and if report is True numbers of values turned
+    to NA in each peak and in each sample
     """
+    layout = layout or sample_layout(df)
+    samples = layout.samples_wo_controls_qc
     df = df.copy()
-    # Find maxima for each peak in all blank controls
-    maxima = df[blanks].max(axis=1)
 
-    # In case of extermination turn to NA all peaks which contains intensity > 0 in any of blanks
-    if exterminate:
-        df.loc[maxima[maxima != 0].index, samples_wo_controls_qc] = np.nan
+    # Without blanks there is nothing to compare with
+    if len(layout.blanks) == 0:
+        if report:
+            return (df, pd.Series(0, index=df.index, name='removed'),
+                    pd.Series(0, index=samples, name='removed'))
+        return df
+
+    intensities = intensity_values(df[samples], copy=True)
+    # Find blank level of each peak for each sample
+    levels = blank_levels(df, layout.blanks, samples, threshold, k, batches)
 
+    # In case of extermination turn to NA all peaks which contains intensity > 0 in corresponding blanks
+    if exterminate:
+        removed = np.broadcast_to(levels > 0, intensities.shape) & ~np.isnan(intensities)
     # Otherwise turn to NA values whose intensities less than fold * blank_intensity
     else:
-        # Find samples where peaks' concentration less than in blank times fold multiplier
-        less_than_blank = df[samples_wo_controls_qc].apply(lambda x: x < maxima * fold)
-        # Purge observations with abundance less than blank one
-        df[less_than_blank] = np.nan
-        # Should I subtract blank value from samples?
-        # df[samples_wo_controls_qc] = df[samples_wo_controls_qc].sub(maxima, axis=0)
+        removed = intensities < levels * fold
+
+    # Purge observations with abundance less than blank one and subtract blank from the rest if needed
+    intensities[removed] = np.nan
+    if subtract:
+        intensities -= np.nan_to_num(levels)
+    df[samples] = intensities
+
+    if report:
+        removed_in_peaks = pd.Series(removed.sum(axis=1), index=df.index, name='removed')
+        removed_in_samples = pd.Series(removed.sum(axis=0), index=samples, name='removed')
+        return df, removed_in_peaks, removed_in_samples
     return df
 
 
-# Load data
-name = '../../vitaminD/cleaned_isotopes_cleaned_contaminants_xs_annotated_rats_neg.csv'
-df = pd.read_csv(name, index_col=0)
+def blank_levels(df, blanks, samples, threshold='max', k=3, batches=None):
+    """
+    Compute blank level of each peak for each sample
+    :param df: df - dataframe with intensities
+    :param blanks: index - names of blank columns
+    :param samples: index - names of sample columns
+    :param threshold: str - 'max' - maximal intensity in blanks, 'mean_sd' - mean + k * sd of intensities in blanks
+    :param k: float - number of standard deviations for 'mean_sd' threshold
+    :param batches: dict - name of batch: (blank columns, sample columns)
+    :return: array - levels with shape peaks X 1 without batches and peaks X samples otherwise, NA for peaks absent
+    in blanks
+    """
+    levels = blank_statistic(intensity_values(df[blanks]), threshold, k)[:, np.newaxis]
+    if not batches:
+        return levels
+
+    # Samples of each batch get level of blanks from the same batch
+    levels = np.repeat(levels, len(samples), axis=1)
+    for batch, (batch_blanks, batch_samples) in batches.items():
+        positions = pd.Index(samples).get_indexer(batch_samples)
+        if (positions < 0).any():
+            missing = list(pd.Index(batch_samples)[positions < 0])
+            raise ValueError(f'Samples of batch {batch} are not among samples of df: {missing}')
+        levels[:, positions] = blank_statistic(intensity_values(df[batch_blanks]), threshold, k)[:, np.newaxis]
+    return levels
+
 
-# Purge
-df = purge_control(df)
-# Write to a file
-df.to_csv(f'cleaned_control_{name}')
\ No newline at end of file
+def blank_statistic(intensities, threshold='max', k=3):
+    """
+    Compute statistic of blank intensities for each peak
+    :param intensities: array - intensities of blanks peaks X blanks
+    :param threshold: str - 'max' - maximal intensity, 'mean_sd' - mean + k * sd of intensities
+    :param k: float - number of standard deviations for 'mean_sd' threshold
+    :return: array - statistic for each peak, NA for peaks without values
+    """
+    # Peaks without values in blanks get NA, as well as all peaks if there are no blanks (e.g. in batch)
+    if intensities.shape[1] == 0:
+        return np.full(intensities.shape[0], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if threshold == 'max':
+            return np.nanmax(intensities, axis=1)
+        elif threshold == 'mean_sd':
+            sd = np.nan_to_num(np.nanstd(intensities, axis=1, ddof=1))
+            return np.nanmean(intensities, axis=1) + k * sd
+    raise ValueError(f'Unknown type of blank threshold: {threshold}')
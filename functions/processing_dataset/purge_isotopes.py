@@ -1,41 +1,47 @@
 import numpy as np
 import pandas as pd
-from .column_division import *
+from .column_division import sample_layout
 
 
-def purge_isotopes(df):
+def purge_isotopes(df, keep='maxima', layout=None):
     """
     Delete isotopic peaks with lower intensity from dataset - peaks are rows and mz, rt, samples are columns
     :param df: df - dataframe to clean
+    :param keep: str - 'maxima' to keep peak with greatest number of maximal intensities in samples from each isotope
+                       group or 'monoisotopic' to keep [M] peak (groups without it are treated as with 'maxima')
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :return: df - cleaned from isotopes dataframe
     """
-    # Parse isotopes column and extract id of peak and isotope type
-    df[['id', 'type']] = df['isotopes'].str.extract(r'\[(?P<id>\d+)\]\[(?P<type>.+)\]', expand=True)
+    layout = layout or sample_layout(df)
 
-    # Get indices of appropriate peaks
-    ind = df.groupby('id').apply(isotop_chose).values
+    # Parse isotopes column and extract id of peak and isotope type, peaks are numbered by position
+    parsed = df['isotopes'].str.extract(r'\[(?P<id>\d+)\]\[(?P<type>.+)\]', expand=True).reset_index(drop=True)
+    grouped = parsed['id'].notna().to_numpy()
 
-    # Obtain df without redundant isotope peaks which had isotope alternatives
-    data_wo_isotopes = df.loc[ind]
-    # Obtain df with peaks without isotope alternatives
-    data_wo_isotopes_na = df[df['id'].isna()]
+    # Count cells with maximal concentration in group for each peak of isotope groups
+    counts = count_maxima(df.loc[grouped, layout.samples].reset_index(drop=True), parsed.loc[grouped, 'id'].values)
 
-    # Unite dfs to one
-    cleaned = pd.concat([data_wo_isotopes, data_wo_isotopes_na])
+    # Monoisotopic peaks get bonus which can't be achieved by number of maxima
+    if keep == 'monoisotopic':
+        counts += (parsed.loc[grouped, 'type'].values == 'M') * (len(layout.samples) + 1)
+    elif keep != 'maxima':
+        raise ValueError(f'Unknown type of kept peaks: {keep}')
 
-    # Delete obsolete columns
-    cleaned.drop(['id', 'type'], axis=1, inplace=True)
+    # Get positions of appropriate peaks - first peak with greatest count in each group
+    ind = np.flatnonzero(grouped)[counts.groupby(parsed.loc[grouped, 'id'].values).idxmax().values]
+
+    # Unite peaks chosen from isotope groups and peaks without isotope alternatives
+    cleaned = pd.concat([df.iloc[ind], df.iloc[np.flatnonzero(~grouped)]])
     return cleaned
 
 
-def isotop_chose(group):
+def count_maxima(intensities, ids):
     """
-    Return index of peak with greatest fraction of maximal concentration from group.
-    samples here is a subset of columns (which contains peaks) which should be processed
-    :param group: df - group of grouped df
-    :return: index - indices of appropriate peaks
+    Count for each peak number of samples in which its intensity is the maximal one in its isotope group
+    :param intensities: df - intensities of peaks from isotope groups
+    :param ids: array - isotope group of each peak
+    :return: series - number of maxima for each peak
     """
-    # Count cells with maximal concentration and take indices of peaks with greatest number of maxima
     # It takes maximum in SAMPLE to compare is it ok?
-    index = (group[samples] == group[samples].max(axis=0)).sum(axis=1).idxmax()
-    return index
+    maxima = intensities.groupby(ids).transform('max')
+    return (intensities == maxima).sum(axis=1)
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from .lipid_matrix import LipidMatrix, find_diff
+
+
+class SampleIndex:
+    """
+    Sample metadata encoded for fast selection of samples: each feature (tissue, age, id etc.) is kept as integer codes
+    of its categories, presence of mass is kept as boolean mask. Queries return positions of samples, so intensities
+    are never copied or compared as objects
+    """
+    def __init__(self, metadata, mass_row_name='mass'):
+        """
+        :param metadata: df - metadata of samples, samples are rows and features are columns
+        :param mass_row_name: str - name of feature with masses of samples
+        """
+        self.samples = metadata.index
+        self.codes = {}
+        self.categories = {}
+        # NA get code -1 and never match any variant
+        for feature in metadata.columns.drop(mass_row_name, errors='ignore'):
+            self.codes[feature], self.categories[feature] = pd.factorize(metadata[feature])
+        if mass_row_name in metadata.columns:
+            self.with_mass = metadata[mass_row_name].notna().to_numpy()
+        else:
+            self.with_mass = np.zeros(len(self.samples), dtype='bool')
+
+    @classmethod
+    def from_merged(cls, df, mass_row_name='mass'):
+        """
+        Create index from dataframe merged with metadata, where metadata rows are at the bottom of df
+        :param df: df - dataframe merged with metadata, only columns of samples
+        :param mass_row_name: str - name of row with masses of samples
+        :return: SampleIndex - index of df columns
+        """
+        return cls(df.iloc[df.shape[0] - find_diff(df):].T, mass_row_name)
+
+    def variant_mask(self, feature, variant):
+        """
+        Find samples which have one of variants of feature
+        :param feature: str - name of feature
+        :param variant: str or list - variant or several variants of feature
+        :return: array - boolean mask of samples
+        """
+        variants = list(variant) if pd.api.types.is_list_like(variant) else [variant]
+        wanted = self.categories[feature].get_indexer(variants)
+        return np.isin(self.codes[feature], wanted[wanted >= 0])
+
+    def mask(self, include, exclude={}, with_mass=True):
+        """
+        Find samples which satisfy all conditions
+        :param include: dict - dictionary with feature: variant or feature: [variants] to include
+        :param exclude: dict - dictionary with feature: variant or feature: [variants] to exclude
+        :param with_mass: boolean - whether to take only samples with known mass
+        :return: array - boolean mask of samples
+        """
+        mask = self.with_mass.copy() if with_mass else np.ones(len(self.samples), dtype='bool')
+        for feature, variant in include.items():
+            mask &= self.variant_mask(feature, variant)
+        for feature, variant in exclude.items():
+            mask &= ~self.variant_mask(feature, variant)
+        return mask
+
+    def positions(self, include, exclude={}, with_mass=True):
+        """
+        Find positions of samples which satisfy all conditions
+        :param include: dict - dictionary with feature: variant or feature: [variants] to include
+        :param exclude: dict - dictionary with feature: variant or feature: [variants] to exclude
+        :param with_mass: boolean - whether to take only samples with known mass
+        :return: array - positions of samples in increasing order
+        """
+        return np.flatnonzero(self.mask(include, exclude, with_mass))
+
+    def has_variants(self, feature, positions):
+        """
+        Check whether any of selected samples has known variant of feature
+        :param feature: str - name of feature
+        :param positions: array - positions of samples
+        :return: bool - whether feature isn't NA for at least one sample
+        """
+        return bool((self.codes[feature][positions] >= 0).any())
+
+
+def sample_index(data, mass_row_name='mass'):
+    """
+    Create index of samples from matrix or dataframe merged with metadata
+    :param data: LipidMatrix or df - matrix with metadata of samples or dataframe merged with metadata
+    :param mass_row_name: str - name of feature with masses of samples
+    :return: SampleIndex - index of samples
+    """
+    if isinstance(data, LipidMatrix):
+        return SampleIndex(data.samples, mass_row_name)
+    return SampleIndex.from_merged(data, mass_row_name)
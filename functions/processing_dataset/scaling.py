@@ -1,16 +1,17 @@
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-from .column_division import *
+from .column_division import sample_layout
 
 
-def z_scale(df):
+def z_scale(df, layout=None):
     """
     Perform z-scaling on df
-    samples constant should be predefined
     :param df: df - dataframe
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :return:
     """
+    samples = (layout or sample_layout(df)).samples
     df = df.copy()
 
     # Initialize scaler and scale numeric data
@@ -20,14 +21,15 @@ def z_scale(df):
     return df
 
 
-def log_transform(df):
+def log_transform(df, layout=None):
     """
     Log scaling of (intensities + minimum) in df. Addition of minimum to avoid Inf in case of zeros.
     Minimum is a half of minimal positive value
-    samples constant should be predefined
     :param df: df - dataframe with nonnegative values
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :return: df - log transformed dataframe
     """
+    samples = (layout or sample_layout(df)).samples
     df = df.copy()
 
     # Adding 1 before log transformation is too much for z-scaled positivised data
@@ -43,13 +45,14 @@ def log_transform(df):
     return df
 
 
-def positivize(df):
+def positivize(df, layout=None):
     """
     Add minimal value in df to df (shift value distribution to start from 0)
-    samples constant should be predefined
     :param df: df - dataframe
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
     :return: df - nonnegative (0 and positives) dataframe
     """
+    samples = (layout or sample_layout(df)).samples
     df = df.copy()
 
     # Find minimum and subtract it from df
@@ -0,0 +1,150 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from .column_division import sample_layout, columns_layout, intensity_values
+
+
+# Names of files inside directory with stored peak table
+DESCRIPTION = 'table.json'
+INTENSITIES = 'intensities.npy'
+# Column which keeps index of peak table in columnar files
+INDEX = '__peak__'
+
+
+def save_peak_table(df, path, fmt='parquet', split_intensities=True, dtype=None, layout=None):
+    """
+    Save peak table into directory with columnar file and optionally raw intensity matrix
+    Annotation columns (mz, rt, isotopes etc.) are written into parquet or feather file, intensities of samples are
+    written as float matrix peaks X samples into .npy file which can be memory-mapped
+    :param df: df - peak table with peaks as rows and mz, rt, samples as columns
+    :param path: str - directory to save table
+    :param fmt: str - format of columnar file, 'parquet' or 'feather'
+    :param split_intensities: bool - whether to save intensities into separate .npy file
+    :param dtype: str - type of saved intensities, e.g. 'float32', type of df columns by default
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :return:
+    """
+    samples = (layout or sample_layout(df)).samples if split_intensities else pd.Index([])
+    os.makedirs(path, exist_ok=True)
+
+    # Columnar file can't keep arbitrary index, so it is stored as a column
+    table = df.drop(columns=samples)
+    table.index.name = INDEX
+    write_columnar(table.reset_index(), os.path.join(path, f'table.{fmt}'), fmt)
+
+    # Intensities are stored as contiguous matrix
+    if split_intensities:
+        intensities = intensity_values(df[samples])
+        np.save(os.path.join(path, INTENSITIES), np.ascontiguousarray(intensities, dtype=dtype or intensities.dtype))
+
+    # Description of table to restore it in original form
+    description = {'format': fmt,
+                   'columns': list(map(str, df.columns)),
+                   'samples': list(map(str, samples)),
+                   'index': df.index.name}
+    with open(os.path.join(path, DESCRIPTION), 'w') as f:
+        json.dump(description, f)
+
+
+def load_peak_table(path, columns=None, mmap=True, dtype=None):
+    """
+    Load peak table saved by save_peak_table. Only requested columns are read from disk
+    The table is always assembled in memory: memory mapping only avoids reading the whole matrix when some samples are
+    requested, all intensities are copied into dataframe anyway. Use load_intensities for memory-mapped matrix
+    :param path: str - directory with stored table
+    :param columns: iterable - names of columns to load, all by default
+    :param mmap: bool - whether to memory-map intensity matrix instead of reading it whole before selection of samples
+    :param dtype: str - type of intensities, e.g. 'float32', stored type by default
+    :return: df - peak table with columns in original order
+    """
+    description = describe_table(path)
+    if columns is None:
+        columns = description['columns']
+    columns = [c for c in description['columns'] if c in set(columns)]
+
+    # Read annotation columns from columnar file
+    samples = set(description['samples'])
+    annotations = [c for c in columns if c not in samples]
+    table = read_columnar(os.path.join(path, f'table.{description["format"]}'), description['format'],
+                          [INDEX] + annotations)
+    df = table.set_index(INDEX)
+    df.index.name = description['index']
+
+    # Take requested samples from intensity matrix
+    requested = [c for c in columns if c in samples]
+    if requested:
+        intensities = load_intensities(path, requested, mmap_mode='r' if mmap else None)
+        intensities = intensities.astype(dtype or intensities.dtype, copy=False)
+        df = pd.concat([df, pd.DataFrame(intensities, index=df.index, columns=requested)], axis=1)
+    return df[columns]
+
+
+def load_intensities(path, samples=None, mmap_mode='r'):
+    """
+    Load intensity matrix peaks X samples saved by save_peak_table
+    With memory mapping and without selection of samples matrix is not read, so it could be shared between processes
+    :param path: str - directory with stored table
+    :param samples: iterable - names of samples to take, all by default
+    :param mmap_mode: str - mode of memory mapping for np.load, None to read whole matrix into memory
+    :return: array - matrix peaks X samples
+    """
+    intensities = np.load(os.path.join(path, INTENSITIES), mmap_mode=mmap_mode)
+    if samples is None:
+        return intensities
+
+    # Select columns of requested samples
+    positions = pd.Index(describe_table(path)['samples']).get_indexer(samples)
+    if (positions < 0).any():
+        raise ValueError('Some samples are absent in stored table')
+    return np.asarray(intensities[:, positions])
+
+
+def stored_layout(path):
+    """
+    Divide columns of stored peak table into groups without reading the table
+    :param path: str - directory with stored table
+    :return: SampleLayout - named tuple with indices of column groups
+    """
+    return columns_layout(tuple(describe_table(path)['columns']))
+
+
+def describe_table(path):
+    """
+    Read description of stored peak table
+    :param path: str - directory with stored table
+    :return: dict - format of columnar file, names of all columns, sample columns and index
+    """
+    with open(os.path.join(path, DESCRIPTION)) as f:
+        return json.load(f)
+
+
+def write_columnar(df, name, fmt):
+    """
+    Write dataframe into columnar file
+    :param df: df - dataframe with default index
+    :param name: str - name of file
+    :param fmt: str - 'parquet' or 'feather'
+    :return:
+    """
+    if fmt == 'parquet':
+        df.to_parquet(name, index=False)
+    elif fmt == 'feather':
+        df.to_feather(name)
+    else:
+        raise ValueError(f'Unknown format of peak table: {fmt}')
+
+
+def read_columnar(name, fmt, columns):
+    """
+    Read selected columns from columnar file
+    :param name: str - name of file
+    :param fmt: str - 'parquet' or 'feather'
+    :param columns: list - names of columns to read
+    :return: df - dataframe with selected columns
+    """
+    if fmt == 'parquet':
+        return pd.read_parquet(name, columns=columns)
+    elif fmt == 'feather':
+        return pd.read_feather(name, columns=columns)
+    raise ValueError(f'Unknown format of peak table: {fmt}')
@@ -0,0 +1,187 @@
+import os
+import inspect
+import numpy as np
+import pandas as pd
+from .column_division import sample_layout
+from .purge_contamination import purge_contaminants
+from .purge_control import purge_control
+from .substitute_na import remove_na_peaks, substitute_na
+from .storage import describe_table, load_intensities, INDEX
+from ..instrumentation import Monitor
+
+
+# Functions which process each peak independently of others, so peak table could be processed by parts
+row_local_functions = {purge_contaminants, purge_control, remove_na_peaks, substitute_na}
+# Imputers which use only values of the same peak
+row_local_imputers = {'half_min', 'quantile'}
+
+
+def stream_pipeline(pipeline, source, destination, chunksize=10000):
+    """
+    Apply stages of pipeline to peak table by chunks of rows and write remaining peaks incrementally
+    Memory consumption is proportional to chunksize instead of number of peaks. All stages should be row-local
+    Reports of stages (e.g. dropped peaks) go to monitor of pipeline, without it they are silenced instead of being
+    printed for each chunk. Stages with report=True return tuples, only their dataframes are passed further
+    :param pipeline: Pipeline - pipeline with row-local stages, its cache isn't used
+    :param source: str - csv or parquet file or directory with table stored by save_peak_table
+    :param destination: str - csv or parquet file for result
+    :param chunksize: int - number of peaks in chunk
+    :return: (int, int) - number of peaks in source and in destination
+    """
+    for stage in pipeline.stages:
+        if not is_row_local(stage):
+            raise ValueError(f'Stage {stage.name} needs the whole table and can not be streamed')
+
+    monitor = pipeline.monitor or Monitor()
+    read, write = 0, 0
+    with ChunkWriter(destination) as writer:
+        for chunk in read_chunks(source, chunksize):
+            read += len(chunk)
+            # Column groups are the same for all chunks and computed once
+            layout = sample_layout(chunk)
+            for stage in pipeline.stages:
+                params = dict(stage.params)
+                if 'layout' in inspect.signature(stage.function).parameters:
+                    params.setdefault('layout', layout)
+                if 'monitor' in inspect.signature(stage.function).parameters:
+                    params.setdefault('monitor', monitor)
+                chunk = pipeline.function(stage)(chunk, **params)
+                if isinstance(chunk, tuple):
+                    chunk = chunk[0]
+            write += len(chunk)
+            writer.write(chunk)
+    return read, write
+
+
+def is_row_local(stage):
+    """
+    Check whether stage processes each peak independently
+    :param stage: Stage - stage of pipeline
+    :return: bool - whether stage could be applied to chunks of peak table
+    """
+    if stage.function is substitute_na:
+        return stage.params.get('method', 'half_min') in row_local_imputers
+    return stage.function in row_local_functions
+
+
+def read_chunks(source, chunksize=10000):
+    """
+    Read peak table by chunks of rows
+    :param source: str - csv or parquet file or directory with table stored by save_peak_table
+    :param chunksize: int - number of peaks in chunk
+    :return: generator - dataframes with consecutive peaks
+    """
+    if os.path.isdir(source):
+        yield from read_stored_chunks(source, chunksize)
+    elif source.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, index_col=0, chunksize=chunksize)
+
+
+def read_stored_chunks(path, chunksize=10000):
+    """
+    Read peak table stored by save_peak_table by chunks of rows, intensities are taken from memory-mapped matrix
+    :param path: str - directory with stored table
+    :param chunksize: int - number of peaks in chunk
+    :return: generator - dataframes with consecutive peaks
+    """
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    description = describe_table(path)
+    name = os.path.join(path, f'table.{description["format"]}')
+    intensities = load_intensities(path)
+
+    # Feather file is memory-mapped as well, parquet one is read by batches
+    if description['format'] == 'feather':
+        table = feather.read_table(name, memory_map=True)
+        batches = (table.slice(start, chunksize) for start in range(0, table.num_rows, chunksize))
+    else:
+        batches = pq.ParquetFile(name).iter_batches(batch_size=chunksize)
+
+    start = 0
+    for batch in batches:
+        annotation = batch.to_pandas().set_index(INDEX)
+        annotation.index.name = description['index']
+        block = np.asarray(intensities[start:start + len(annotation)])
+        chunk = pd.concat([annotation, pd.DataFrame(block, index=annotation.index, columns=description['samples'])],
+                          axis=1)
+        start += len(annotation)
+        yield chunk[description['columns']]
+
+
+class ChunkWriter:
+    """
+    Append chunks of peak table to csv or parquet file
+    Schema of parquet file is pinned by the first chunk and the following ones are cast to it, annotation columns
+    without values in the first chunk are written as strings since their type can't be inferred from it
+    """
+    def __init__(self, destination):
+        """
+        :param destination: str - csv or parquet file, it is overwritten
+        """
+        self.destination = destination
+        self.writer = None
+        self.started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.writer is not None:
+            self.writer.close()
+
+    def write(self, chunk):
+        """
+        Append chunk to file
+        :param chunk: df - part of peak table
+        :return:
+        """
+        if self.destination.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.destination, pinned_schema(table, sample_layout(chunk).samples))
+            self.writer.write_table(cast_table(table, self.writer.schema))
+        else:
+            chunk.to_csv(self.destination, mode='a' if self.started else 'w', header=not self.started)
+        self.started = True
+
+
+def pinned_schema(table, samples):
+    """
+    Compute schema of parquet file from its first chunk
+    :param table: pa.Table - the first chunk
+    :param samples: index - intensity columns, they are floating even without values
+    :return: pa.Schema - schema with string type of annotation columns without values
+    """
+    import pyarrow as pa
+    fields = []
+    for field, column in zip(table.schema, table.columns):
+        if column.null_count == len(column) and field.name not in samples and not field.name.startswith('__index'):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def cast_table(table, schema):
+    """
+    Cast chunk to pinned schema of parquet file
+    :param table: pa.Table - chunk
+    :param schema: pa.Schema - schema of file
+    :return: pa.Table - chunk with types of schema
+    """
+    import pyarrow as pa
+    if table.schema.names != schema.names:
+        raise ValueError(f'Columns of chunk {table.schema.names} differ from columns of file {schema.names}')
+    columns = []
+    for field, column in zip(schema, table.columns):
+        try:
+            columns.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as error:
+            raise ValueError(f'Column {field.name} of chunk can not be written as {field.type}: {error}') from error
+    return pa.Table.from_arrays(columns, schema=schema)
@@ -1,36 +1,213 @@
+import warnings
 import numpy as np
 import pandas as pd
-from .column_division import *
+from scipy import stats
+from .column_division import sample_layout, intensity_values
 
 
-# TODO: Other method for filling NAs - 0.5 * min(sample) looks flimsy
-def remove_na_peaks(df, fraction=1):
+def remove_na_peaks(df, fraction=1, layout=None, monitor=None):
     """
-    Remove peaks which have no values in samples and qc. Need predefined constant samples_wo_controls_qc
+    Remove peaks which have no values in samples and qc
     :param df: df - dataframe to clean
     :param fraction: float - threshold of tolerable NA portion for peak
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :param monitor: Monitor - instrumentation which gets number of dropped peaks as event instead of printing
     :return: df - cleaned from empty peaks dataframe
     """
+    layout = layout or sample_layout(df)
+
     # Find peaks which contain NA more than provided fraction in samples and qc
-    too_many_na = df[samples_wo_controls_qc].isna().sum(axis=1) / df[samples_wo_controls_qc].shape[1] > fraction
-    na_peaks = too_many_na[too_many_na].index
+    too_many_na = np.isnan(intensity_values(df[layout.samples_wo_controls_qc])).mean(axis=1) > fraction
 
-    # Some informative message about number of dropped peaks to stdout
-    print(f'Number of dropped peaks is: {len(na_peaks)}')
+    # Some informative message about number of dropped peaks to monitor or stdout
+    if monitor is not None:
+        monitor.event('na_peaks_dropped', dropped=int(too_many_na.sum()))
+    else:
+        print(f'Number of dropped peaks is: {too_many_na.sum()}')
 
     # Get rid of these peaks
-    df = df.drop(na_peaks)
+    df = df[~too_many_na]
     return df
 
 
-def substitute_na(df):
+def substitute_na(df, method='half_min', layout=None, **params):
     """
-    Substitute NA with values. Need predefined constant samples_wo_controls_qc
+    Substitute NA with values in samples and qc
     :param df: df - dataframe to clean
+    :param method: str or function - name of imputer from imputers or function which takes float array
+                                     peaks X samples with NA and returns array without them
+    :param layout: SampleLayout - groups of df columns, computed from df if not provided
+    :param params: dict - keyword parameters to imputer
     :return: df - dataframe with values in sample area
     """
+    layout = layout or sample_layout(df)
+    imputer = imputers[method] if isinstance(method, str) else method
     df = df.copy()
 
-    # Fill NA with 0.5 * min(sample) in columns with intensities
-    df[samples_wo_controls_qc] = df[samples_wo_controls_qc].apply(lambda xs: xs.fillna(xs.min() / 2), axis=1)
+    # Fill NA in columns with intensities
+    intensities = intensity_values(df[layout.samples_wo_controls_qc])
+    df[layout.samples_wo_controls_qc] = imputer(intensities, **params)
     return df
+
+
+def impute_half_min(intensities):
+    """
+    Fill NA with 0.5 * min(peak)
+    :param intensities: array - intensities peaks X samples
+    :return: array - intensities without NA (except peaks without any value)
+    """
+    # Peaks without values stay NA
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        minima = np.nanmin(intensities, axis=1, keepdims=True)
+    return np.where(np.isnan(intensities), minima / 2, intensities)
+
+
+def impute_quantile(intensities, q=0.01):
+    """
+    Fill NA with some low quantile of observed intensities of peak
+    :param intensities: array - intensities peaks X samples
+    :param q: float - quantile of peak intensities
+    :return: array - intensities without NA (except peaks without any value)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        quantiles = np.nanquantile(intensities, q, axis=1, keepdims=True)
+    return np.where(np.isnan(intensities), quantiles, intensities)
+
+
+def impute_qrilc(intensities, tune_sigma=1, seed=0):
+    """
+    Fill NA with random draws from left tail of normal distribution (quantile regression imputation of left-censored
+    data, QRILC). For each sample normal distribution is fitted to quantiles of observed values assuming that missing
+    ones are the lowest, then NA are drawn from its part below the portion of missing values
+    Data is assumed to be log-transformed
+    :param intensities: array - intensities peaks X samples
+    :param tune_sigma: float - multiplier of fitted standard deviation
+    :param seed: int - seed of random generator
+    :return: array - intensities without NA (except samples without any value)
+    """
+    rng = np.random.default_rng(seed)
+    intensities = intensities.copy()
+    missing = np.isnan(intensities)
+
+    for j in np.flatnonzero(missing.any(axis=0)):
+        observed = intensities[~missing[:, j], j]
+        portion = missing[:, j].mean()
+        if observed.size < 2:
+            continue
+
+        # Regress quantiles of observed values on corresponding quantiles of standard normal distribution
+        levels = np.linspace(portion + 0.001, 0.99, 100)
+        sample_quantiles = np.quantile(observed, (levels - portion) / (1 - portion))
+        slope, intercept = np.polyfit(stats.norm.ppf(levels), sample_quantiles, 1)
+        if slope <= 0:
+            continue
+
+        # Draw values from (widened by tune_sigma) distribution truncated at the quantile of missing portion
+        bound = intercept + slope * stats.norm.ppf(portion)
+        scale = slope * tune_sigma
+        intensities[missing[:, j], j] = stats.truncnorm.rvs(-np.inf, (bound - intercept) / scale, loc=intercept,
+                                                            scale=scale, size=missing[:, j].sum(), random_state=rng)
+    return intensities
+
+
+def impute_knn(intensities, k=5, block=1000, candidates=10):
+    """
+    Fill NA with mean value of k nearest peaks which have value in this sample
+    Distances between peaks are euclidean over their common samples scaled to all samples. Peaks are processed in
+    blocks and only nearest candidates are sorted, so memory consumption is about block X number of peaks. Values which
+    have no donors are filled with 0.5 * min(peak)
+    :param intensities: array - intensities peaks X samples
+    :param k: int - number of neighbours
+    :param block: int - number of peaks processed at once
+    :param candidates: int - only candidates * k nearest peaks are sorted at first, their number is increased for peaks
+                             which have less than k donors among them in some sample
+    :return: array - intensities without NA (except peaks without any value)
+    """
+    missing = np.isnan(intensities)
+    present = (~missing).astype(intensities.dtype)
+    values = np.where(missing, intensities.dtype.type(0), intensities)
+    squares = values ** 2
+    imputed = intensities.copy()
+
+    for start in range(0, len(intensities), block):
+        # Only peaks with NA are needed
+        rows = start + np.flatnonzero(missing[start:start + block].any(axis=1))
+        if not rows.size:
+            continue
+
+        # Euclidean distances over common samples of block peaks and all peaks
+        common = present[rows] @ present.T
+        distances = squares[rows] @ present.T + present[rows] @ squares.T - 2 * values[rows] @ values.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.maximum(distances, 0) * (intensities.shape[1] / common)
+        distances[common == 0] = np.inf
+        distances[np.arange(len(rows)), rows] = np.inf
+
+        # Peaks are imputed from sorted nearest candidates, candidates are widened for peaks without enough donors,
+        # so all arrays are at most block X number of peaks
+        pending, nearest = np.arange(len(rows)), candidates * k
+        while pending.size:
+            nearest = min(nearest, len(intensities))
+            pending_distances = distances[pending] if len(pending) < len(rows) else distances
+            order = nearest_peaks(pending_distances, nearest)
+            reachable = np.isfinite(np.take_along_axis(pending_distances, order, axis=1))
+            filled, enough = neighbours_mean(intensities[rows[pending]], order, reachable, missing, values, k)
+
+            # Peak is done if it has k donors in each NA sample or all reachable peaks are among candidates
+            done = enough | ~reachable[:, -1] | (nearest == len(intensities))
+            imputed[rows[pending[done]]] = filled[done]
+            pending, nearest = pending[~done], nearest * 8
+
+    # Values without donors
+    return np.where(np.isnan(imputed), impute_half_min(intensities), imputed)
+
+
+def nearest_peaks(distances, nearest):
+    """
+    Find nearest peaks sorted by distance
+    :param distances: array - distances from peaks to all peaks
+    :param nearest: int - number of nearest peaks
+    :return: array - positions of nearest peaks for each peak in ascending order of distance
+    """
+    if nearest < distances.shape[1]:
+        order = np.argpartition(distances, nearest - 1, axis=1)[:, :nearest]
+    else:
+        order = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    return np.take_along_axis(order, np.argsort(np.take_along_axis(distances, order, axis=1), axis=1), axis=1)
+
+
+def neighbours_mean(intensities, order, reachable, missing, values, k=5):
+    """
+    Fill NA of peaks with mean of k first neighbours which have value in the sample
+    Samples are processed one by one, so only peaks X neighbours arrays are created
+    :param intensities: array - intensities of imputed peaks
+    :param order: array - positions of neighbours of imputed peaks sorted by distance
+    :param reachable: array - whether neighbour has common samples with imputed peak
+    :param missing: array - NA mask of all peaks
+    :param values: array - intensities of all peaks with 0 instead of NA
+    :param k: int - number of neighbours
+    :return: (array, array) - intensities of imputed peaks with NA where there are no donors and whether each peak has
+    k donors in all its NA samples
+    """
+    imputed = intensities.copy()
+    enough = np.ones(len(intensities), dtype='bool')
+    # For each sample take k nearest peaks which have value in it
+    for j in np.flatnonzero(np.isnan(intensities).any(axis=0)):
+        need = np.isnan(intensities[:, j])
+        neighbours = order[need]
+        donors = ~missing[neighbours, j] & reachable[need]
+        counts = np.cumsum(donors, axis=1)
+        donors &= counts <= k
+        enough[need] &= counts[:, -1] >= k
+        with np.errstate(divide='ignore', invalid='ignore'):
+            imputed[need, j] = (values[neighbours, j] * donors).sum(axis=1) / donors.sum(axis=1)
+    return imputed, enough
+
+
+# Imputers available by name in substitute_na
+imputers = {'half_min': impute_half_min,
+            'quantile': impute_quantile,
+            'qrilc': impute_qrilc,
+            'knn': impute_knn}
@@ -1,12 +1,19 @@
 import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
-from sklearn.manifold import MDS
+from sklearn.manifold import smacof
+from scipy.linalg import eigh
 import matplotlib.pyplot as plt
+from ..processing_dataset.lipid_matrix import LipidMatrix, sample_matrix, find_diff
+from ..processing_dataset.sample_index import sample_index
 
 
-def reduce_dimensions(df, analysis, species, separation_feature, functions, included_variants, excluded_variants={}, with_mass=True):
+def reduce_dimensions(df, analysis, species, separation_feature, functions, included_variants, excluded_variants={}, with_mass=True,
+                      index=None):
     """
     Top function to perform dimensionality reduction, plot graph and save figure
     :param df: df - dataframe merged with metadata
@@ -17,17 +24,20 @@ def reduce_dimensions(df, analysis, species, separation_feature, functions, incl
     :param included_variants: dict - dictionary with selected feature: variant for analysis
     :param excluded_variants: dict - dictionary with excluded feature: variant from analysis
     :param with_mass: bool - whether to take samples without mass in the analysis
+    :param index: SampleIndex - encoded metadata of df samples, computed from df if not provided
     :return:
     """
     # Create title
     title = construct_title(analysis, species, included_variants, separation_feature, with_mass)
 
-    # Take appropriate subset of data
-    ss = subset(df, included_variants, excluded_variants, with_mass=with_mass)
+    # Take positions of appropriate subset of data
+    index = index or sample_index(df)
+    positions = index.positions(included_variants, excluded_variants, with_mass)
 
     # Exit function if subset is empty
-    if ss.empty or ss.loc[separation_feature].isna().all():
+    if not positions.size or not index.has_variants(separation_feature, positions):
         return
+    ss = df.iloc[:, positions]
 
     # Extract y and classes for plot
     y, classes = extract_data_for_plot(ss, separation_feature)
@@ -54,33 +64,122 @@ def draw_variants(df, feature, analysis, species, separation_feature, functions,
     variants = df.loc[feature].unique()
     nas = pd.isna(variants)
 
-    # Draw and save plot for each subset of data with particular value of feature
+    # Draw and save plot for each subset of data with particular value of feature, metadata is encoded once
+    index = sample_index(df)
     for variant in variants[~nas]:
         included_variants = {feature: variant}
         reduce_dimensions(df, analysis, species, separation_feature, functions, included_variants, excluded_variants,
-                          with_mass)
+                          with_mass, index)
 
 
-def plot_variants_with_opposite_separations(df, species, functions, analyses=('pca', 'mds'), separations=('tissue', 'age'), excluded={}):
+def plot_variants_with_opposite_separations(df, species, functions, analyses=('pca', 'mds'), separations=('tissue', 'age'), excluded={},
+                                            n_jobs=1, fmt='svg', dpi=150, directory='img'):
     """
     Plot figure for each specified analysis with and without mass for each of 2 features in separations divided by the
     remaining one
+    All figures are planned at first and then fitted and drawn in process pool
     :param df: df - dataframe
     :param species: str - name of species in analysis
-    :param functions: dict - dictionary with name: transformation function
+    :param functions: dict or TransformCache - dictionary with name: transformation function, TransformCache to reuse
+                      results for the same subsets
     :param analyses: iterable - collection with names of analyses, which are in functions container
     :param separations: iterable - collection with 2 names of features used in separation of data in plots
     :param excluded: dict - dictionary with feature: variants to exclude
-    :return:
+    :param n_jobs: int - number of worker processes, 1 to draw everything in current process
+    :param fmt: str - format of figures, 'svg' (with rasterized points) or 'png'
+    :param dpi: int - resolution of raster parts of figures
+    :param directory: str - directory for figures
+    :return: list - names of saved figures
+    """
+    jobs = plan_variants(df, species, analyses, separations, excluded)
+    return render_jobs(df, jobs, functions, n_jobs, fmt=fmt, dpi=dpi, directory=directory)
+
+
+# Figure which should be drawn: analysis, title, positions of columns in subset and feature separated by color
+Job = namedtuple('Job', ['analysis', 'title', 'positions', 'separation_feature'])
+# Dataframe and transformation functions which are shared by all jobs in a process, filled by init_rendering
+shared = {}
+
+
+def plan_variants(df, species, analyses=('pca', 'mds'), separations=('tissue', 'age'), excluded={}):
+    """
+    Collect all figures for plot_variants_with_opposite_separations without fitting anything
+    Subsets which are empty or have no variants of separation feature are skipped
+    :param df: df - dataframe merged with metadata
+    :param species: str - name of species in analysis
+    :param analyses: iterable - collection with names of analyses
+    :param separations: iterable - collection with 2 names of features used in separation of data in plots
+    :param excluded: dict - dictionary with feature: variants to exclude
+    :return: list - Job for each figure
     """
+    index = sample_index(df)
+    jobs = []
     for analysis in analyses:
         for with_mass in [True, False]:
             # 1 feature separated by other and vice versa
-            draw_variants(df, separations[0], analysis, species, separations[1], functions, excluded, with_mass=with_mass)
-            draw_variants(df, separations[1], analysis, species, separations[0], functions, excluded, with_mass=with_mass)
+            for feature, separation_feature in [separations, separations[::-1]]:
+                variants = df.loc[feature].unique()
+                for variant in variants[~pd.isna(variants)]:
+                    included_variants = {feature: variant}
+                    positions = index.positions(included_variants, excluded, with_mass)
+                    if not positions.size or not index.has_variants(separation_feature, positions):
+                        continue
+                    title = construct_title(analysis, species, included_variants, separation_feature, with_mass)
+                    jobs.append(Job(analysis, title, positions, separation_feature))
+    return jobs
+
+
+def render_jobs(df, jobs, functions, n_jobs=1, **options):
+    """
+    Fit transformation and save figure for each job either in current process or in process pool
+    :param df: df - dataframe merged with metadata
+    :param jobs: list - Job for each figure
+    :param functions: dict - dictionary with name: transformation function, functions should be importable
+                             (defined at module level) to be sent to workers
+    :param n_jobs: int - number of worker processes
+    :param options: dict - keyword parameters to draw_dimensionality_reduction (fmt, dpi, directory)
+    :return: list - names of saved figures in order of jobs
+    """
+    # Current process keeps its backend (e.g. inline one in notebooks) and forgets shared data after rendering
+    if n_jobs == 1:
+        init_rendering(df, functions, backend=None)
+        try:
+            return [render_job(job, **options) for job in jobs]
+        finally:
+            shared.clear()
+
+    # Dataframe is passed to every worker only once by initializer
+    with ProcessPoolExecutor(n_jobs, initializer=init_rendering, initargs=(df, functions)) as pool:
+        return list(pool.map(partial(render_job, **options), jobs))
 
 
-def transforming(analysis, functions, ss, title, y, classes):
+def init_rendering(df, functions, backend='Agg'):
+    """
+    Prepare process for rendering: switch matplotlib to non-interactive backend and keep shared data
+    :param df: df - dataframe merged with metadata
+    :param functions: dict - dictionary with name: transformation function
+    :param backend: str - matplotlib backend of worker process, None to keep current one
+    :return:
+    """
+    if backend is not None:
+        plt.switch_backend(backend)
+    shared['df'] = df
+    shared['functions'] = functions
+
+
+def render_job(job, **options):
+    """
+    Fit transformation of job subset and save its figure
+    :param job: Job - figure to draw
+    :param options: dict - keyword parameters to draw_dimensionality_reduction
+    :return: str - name of saved figure
+    """
+    ss = shared['df'].iloc[:, job.positions]
+    y, classes = extract_data_for_plot(ss, job.separation_feature)
+    return transforming(job.analysis, shared['functions'], ss, job.title, y, classes, **options)
+
+
+def transforming(analysis, functions, ss, title, y, classes, **options):
     """
     Perform appropriate transformation and plotting, save figure
     :param analysis: str - name of analysis, e.g. pca or mds
@@ -89,20 +188,23 @@ def transforming(analysis, functions, ss, title, y, classes):
     :param title: str - title of plot and name of file
     :param y: sequence - collection of observation labels e.g. old/young for age, bones/blood for tiessue etc.
     :param classes: sequence - container with unique labels of observations
-    :return:
+    :param options: dict - keyword parameters to draw_dimensionality_reduction (fmt, dpi, directory)
+    :return: str - name of saved figure
     """
     # Depending on analysis extract additional data
     if analysis == 'pca':
         transformed, (var1, var2) = functions[analysis](ss)
         # Draw and save plot
-        draw_dimensionality_reduction(title, transformed, y, classes, title=title, var1=var1, var2=var2)
+        return draw_dimensionality_reduction(title, transformed, y, classes, title=title, var1=var1, var2=var2,
+                                             **options)
     else:
         transformed = functions[analysis](ss)
         # Draw and save plot
-        draw_dimensionality_reduction(title, transformed, y, classes, title=title)
+        return draw_dimensionality_reduction(title, transformed, y, classes, title=title, **options)
 
 
-def draw_dimensionality_reduction(name, transformed, y, classes, colors=None, title='PCA', var1=0, var2=0, locus='best'):
+def draw_dimensionality_reduction(name, transformed, y, classes, colors=None, title='PCA', var1=0, var2=0, locus='best',
+                                  fmt='svg', dpi=150, directory='img'):
     """
     Plot results of dimensionality collapsing
     :param name: str - name of saved figure
@@ -114,37 +216,43 @@ def draw_dimensionality_reduction(name, transformed, y, classes, colors=None, ti
     :param var1: float - portion of explained variance by PC1
     :param var2: float - portion of explained variance by PC1
     :param locus: str - position of legend
-    :return:
+    :param fmt: str - 'svg' with rasterized points and vector text and axes or 'png'
+    :param dpi: int - resolution of png or of rasterized points in svg
+    :param directory: str - directory for figures
+    :return: str - name of saved figure
     """
     # Specify plot size
-    plt.figure(figsize=(12, 8))
+    fig, ax = plt.subplots(figsize=(12, 8))
 
-    # Use specified colors if provided
+    # Use specified colors if provided, points are rasterized to keep svg small
     if colors:
         for sp, color in zip(classes, colors):
-            plt.scatter(transformed[sp == y, 0],
-                        transformed[sp == y, 1],
-                        alpha=0.8, color=color, label=sp)
+            ax.scatter(transformed[sp == y, 0],
+                       transformed[sp == y, 1],
+                       alpha=0.8, color=color, label=sp, rasterized=True)
     else:
         for sp in classes:
-            plt.scatter(transformed[sp == y, 0],
-                        transformed[sp == y, 1],
-                        alpha=0.8, label=sp)
+            ax.scatter(transformed[sp == y, 0],
+                       transformed[sp == y, 1],
+                       alpha=0.8, label=sp, rasterized=True)
 
     # Metadata
     # For pca plot add axis labels with explained variance portion
     if 'PCA' in title:
         xlab = f'PC1, {var1}'
         ylab = f'PC2, {var2}'
-        plt.xlabel(xlab)
-        plt.ylabel(ylab)
+        ax.set_xlabel(xlab)
+        ax.set_ylabel(ylab)
 
-    plt.legend(loc=locus, shadow=False)
-    plt.title(title)
+    ax.legend(loc=locus, shadow=False)
+    ax.set_title(title)
 
-    # Create dir for images and save svg image
-    os.makedirs('img', exist_ok=True)
-    plt.savefig(f'img/{name}.svg', format='svg', bbox_inches='tight')
+    # Create dir for images and save image, figure is closed to free memory in long runs
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f'{name}.{fmt}')
+    fig.savefig(filename, format=fmt, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return filename
 
 
 def construct_title(analysis, species, included_variants, separation_feature, with_mass):
@@ -192,82 +300,217 @@ def extract_data_for_plot(df, sample_feature):
     return y, classes
 
 
-def pca_transform(df, n_components=2):
+def pca_transform(df, n_components=2, solver='full', loadings=False, block=5000, seed=0, dtype=None):
     """
     Transform data for PCA
-    meta constant should be predefined
-    :param df: df - subset of dataframe merged with metadata
+    :param df: LipidMatrix, df or array - matrix, subset of dataframe merged with metadata or intensities peaks X samples
+                                          (e.g. memory-mapped by load_intensities)
     :param n_components: int - number of components
-    :return: array - np array with number of samples x n_components shape
+    :param solver: str - 'full' for exact SVD, 'randomized' for randomized truncated SVD of wide data, 'incremental'
+                         for exact PCA which reads intensities by blocks of peaks and keeps only samples X samples
+                         matrix in memory
+    :param loadings: bool - whether to return loadings of peaks too
+    :param block: int - number of peaks in block for 'incremental' solver
+    :param seed: int - seed of random generator for 'randomized' solver
+    :param dtype: str - type of intensities, e.g. 'float32' for single precision of dataframe merged with metadata,
+                        type of intensities by default (see sample_matrix)
+    :return: (array, tuple) or (array, tuple, df) - np array with number of samples x n_components shape, portions of
+    explained variance and if loadings is True dataframe peaks X n_components with weights of peaks in components
     """
+    if solver == 'incremental':
+        return incremental_pca(df, n_components, loadings, block, dtype)
+    elif solver not in ('full', 'randomized'):
+        raise ValueError(f'Unknown PCA solver: {solver}')
+
     # Initialize transformer
-    pca = PCA(n_components=n_components)
+    pca = PCA(n_components=n_components, svd_solver=solver, random_state=seed if solver == 'randomized' else None)
     # Take numeric subset of data and
     # Transpose df, because as we love in ml ROWS are observations and COLUMNS are features and
     # all normal functions follow this convention. Thus we finally transpose df to normal form
-    transformed = pca.fit_transform(df.iloc[:-meta].T)
+    transformed = pca.fit_transform(np.asarray(df, dtype=dtype).T if isinstance(df, np.ndarray) else
+                                    sample_matrix(df, dtype))
 
     # Get info about variance percentages
     variance = pca.explained_variance_ratio_
+    if loadings:
+        return transformed, tuple(map(lambda x: np.round(x, 2), variance)), peak_loadings(df, pca.components_.T)
     return transformed, tuple(map(lambda x: np.round(x, 2), variance))
 
 
-def mds_transform(df, n_components=2):
+def incremental_pca(df, n_components=2, loadings=False, block=5000, dtype=None):
+    """
+    Perform exact PCA by blocks of peaks: covariance matrix of samples is accumulated over blocks, its
+    eigendecomposition gives coordinates of samples, loadings are computed by the second pass over blocks
+    Memory consumption is about block X number of samples besides samples X samples matrix
+    :param df: LipidMatrix, df or array - matrix, subset of dataframe merged with metadata or intensities peaks X samples
+    :param n_components: int - number of components
+    :param loadings: bool - whether to return loadings of peaks too
+    :param block: int - number of peaks in block
+    :param dtype: str - type of intensities, type of intensities of df by default
+    :return: (array, tuple) or (array, tuple, df) - the same as pca_transform
+    """
+    # Each block is centered by means of its own peaks, so sum of blocks products is covariance of centered samples
+    n_samples = next(peak_blocks(df, 1, dtype)).shape[1]
+    gram = np.zeros((n_samples, n_samples))
+    total = 0
+    for intensities in peak_blocks(df, block, dtype):
+        centered = intensities - intensities.mean(axis=1, keepdims=True)
+        gram += centered.T @ centered
+        total += (centered ** 2).sum()
+
+    # Leading eigenvectors in descending order with fixed signs
+    n_components = min(n_components, n_samples)
+    values, vectors = eigh(gram, subset_by_index=[n_samples - n_components, n_samples - 1])
+    values, vectors = np.maximum(values[::-1], 0), vectors[:, ::-1]
+    vectors *= np.sign(vectors[np.abs(vectors).argmax(axis=0), np.arange(n_components)])
+    singular = np.sqrt(values)
+    transformed = (vectors * singular).astype(intensities.dtype, copy=False)
+    variance = tuple(map(lambda x: np.round(x, 2), values / total))
+    if not loadings:
+        return transformed, variance
+
+    # Weights of peaks are projections of centered peaks on coordinates of samples
+    with np.errstate(divide='ignore', invalid='ignore'):
+        components = np.concatenate([(intensities - intensities.mean(axis=1, keepdims=True)) @ vectors / singular
+                                     for intensities in peak_blocks(df, block, dtype)])
+    return transformed, variance, peak_loadings(df, components)
+
+
+def peak_blocks(df, block=5000, dtype=None):
+    """
+    Generate intensities by consecutive blocks of peaks
+    :param df: LipidMatrix, df or array - matrix, subset of dataframe merged with metadata or intensities peaks X samples
+    :param block: int - number of peaks in block
+    :param dtype: str - type of intensities, type of intensities of df by default
+    :return: generator - float arrays block X samples
+    """
+    if isinstance(df, LipidMatrix):
+        intensities = df.intensities
+    elif isinstance(df, np.ndarray):
+        intensities = df
+    else:
+        intensities = sample_matrix(df, dtype).T
+    for start in range(0, len(intensities), block):
+        yield np.asarray(intensities[start:start + block], dtype=dtype)
+
+
+def peak_loadings(df, components):
+    """
+    Label loadings of peaks by their names
+    :param df: LipidMatrix, df or array - matrix, subset of dataframe merged with metadata or intensities peaks X samples
+    :param components: array - weights of peaks peaks X components
+    :return: df - loadings peaks X components with columns PC1, PC2 etc.
+    """
+    if isinstance(df, LipidMatrix):
+        peaks = df.peaks.index
+    elif isinstance(df, np.ndarray):
+        peaks = pd.RangeIndex(len(df))
+    else:
+        peaks = df.index[:df.shape[0] - find_diff(df)]
+    return pd.DataFrame(components, index=peaks, columns=[f'PC{i + 1}' for i in range(components.shape[1])])
+
+
+def top_loadings(loadings, component='PC1', n=20):
     """
-    Transform data for MDS, meta constant should be predefined
-    :param df: df - subset of dataframe merged with metadata
+    Take peaks which contribute to component most of all
+    :param loadings: df - loadings peaks X components from pca_transform
+    :param component: str - name of component
+    :param n: int - number of peaks
+    :return: series - loadings of top peaks sorted by absolute value
+    """
+    return loadings[component].loc[loadings[component].abs().nlargest(n).index]
+
+
+def mds_transform(df, n_components=2, method='classical', distances=None, max_iter=300, dtype=None):
+    """
+    Transform data for MDS
+    :param df: LipidMatrix or df - matrix or subset of dataframe merged with metadata
     :param n_components: int - number of components
+    :param method: str - 'classical' for Torgerson MDS (deterministic and fast) or 'smacof' for metric MDS with
+                         iterative SMACOF started from classical solution
+    :param distances: df - euclidean distances between samples of the whole dataset (from sample_distances), distances
+                           of subset are taken from it instead of computing them
+    :param max_iter: int - maximal number of SMACOF iterations
+    :param dtype: str - type of intensities for distances which are not provided (see sample_matrix)
     :return: array - np array with number of samples x n_components shape
     """
-    # Initialize transformer
-    mds = MDS(n_components=n_components, n_jobs=-1)
-    # Take numeric subset of data and
-    # Transpose df, because as we love in ml ROWS are observations and COLUMNS are features and
-    # all normal functions follow this convention. Thus we finally transpose df to normal form
-    transformed = mds.fit_transform(df.iloc[:-meta].T)
+    # Take distances between selected samples
+    samples = df.samples.index if isinstance(df, LipidMatrix) else df.columns
+    if distances is None:
+        distances = sample_distances(df, dtype)
+    distances = distances.loc[samples, samples].to_numpy()
+
+    transformed = classical_mds(distances, n_components)
+    if method == 'smacof':
+        transformed = smacof(distances.astype('float64'), metric=True, n_components=n_components, init=transformed,
+                             n_init=1, max_iter=max_iter)[0].astype(distances.dtype, copy=False)
+    elif method != 'classical':
+        raise ValueError(f'Unknown method of MDS: {method}')
     return transformed
 
 
-def subset(df, include, exclude={}, with_mass=with_mass):
+def classical_mds(distances, n_components=2):
     """
-    Take appropriate slice of data, use samples_with_mass constant which should be predefined.
-    At least one of include and exclude should be provided, could be both
-    :param df: df - dataframe merged with metadata
+    Perform classical (Torgerson) MDS - eigendecomposition of double centered matrix of squared distances
+    Only the largest n_components eigenvalues are computed. Signs of components are fixed, so results are reproducible
+    :param distances: array - symmetric matrix of distances between samples
+    :param n_components: int - number of components
+    :return: array - np array with number of samples x n_components shape
+    """
+    n = len(distances)
+    n_components = min(n_components, n)
+    # Double centering of squared distances gives Gram matrix of centered samples
+    squares = distances ** 2
+    gram = -0.5 * (squares - squares.mean(axis=0) - squares.mean(axis=1)[:, np.newaxis] + squares.mean())
+    values, vectors = eigh(gram, subset_by_index=[n - n_components, n - 1])
+
+    # Components in descending order, negative eigenvalues correspond to non-euclidean part and are dropped
+    values, vectors = values[::-1], vectors[:, ::-1]
+    vectors *= np.sign(vectors[np.abs(vectors).argmax(axis=0), np.arange(n_components)])
+    return vectors * np.sqrt(np.maximum(values, 0))
+
+
+def sample_distances(df, dtype=None):
+    """
+    Compute euclidean distances between all samples once, so subsets could take them by mds_transform
+    :param df: LipidMatrix or df - matrix or dataframe merged with metadata
+    :param dtype: str - type of intensities, e.g. 'float32', see sample_matrix
+    :return: df - symmetric dataframe samples X samples
+    """
+    samples = df.samples.index if isinstance(df, LipidMatrix) else df.columns
+    matrix = sample_matrix(df, dtype)
+    # |x - y|^2 = |x|^2 + |y|^2 - 2xy, all products are computed by one matrix multiplication
+    norms = np.einsum('ij,ij->i', matrix, matrix)
+    squares = np.maximum(norms[:, np.newaxis] + norms - 2 * matrix @ matrix.T, 0)
+    np.fill_diagonal(squares, 0)
+    return pd.DataFrame(np.sqrt(squares), index=samples, columns=samples)
+
+
+def dataset_mds(df, **params):
+    """
+    Create mds function for functions dict which takes distances of subsets from distances of the whole dataset
+    :param df: LipidMatrix or df - matrix or dataframe merged with metadata
+    :param params: dict - keyword parameters to mds_transform, e.g. method
+    :return: function - mds_transform with precomputed distances
+    """
+    return partial(mds_transform, distances=sample_distances(df, params.get('dtype')), **params)
+
+
+def subset(df, include, exclude={}, with_mass=True, index=None):
+    """
+    Take appropriate slice of data. At least one of include and exclude should be provided, could be both
+    Samples are selected by positions from index, df itself isn't copied or compared
+    :param df: LipidMatrix or df - matrix or dataframe merged with metadata
     :param include: dict - dictionary with feature: variant to include variant of feature from output df
                            other appropriate format is feature: [variants] to include all listed variants
     :param exclude: dict - dictionary with feature: variant to exclude variant of feature from output df
                            other appropriate format is feature: [variants] to exclude all listed variants
     :param with_mass: boolean - whether to exclude samples without known mass,
                                 idk why I have included this option - it always should be True
-    :return: (series, array) - tuple with row of given feature from input array and array with unique values in this
-                               series
-    """
-    # Create a copy of original df
-    df = df.copy()
-    # Initialize condition with neutral element
-    cond = True
-
-    # For features in include add to condition appropriate columns
-    for feature, variant in include.items():
-        # Add single variant
-        if type(variant) is str:
-            cond &= (df.loc[feature] == variant)
-        # Add several variants
-        else:
-            cond &= df.loc[feature].isin(variant)
-
-    # For features in include add to condition appropriate columns
-    for feature, variant in exclude.items():
-        # Remove single variant
-        if type(variant) is str:
-            cond &= (df.loc[feature] != variant)
-        # Remove several variants
-        else:
-            cond &= ~df.loc[feature].isin(variant)
-
-    # Imho this condition is always true, hence with_mass parameter should be removed
-    # Take only columns with present mass
-    if with_mass:
-        return df.loc[:, cond & samples_with_mass]
-    # Take all selected columns
-    return df.loc[:, cond]
+    :param index: SampleIndex - encoded metadata of df samples, computed from df if not provided
+    :return: LipidMatrix or df - selected samples
+    """
+    positions = (index or sample_index(df)).positions(include, exclude, with_mass)
+    if isinstance(df, LipidMatrix):
+        return df.select_samples(positions)
+    return df.iloc[:, positions]
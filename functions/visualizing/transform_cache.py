@@ -0,0 +1,148 @@
+import os
+import pickle
+import hashlib
+import inspect
+from collections import OrderedDict
+from functools import partial
+import numpy as np
+import pandas as pd
+from ..processing_dataset.lipid_matrix import LipidMatrix, sample_matrix
+
+
+class TransformCache:
+    """
+    Memoized transformation functions, drop-in replacement of functions dict in plotting functions of pca module
+    Results (embedding and explained variance for pca) are kept in LRU cache in memory and optionally in directory, so
+    the same subset of samples is fitted only once, also between runs
+    """
+    def __init__(self, functions, maxsize=128, cache_dir=None):
+        """
+        :param functions: dict - dictionary with name: transformation function, e.g. pca_transform
+        :param maxsize: int - number of results kept in memory
+        :param cache_dir: str - directory for results on disk, None to keep them only in memory
+        """
+        self.functions = functions
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.results = OrderedDict()
+
+    def __getitem__(self, analysis):
+        return partial(self.transform, analysis)
+
+    def __contains__(self, analysis):
+        return analysis in self.functions
+
+    def keys(self):
+        return self.functions.keys()
+
+    def transform(self, analysis, data, n_components=2, **params):
+        """
+        Get result of transformation from cache or compute it
+        :param analysis: str - name of analysis in functions
+        :param data: LipidMatrix or df - matrix or subset of dataframe merged with metadata
+        :param n_components: int - number of components
+        :param params: dict - other keyword parameters to transformation function
+        :return: result of transformation function
+        """
+        key = self.key(analysis, data, n_components, params)
+
+        # Look in memory and then on disk
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+        if self.cache_dir is not None and os.path.exists(self.path(analysis, key)):
+            with open(self.path(analysis, key), 'rb') as f:
+                result = pickle.load(f)
+        else:
+            result = self.functions[analysis](data, n_components=n_components, **params)
+            if self.cache_dir is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.path(analysis, key), 'wb') as f:
+                    pickle.dump(result, f)
+
+        # Forget the least recently used result
+        self.results[key] = result
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+        return result
+
+    def key(self, analysis, data, n_components, params):
+        """
+        Compute cache key of transformation, the key depends on function registered under analysis name too
+        :param analysis: str - name of analysis in functions
+        :param data: LipidMatrix or df - matrix or subset of dataframe merged with metadata
+        :param n_components: int - number of components
+        :param params: dict - other keyword parameters to transformation function
+        :return: str - hex digest
+        """
+        digest = hashlib.sha1(repr((analysis, n_components, sorted(params.items()))).encode())
+        digest.update(function_identity(self.functions[analysis]).encode())
+        digest.update(subset_hash(data).encode())
+        return digest.hexdigest()
+
+    def path(self, analysis, key):
+        """
+        Get path of cached result
+        :param analysis: str - name of analysis in functions
+        :param key: str - cache key of transformation
+        :return: str - path to file
+        """
+        return os.path.join(self.cache_dir, f'{analysis}_{key}.pkl')
+
+    def clear(self):
+        """
+        Forget results kept in memory, files on disk are not removed
+        :return:
+        """
+        self.results.clear()
+
+
+def subset_hash(data):
+    """
+    Compute hash of selected samples and their intensities
+    Intensities are hashed together with names of samples, so cache on disk is not reused after reprocessing of data
+    :param data: LipidMatrix or df - matrix or subset of dataframe merged with metadata
+    :return: str - hex digest
+    """
+    samples = data.samples.index if isinstance(data, LipidMatrix) else data.columns
+    matrix = np.ascontiguousarray(sample_matrix(data))
+    digest = hashlib.sha1(repr(list(map(str, samples))).encode())
+    digest.update(str(matrix.dtype).encode())
+    digest.update(matrix.tobytes())
+    return digest.hexdigest()
+
+
+def function_identity(function):
+    """
+    Describe transformation function for cache key: qualified name and hash of source, for partial functions also
+    their bound arguments, so results aren't reused after function is replaced or its parameters are changed
+    :param function: function - transformation function, e.g. pca_transform or partial of mds_transform
+    :return: str - description of function
+    """
+    if isinstance(function, partial):
+        arguments = [argument_identity(argument) for argument in function.args]
+        arguments += [f'{name}={argument_identity(value)}' for name, value in sorted(function.keywords.items())]
+        return f'{function_identity(function.func)}({", ".join(arguments)})'
+
+    name = f'{getattr(function, "__module__", None)}.{getattr(function, "__qualname__", repr(function))}'
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        source = ''
+    return f'{name}:{hashlib.sha1(source.encode()).hexdigest()}'
+
+
+def argument_identity(value):
+    """
+    Describe bound argument of function, arrays and dataframes (e.g. precomputed distances) are described by content
+    :param value: object - argument
+    :return: str - description of argument
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        hashed = pd.util.hash_pandas_object(value, index=True).to_numpy()
+        columns = repr(list(value.columns)) if isinstance(value, pd.DataFrame) else ''
+        return hashlib.sha1(hashed.tobytes() + columns.encode()).hexdigest()
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(str(value.dtype).encode() + repr(value.shape).encode()
+                            + np.ascontiguousarray(value).tobytes()).hexdigest()
+    return repr(value)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table, synthetic_metadata, anova_frame
+from functions.analysis.anova import anova_for_all_peaks_vs_some_variables
+
+
+@pytest.fixture(scope='module')
+def frame():
+    metadata = synthetic_metadata(40)
+    table = synthetic_peak_table(200, 40).dropna(subset=list(metadata.index)).iloc[:30]
+    df = anova_frame(table, metadata)
+    # NA with different patterns in several peaks
+    rng = np.random.default_rng(0)
+    for peak in df.columns[:10]:
+        df.loc[rng.choice(df.index, 5, replace=False), peak] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('interaction', ['no', 'double', 'multiple'])
+def test_matrix_anova_agrees_with_statsmodels(frame, interaction):
+    expected = anova_for_all_peaks_vs_some_variables(frame, ['tissue', 'age'], interaction, method='statsmodels')
+    observed = anova_for_all_peaks_vs_some_variables(frame, ['tissue', 'age'], interaction, method='matrix')
+    assert list(observed.index) == list(expected.index)
+    np.testing.assert_allclose(observed.to_numpy(), expected.loc[:, observed.columns].to_numpy(), rtol=1e-8)
+
+
+@pytest.mark.parametrize('interaction', ['no', 'double'])
+def test_matrix_anova_with_empty_cell(frame, interaction):
+    # Samples of one tissue and age combination are absent
+    df = frame[~((frame['tissue'] == 'brain') & (frame['age'] == 'old'))]
+    expected = anova_for_all_peaks_vs_some_variables(df, ['tissue', 'age'], interaction, method='statsmodels')
+    observed = anova_for_all_peaks_vs_some_variables(df, ['tissue', 'age'], interaction, method='matrix')
+    np.testing.assert_allclose(observed.to_numpy(), expected.loc[:, observed.columns].to_numpy(), rtol=1e-8)
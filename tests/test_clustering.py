@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist
+from functions.analysis import clustering
+from functions.analysis.clustering import hierarchical_clustering, condensed_distances
+
+
+@pytest.fixture
+def intensities():
+    clustering.linkages.clear()
+    return np.random.default_rng(0).normal(size=(120, 15))
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'correlation'])
+def test_blocked_distances_agree_with_pdist(intensities, metric):
+    np.testing.assert_allclose(condensed_distances(intensities, metric, block=7), pdist(intensities, metric),
+                               atol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['average', 'complete', 'single', 'ward'])
+@pytest.mark.parametrize('axis', ['samples', 'peaks'])
+def test_linkage_agrees_with_scipy(intensities, method, axis):
+    observations = intensities.T if axis == 'samples' else intensities
+    expected = hierarchy.linkage(pdist(observations), method=method)
+    result = hierarchical_clustering(intensities, axis, method, block=16)
+    np.testing.assert_allclose(result.linkage[:, 2], expected[:, 2], rtol=1e-10)
+    np.testing.assert_allclose(hierarchy.cophenet(result.linkage), hierarchy.cophenet(expected), rtol=1e-10)
+    pd.testing.assert_index_equal(result.labels, pd.RangeIndex(len(observations)))
+
+
+def test_linkage_cache(intensities, tmp_path):
+    first = hierarchical_clustering(intensities, 'peaks', cache_dir=str(tmp_path))
+    assert hierarchical_clustering(intensities, 'peaks').linkage is first.linkage
+    # Other parameters or data are computed again, the least recently used linkages are forgotten
+    assert hierarchical_clustering(intensities, 'peaks', 'complete').linkage is not first.linkage
+    for i in range(clustering.max_linkages):
+        hierarchical_clustering(intensities + i + 1, 'peaks')
+    assert len(clustering.linkages) == clustering.max_linkages
+    # Forgotten linkage is loaded from disk
+    reloaded = hierarchical_clustering(intensities, 'peaks', cache_dir=str(tmp_path))
+    assert reloaded.linkage is not first.linkage
+    np.testing.assert_array_equal(reloaded.linkage, first.linkage)
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_clustering_rejects_na(intensities):
+    intensities[3, 4] = np.nan
+    with pytest.raises(ValueError, match='substitute_na'):
+        hierarchical_clustering(intensities)
@@ -0,0 +1,42 @@
+import string
+import numpy as np
+import pandas as pd
+import pytest
+from functions.processing_dataset.label_extraction import create_labels, create_labels_tissue, punct_check, tissues
+
+
+def reference_labels(samples, labs, punct=string.punctuation):
+    # Implementation before automaton: labels are checked one by one for each sample
+    res = []
+    for sample in samples:
+        for lab in labs:
+            if lab in sample.lower():
+                res.append(punct_check(lab, punct))
+                break
+        else:
+            res.append(np.nan)
+    return pd.Series(res, index=list(samples), dtype='object')
+
+
+def assert_same_labels(labels, expected):
+    assert isinstance(labels.dtype, pd.CategoricalDtype)
+    pd.testing.assert_series_equal(labels.astype('object'), expected, check_names=False)
+
+
+def test_tissue_labels_agree_with_reference():
+    rng = np.random.default_rng(0)
+    parts = tissues + ['ms', '01', 'Blank', 'wash', '_', '-', 'x']
+    samples = [''.join(rng.choice(parts, rng.integers(1, 4))).upper() if i % 3 == 0 else
+               '_'.join(rng.choice(parts, rng.integers(1, 4))) for i in range(500)]
+    labels = create_labels_tissue(samples)
+    assert labels.name == 'tissue'
+    assert_same_labels(labels, reference_labels(samples, tissues))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_overlapping_labels_agree_with_reference(seed):
+    # Small alphabet gives labels which are prefixes, suffixes and substrings of each other
+    rng = np.random.default_rng(seed)
+    labs = list(dict.fromkeys(''.join(rng.choice(list('ab.'), rng.integers(1, 5))) for _ in range(15)))
+    samples = [''.join(rng.choice(list('abc.'), rng.integers(0, 12))) for _ in range(300)]
+    assert_same_labels(create_labels(samples, labs), reference_labels(samples, labs))
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table
+from functions.processing_dataset.column_division import sample_layout
+from functions.processing_dataset.merge_features import merge_features
+
+
+def reference_merge_features(df, rule, mz_tolerance, rt_tolerance):
+    # Brute force: all pairs of windows are compared, groups are found by depth first search
+    samples = sample_layout(df).samples
+    mzmin = df['mzmin'].to_numpy() * (1 - mz_tolerance * 1e-6)
+    mzmax = df['mzmax'].to_numpy() * (1 + mz_tolerance * 1e-6)
+    rtmin, rtmax = df['rtmin'].to_numpy() - rt_tolerance, df['rtmax'].to_numpy() + rt_tolerance
+    overlap = ((np.maximum.outer(mzmin, mzmin) <= np.minimum.outer(mzmax, mzmax))
+               & (np.maximum.outer(rtmin, rtmin) <= np.minimum.outer(rtmax, rtmax)))
+    groups, seen = [], set()
+    for start in range(len(df)):
+        if start in seen:
+            continue
+        group, stack = [], [start]
+        seen.add(start)
+        while stack:
+            feature = stack.pop()
+            group.append(feature)
+            for other in np.flatnonzero(overlap[feature]):
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        groups.append(sorted(group))
+
+    rows, features = [], pd.Series(index=df.index, dtype='object', name='feature')
+    for group in groups:
+        part = df.iloc[group]
+        intensities = part[samples].to_numpy(dtype='float')
+        completeness = (~np.isnan(intensities)).sum(axis=1)
+        medians = [np.nanmedian(row) if completeness[i] else -np.inf for i, row in enumerate(intensities)]
+        best = min(range(len(group)), key=lambda i: (-completeness[i], -medians[i], i))
+        row = part.iloc[best].copy()
+        row['mzmin'], row['mzmax'] = part['mzmin'].min(), part['mzmax'].max()
+        row['rtmin'], row['rtmax'] = part['rtmin'].min(), part['rtmax'].max()
+        present = (~np.isnan(intensities)).any(axis=0)
+        if rule == 'max':
+            row[samples] = np.where(present, np.nanmax(np.where(present, intensities, 0), axis=0), np.nan)
+        elif rule == 'sum':
+            row[samples] = np.where(present, np.nansum(intensities, axis=0), np.nan)
+        rows.append(row)
+        features.iloc[group] = row.name
+    return pd.DataFrame(rows).astype(df.dtypes.to_dict()), features
+
+
+@pytest.fixture(scope='module')
+def table():
+    df = synthetic_peak_table(300, 10)
+    samples = sample_layout(df).samples
+    rng = np.random.default_rng(1)
+    # Split features: shifted copies of some features with their own missing values
+    copies = df.iloc[rng.choice(len(df), 100)].copy()
+    scale, shift = 1 + rng.uniform(-4e-6, 4e-6, len(copies)), rng.uniform(-4, 4, len(copies))
+    for column in ('mz', 'mzmin', 'mzmax'):
+        copies[column] *= scale
+    for column in ('rt', 'rtmin', 'rtmax'):
+        copies[column] += shift
+    copies[samples] = copies[samples].where(rng.random(copies[samples].shape) > 0.3) * 1.1
+    copies.index = [f'{name}_split{i}' for i, name in enumerate(copies.index)]
+    return pd.concat([df, copies]).iloc[rng.permutation(len(df) + len(copies))]
+
+
+@pytest.mark.parametrize('rule', ['max', 'sum', 'complete'])
+@pytest.mark.parametrize('mz_tolerance, rt_tolerance', [(0, 0), (50, 200)])
+def test_merge_agrees_with_reference(table, rule, mz_tolerance, rt_tolerance):
+    merged, features = merge_features(table, rule, mz_tolerance, rt_tolerance, report=True)
+    expected, expected_features = reference_merge_features(table, rule, mz_tolerance, rt_tolerance)
+    assert len(merged) < len(table)
+    pd.testing.assert_frame_equal(merged, expected)
+    pd.testing.assert_series_equal(features.astype('object'), expected_features)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from functions.processing_dataset.normalization import standard_normalization, find_standards
+
+mzs = {'pg': [709.55189], 'pe': [740.54648]}
+classes = ['pg', 'pe', 'pg', 'pe', 'pc']
+
+
+def standards_frame(index):
+    # Standards pg and pe, a lipid of each class and a lipid of class without standard
+    return pd.DataFrame({'mz': [709.55189, 740.54648, 700.1, 750.2, 800.3],
+                         's1': [10., 20., 5., 6., 7.],
+                         's2': [11., np.nan, 5., 6., 7.],
+                         's3': [12., 22., 5., 6., 7.]}, index=index)
+
+
+def test_class_standard_missing_in_one_sample():
+    df = standards_frame([f'p{i}' for i in range(5)])
+    normalized = standard_normalization(df, mzs, classes=pd.Series(classes, index=df.index))
+    samples = ['s1', 's2', 's3']
+    # pe keeps its standard, missing value of standard gives NA instead of maximal standard
+    np.testing.assert_allclose(normalized.loc['p3', samples].to_numpy(dtype='float'), [6 - 20, np.nan, 6 - 22])
+    np.testing.assert_allclose(normalized.loc['p2', samples].to_numpy(dtype='float'), [5 - 10, 5 - 11, 5 - 12])
+    # Class without standard is normalized by maximal one
+    np.testing.assert_allclose(normalized.loc['p4', samples].to_numpy(dtype='float'), [7 - 20, 7 - 11, 7 - 22])
+
+
+def test_class_without_standard_values():
+    df = standards_frame([f'p{i}' for i in range(5)])
+    df.loc['p1', ['s1', 's2', 's3']] = np.nan
+    normalized = standard_normalization(df, mzs, classes=pd.Series(classes, index=df.index))
+    np.testing.assert_allclose(normalized.loc['p3', ['s1', 's2', 's3']].to_numpy(dtype='float'),
+                               [6 - 10, 6 - 11, 6 - 12])
+
+
+def test_standards_with_duplicated_index():
+    df = standards_frame([0, 0, 1, 1, 2])
+    standards = find_standards(df, mzs)
+    assert len(standards) == 2
+    assert list(standards['standard']) == ['pg', 'pe']
+    np.testing.assert_allclose(standards['s1'].to_numpy(), [10, 20])
@@ -0,0 +1,25 @@
+import pandas as pd
+from functions.processing_dataset.pipeline import Pipeline
+
+
+def defined_stage(body):
+    # Function without source file, like one defined in notebook
+    namespace = {'__name__': 'notebook'}
+    exec(f'def stage(df):\n    return {body}', namespace)
+    return namespace['stage']
+
+
+def test_redefined_stage_invalidates_cache(tmp_path):
+    df = pd.DataFrame({'a': [1., 2.], 'b': [3., 4.]})
+    first = Pipeline(cache_dir=str(tmp_path)).add('stage', defined_stage('df + 1')).run(df)
+    second = Pipeline(cache_dir=str(tmp_path)).add('stage', defined_stage('df + 2')).run(df)
+    pd.testing.assert_frame_equal(first, df + 1)
+    pd.testing.assert_frame_equal(second, df + 2)
+
+
+def test_unchanged_stage_uses_cache(tmp_path):
+    df = pd.DataFrame({'a': [1., 2.], 'b': [3., 4.]})
+    pipeline = Pipeline(cache_dir=str(tmp_path)).add('stage', defined_stage('df + 1'))
+    assert pipeline.keys(df) == Pipeline().add('stage', defined_stage('df + 1')).keys(df)
+    pipeline.run(df)
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table, synthetic_metadata, merged_frame
+from functions.processing_dataset.column_division import sample_layout
+from functions.processing_dataset.substitute_na import substitute_na
+from functions.processing_dataset.scaling import log_transform, z_scale
+from functions.processing_dataset.normalization import (percentille_normalization, normalize, normalize_by_mass,
+                                                        std_normalization)
+from functions.visualizing.pca import pca_transform, mds_transform
+
+
+@pytest.fixture(scope='module')
+def tables():
+    return {dtype: synthetic_peak_table(500, 20, dtype=dtype) for dtype in ('float32', 'float64')}
+
+
+def assert_close(single, double, rtol=1e-5):
+    samples = sample_layout(double).samples
+    assert (single[samples].dtypes == 'float32').all()
+    np.testing.assert_allclose(single[samples].to_numpy(dtype='float64'), double[samples].to_numpy(), rtol=rtol,
+                               atol=1e-5)
+
+
+@pytest.mark.parametrize('method', ['half_min', 'quantile', 'knn'])
+def test_imputation(tables, method):
+    assert_close(substitute_na(tables['float32'], method), substitute_na(tables['float64'], method))
+
+
+@pytest.mark.parametrize('function', [percentille_normalization, z_scale,
+                                      lambda df: normalize(df, lambda x: x - x.mean()),
+                                      lambda df: std_normalization(df, df.iloc[0])])
+def test_normalization(tables, function):
+    single, double = (log_transform(substitute_na(tables[dtype])) for dtype in ('float32', 'float64'))
+    assert_close(function(single), function(double))
+
+
+def test_mass_normalization(tables):
+    metadata = synthetic_metadata(20)
+    single, double = (normalize_by_mass(merged_frame(log_transform(substitute_na(tables[dtype])), metadata))
+                      for dtype in ('float32', 'float64'))
+    n_peaks = len(tables['float64'])
+    np.testing.assert_allclose(single.iloc[:n_peaks].to_numpy(dtype='float64'),
+                               double.iloc[:n_peaks].to_numpy(dtype='float64'), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('function', [pca_transform, lambda df, dtype: (mds_transform(df, dtype=dtype),),
+                                      lambda df, dtype: pca_transform(df, solver='incremental', dtype=dtype)])
+def test_dimensionality_reduction(tables, function):
+    metadata = synthetic_metadata(20)
+    single, double = (merged_frame(log_transform(substitute_na(tables[dtype])).dropna(subset=list(metadata.index)),
+                                   metadata) for dtype in ('float32', 'float64'))
+    observed, expected = function(single, dtype='float32')[0], function(double, dtype=None)[0]
+    assert observed.dtype == 'float32' and expected.dtype == 'float64'
+    # Components are compared up to sign
+    np.testing.assert_allclose(np.abs(observed), np.abs(expected), rtol=1e-3, atol=1e-3 * np.abs(expected).max())
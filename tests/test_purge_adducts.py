@@ -0,0 +1,55 @@
+import re
+from collections import defaultdict
+import numpy as np
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table
+from functions.processing_dataset.column_division import sample_layout
+from functions.processing_dataset.purge_adducts import purge_adducts, adduct_priority, annotation_pattern
+
+
+def reference_purge_adducts(df, priority, intensity, tolerance):
+    # Brute force: compounds are chains of close masses in each pcgroup, the best ion is chosen by sorting of each one
+    statistic = {'median': np.nanmedian, 'max': np.nanmax}[intensity]
+    intensities = df[sample_layout(df).samples].to_numpy(dtype='float')
+    annotations = defaultdict(list)
+    for position, adduct in enumerate(df['adduct'].fillna('')):
+        for name, mass in re.findall(annotation_pattern, adduct):
+            values = intensities[position][~np.isnan(intensities[position])]
+            score = statistic(values) if len(values) else -np.inf
+            rank = priority.index(name) if name in priority else len(priority)
+            annotations[df['pcgroup'].iloc[position]].append((float(mass), rank, -score, position))
+
+    kept = set(np.flatnonzero(df['adduct'].fillna('').str.len() == 0))
+    for group in annotations.values():
+        group = sorted(group, key=lambda annotation: annotation[0])
+        compound = [group[0]]
+        for previous, annotation in zip(group, group[1:] + [None]):
+            if annotation is None or annotation[0] - previous[0] > tolerance:
+                kept.add(min(compound, key=lambda a: (a[1], a[2], a[3]))[3])
+                compound = []
+            if annotation is not None:
+                compound.append(annotation)
+    return df.iloc[sorted(kept)]
+
+
+@pytest.fixture(scope='module')
+def table():
+    df = synthetic_peak_table(3000, 20, adduct_rate=0.6)
+    samples = sample_layout(df).samples
+    rng = np.random.default_rng(1)
+    # Some peaks get the second hypothesis, rounded intensities give ties of scores
+    annotated = np.flatnonzero(df['adduct'].str.len() > 0)
+    second = rng.choice(annotated, len(annotated) // 5, replace=False)
+    masses = df['adduct'].iloc[second].str.split().str[1].astype(float) + rng.choice([0.002, 50], len(second))
+    df.iloc[second, df.columns.get_loc('adduct')] += ' [M+Cl]- ' + masses.round(4).astype(str)
+    df[samples] = df[samples].round(-4)
+    return df
+
+
+@pytest.mark.parametrize('priority, intensity', [(adduct_priority, 'median'), ((), 'median'), (adduct_priority, 'max'),
+                                                 (('[M+Cl]-', '[M-H]-'), 'median')])
+def test_adducts_agree_with_reference(table, priority, intensity):
+    cleaned = purge_adducts(table, priority, intensity)
+    expected = reference_purge_adducts(table, list(priority), intensity, 0.005)
+    assert len(cleaned) < len(table)
+    assert list(cleaned.index) == list(expected.index)
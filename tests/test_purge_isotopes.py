@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table
+from functions.processing_dataset.column_division import sample_layout
+from functions.processing_dataset.purge_isotopes import purge_isotopes
+
+
+def reference_purge_isotopes(df, samples):
+    # Implementation before vectorization: peak with the greatest number of maxima is chosen group by group
+    ids = df['isotopes'].str.extract(r'\[(?P<id>\d+)\]\[(?P<type>.+)\]', expand=True)['id']
+    chosen = [(group[samples] == group[samples].max(axis=0)).sum(axis=1).idxmax()
+              for _, group in df[ids.notna()].groupby(ids[ids.notna()])]
+    return pd.concat([df.loc[chosen], df[ids.isna()]])
+
+
+@pytest.mark.parametrize('decimals', [None, -5])
+def test_isotopes_agree_with_reference(decimals):
+    df = synthetic_peak_table(2000, 20, isotope_rate=0.5)
+    samples = sample_layout(df).samples
+    if decimals is not None:
+        # Rounded intensities give ties of maxima
+        df[samples] = df[samples].round(decimals)
+    pd.testing.assert_frame_equal(purge_isotopes(df), reference_purge_isotopes(df, samples))
+
+
+def test_monoisotopic_peaks_are_kept():
+    df = synthetic_peak_table(2000, 20, isotope_rate=0.5)
+    cleaned = purge_isotopes(df, keep='monoisotopic')
+    parsed = df['isotopes'].str.extract(r'\[(?P<id>\d+)\]\[(?P<type>.+)\]', expand=True)
+    kept = parsed.loc[cleaned.index]
+    assert kept['id'].dropna().is_unique
+    assert set(kept['id'].dropna()) == set(parsed['id'].dropna())
+    # Groups with [M] peak keep it
+    with_m = parsed.loc[parsed['type'] == 'M', 'id']
+    assert (kept.loc[kept['id'].isin(with_m), 'type'] == 'M').all()
+    assert len(cleaned) == parsed['id'].isna().sum() + parsed['id'].nunique()
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions.benchmarks.synthetic import synthetic_peak_table
+from functions.processing_dataset.pipeline import Pipeline, processing_pipeline
+from functions.processing_dataset.purge_control import purge_control
+from functions.processing_dataset.substitute_na import substitute_na
+from functions.processing_dataset.storage import save_peak_table, load_peak_table
+from functions.processing_dataset.streaming import stream_pipeline
+
+
+@pytest.fixture(scope='module')
+def sources(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('streaming')
+    df = synthetic_peak_table(1000, 20)
+    # The first chunks have no adduct annotations, so type of the column can't be inferred from them
+    df.iloc[:400, df.columns.get_loc('adduct')] = ''
+    df.to_csv(directory / 'table.csv')
+    save_peak_table(pd.read_csv(directory / 'table.csv', index_col=0), str(directory / 'stored'))
+    return directory
+
+
+def assert_same_table(streamed, expected):
+    assert list(streamed.index) == list(expected.index)
+    assert list(streamed.columns) == list(expected.columns)
+    for column in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[column]):
+            np.testing.assert_allclose(streamed[column].to_numpy(dtype='float'),
+                                       expected[column].to_numpy(dtype='float'), equal_nan=True)
+        else:
+            assert (streamed[column].fillna('').astype(str) == expected[column].fillna('').astype(str)).all()
+
+
+def read_table(path):
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, index_col=0)
+
+
+@pytest.mark.parametrize('source', ['table.csv', 'stored'])
+@pytest.mark.parametrize('destination', ['result.csv', 'result.parquet'])
+def test_streaming_agrees_with_whole_table(sources, source, destination):
+    pipeline = processing_pipeline(('contaminants', 'control', 'na_peaks', 'na'), cache_dir=None,
+                                   na_peaks={'fraction': 0.5})
+    table = (pd.read_csv(sources / source, index_col=0) if source.endswith('.csv') else
+             load_peak_table(str(sources / source)))
+    expected = pipeline.run(table)
+    read, written = stream_pipeline(pipeline, str(sources / source), str(sources / destination), chunksize=150)
+    assert (read, written) == (len(table), len(expected))
+    assert written < read
+    assert_same_table(read_table(str(sources / destination)), expected)
+
+
+def test_streaming_of_stage_with_report(sources):
+    pipeline = Pipeline(cache_dir=None).add('control', purge_control, report=True)
+    expected = pipeline.run(pd.read_csv(sources / 'table.csv', index_col=0))[0]
+    stream_pipeline(pipeline, str(sources / 'table.csv'), str(sources / 'report.parquet'), chunksize=150)
+    assert_same_table(read_table(str(sources / 'report.parquet')), expected)
+
+
+def test_streaming_rejects_stages_of_whole_table(sources):
+    pipeline = Pipeline(cache_dir=None).add('na', substitute_na, method='knn')
+    with pytest.raises(ValueError):
+        stream_pipeline(pipeline, str(sources / 'table.csv'), str(sources / 'knn.csv'))